@@ -0,0 +1,82 @@
+
+# @author Jason Chin
+#
+# Copyright (C) 2010 by Jason Chin 
+# Copyright (C) 2011 by Jason Chin
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+
+"""
+Run many small distributed shell script tasks through PypeClusterWorkflow against
+the local fake scheduler, and report the wall time, the number of status queries
+and the largest number of threads used by the controller.
+
+    python benchmark_cluster.py                # 10000 jobs, 500 running at a time
+    python benchmark_cluster.py 2000 100       # other numbers of jobs and running jobs
+"""
+
+import os
+import sys
+import time
+import shutil
+import threading
+import tempfile
+
+from pypeflow.task import PypeDistributibleTask, PypeThreadTaskBase
+from pypeflow.data import PypeLocalFile
+from pypeflow.cluster import PypeFakeScheduler
+from pypeflow.controller import PypeClusterWorkflow
+
+def bench(nJobs, maxRunning):
+    workDir = tempfile.mkdtemp(prefix="pypeflow_bench_")
+    try:
+        tasks = []
+        for i in range(nJobs):
+            out = PypeLocalFile("file://localhost%s/out_%d" % (workDir, i))
+            script = os.path.join(workDir, "job_%d.sh" % i)
+            with open(script, "w") as f:
+                f.write("touch %s\n" % out.localFileName)
+            tasks.append( PypeDistributibleTask(outputDataObjs = {"out": out},
+                                                URL = "task://localhost/bench/job_%d" % i,
+                                                distributed = True,
+                                                TaskType = PypeThreadTaskBase)(script) )
+        scheduler = PypeFakeScheduler(maxRunning = maxRunning)
+        wf = PypeClusterWorkflow(backend = scheduler, minPollInterval = 0.1, maxPollInterval = 2)
+        wf.CONCURRENT_THREAD_ALLOWED = nJobs
+        wf.MAX_NUMBER_TASK_SLOT = nJobs
+        wf.addTasks(tasks)
+
+        maxThreads = [threading.activeCount()]
+        def update(elapsed):
+            maxThreads[0] = max(maxThreads[0], threading.activeCount())
+        wf._update = update
+
+        start = time.time()
+        wf.refreshTargets(updateFreq = 0)
+        print "%d jobs, %d running at a time:" % (nJobs, maxRunning)
+        print "  %-28s %8.2f s" % ("wall time", time.time() - start)
+        print "  %-28s %8d" % ("#status queries", scheduler.nStatusQueries)
+        print "  %-28s %8d" % ("max #threads", maxThreads[0])
+        scheduler.close()
+    finally:
+        shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    nJobs = args[0] if args else 10000
+    maxRunning = args[1] if len(args) > 1 else 500
+    bench(nJobs, maxRunning)
@@ -0,0 +1,95 @@
+
+# @author Jason Chin
+#
+# Copyright (C) 2010 by Jason Chin 
+# Copyright (C) 2011 by Jason Chin
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+
+"""
+Time how long it takes to index a large layered DAG and to build the
+prerequisite map used by the concurrent workflow.
+
+    python benchmark_prereq_map.py                 # 10^5 and 10^6 nodes
+    python benchmark_prereq_map.py 200000          # other sizes
+    python benchmark_prereq_map.py -t 10000        # also time the old transitive closure
+
+Every layer has WIDTH tasks, each reading two outputs of the previous layer
+and writing one file, so a DAG of N nodes has about N/2 tasks.
+"""
+
+import sys
+import time
+
+from pypeflow.task import PypeTaskBase
+from pypeflow.data import PypeLocalFile
+from pypeflow.controller import PypeDependencyIndex
+
+WIDTH = 100
+
+def noop(self):
+    pass
+
+def makeLayeredTasks(nNodes, width = WIDTH):
+    nTasks = nNodes // 2
+    files = [ PypeLocalFile("file://localhost/tmp/bench/in_%d" % i) for i in range(width) ]
+    tasks = []
+    for i in range(nTasks):
+        layer, w = divmod(i, width)
+        prevLayer = files[layer * width: (layer + 1) * width]
+        out = PypeLocalFile("file://localhost/tmp/bench/out_%d_%d" % (layer, w))
+        tasks.append( PypeTaskBase("task://localhost/bench/t_%d_%d" % (layer, w),
+                                   inputDataObjs = {"a": prevLayer[w], "b": prevLayer[(w + 1) % width]},
+                                   outputDataObjs = {"out": out},
+                                   _taskFun = noop) )
+        files.append(out)
+    return tasks
+
+def timeIt(label, f):
+    start = time.time()
+    rtn = f()
+    print "  %-28s %8.2f s" % (label, time.time() - start)
+    return rtn
+
+def bench(nNodes, transitive = False):
+    print "%d nodes:" % nNodes
+    tasks = timeIt("create tasks", lambda: makeLayeredTasks(nNodes))
+
+    def buildIndex():
+        depIndex = PypeDependencyIndex()
+        for t in tasks:
+            depIndex.addTask(t)
+        return depIndex
+    depIndex = timeIt("build index", buildIndex)
+
+    taskURLs = [t.URL for t in tasks]
+    prereqMap = timeIt("direct prereq map", lambda: dict( (URL, depIndex.prereqTaskURLs(URL)) for URL in taskURLs ))
+    print "  %-28s %8d" % ("#prereq entries", sum(len(v) for v in prereqMap.itervalues()))
+
+    if transitive:
+        isTask = set(taskURLs)
+        closure = timeIt("transitive prereq map", lambda: dict(
+            (URL, [u for u in depIndex.transitivePrereqs(URL) if u in isTask and u != URL]) for URL in taskURLs ))
+        print "  %-28s %8d" % ("#prereq entries", sum(len(v) for v in closure.itervalues()))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    transitive = "-t" in args
+    sizes = [int(a) for a in args if a != "-t"] or [10**5, 10**6]
+    for nNodes in sizes:
+        bench(nNodes, transitive)
@@ -0,0 +1,331 @@
+# @author Jason Chin
+#
+# Copyright (C) 2010 by Jason Chin 
+# Copyright (C) 2011 by Jason Chin, Pacific Biosciences
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+
+"""
+
+PypeCluster: This module provides the backends used to submit the shell script tasks to
+a cluster job scheduler and to poll their state without blocking a thread per job, and a
+local stand-in for a scheduler to test and benchmark them without a cluster.
+
+"""
+
+import os
+import sys
+import re
+import errno
+import fcntl
+import shlex
+import getpass
+import pipes
+import threading
+import subprocess
+from collections import deque
+from common import PypeError
+
+class ClusterCommandError(PypeError):
+    pass
+
+# The index (from 1) of the element of an array job a script runs for, under the supported schedulers.
+ARRAY_INDEX_VARS = ("PYPEFLOW_ARRAY_INDEX", "SGE_TASK_ID", "SLURM_ARRAY_TASK_ID", "PBS_ARRAYID", "LSB_JOBINDEX")
+
+def elementId(jobId, index):
+    """
+    Return the id of an element of an array job, as listed by activeJobIds().
+    """
+    return "%s.%d" % (jobId, index)
+
+def writeChunkScript(fileName, script, chunkId):
+    """
+    Write a script running script with the chunk index in the PYPEFLOW_CHUNK_ID variable.
+    """
+    with open(fileName, "w") as f:
+        f.write("#!/bin/bash\nexport PYPEFLOW_CHUNK_ID=%d\nexec /bin/bash %s\n" % (chunkId, pipes.quote(script)))
+
+def writeArrayScript(fileName, members):
+    """
+    Write the script of an array job whose element i (from 1) runs the script of members[i-1],
+    a (script, chunk index) pair, with the chunk index in the PYPEFLOW_CHUNK_ID variable.
+
+    >>> writeArrayScript("/tmp/pypetest_array.sh", [("/bin/true", 0), ("/tmp/my script", 7)])
+    >>> print open("/tmp/pypetest_array.sh").read(),
+    #!/bin/bash
+    index=${PYPEFLOW_ARRAY_INDEX:-${SGE_TASK_ID:-${SLURM_ARRAY_TASK_ID:-${PBS_ARRAYID:-$LSB_JOBINDEX}}}}
+    case "$index" in
+    1) export PYPEFLOW_CHUNK_ID=0; exec /bin/bash /bin/true;;
+    2) export PYPEFLOW_CHUNK_ID=7; exec /bin/bash '/tmp/my script';;
+    esac
+    echo "no element $index in this array job" >&2
+    exit 1
+    """
+    index = "$" + ARRAY_INDEX_VARS[-1]
+    for var in reversed(ARRAY_INDEX_VARS[:-1]):
+        index = "${%s:-%s}" % (var, index)
+    lines = ["#!/bin/bash", "index=%s" % index, 'case "$index" in']
+    for i, (script, chunkId) in enumerate(members):
+        lines.append("%d) export PYPEFLOW_CHUNK_ID=%d; exec /bin/bash %s;;" % (i + 1, chunkId, pipes.quote(script)))
+    lines.extend(["esac", 'echo "no element $index in this array job" >&2', "exit 1"])
+    with open(fileName, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def _expandIndexSpec(spec):
+    """
+    >>> _expandIndexSpec("3"), _expandIndexSpec("4-10:3"), _expandIndexSpec("1,5-6")
+    ([3], [4, 7, 10], [1, 5, 6])
+    """
+    indices = []
+    for part in spec.split(","):
+        step = 1
+        if ":" in part:
+            part, step = part.split(":")
+        if "-" in part:
+            first, last = part.split("-")
+        else:
+            first = last = part
+        indices.extend(range(int(first), int(last) + 1, int(step)))
+    return indices
+
+class PypeGridEngine(object):
+
+    """
+    Submit job scripts and list the active jobs with the commands of a grid engine. The
+    commands are templates filled in with "%" and a dict:
+
+    - submitTemplate: with script, jobName and nSlots; its output must contain the job id,
+      the first match of jobIdPattern.
+    - statusCmd: with user; lists the jobs that are queued or running, one per line with
+      the job id as the first match of statusIdPattern. A job not listed any more is over.
+    - killTemplate: with jobIds, the space separated job ids.
+    - arraySubmitTemplate: like submitTemplate, with nElements too, to submit an array job.
+      For the lines of array jobs, the status query must also list the indices (from 1) of
+      their elements that are queued or running, as the first match of arrayIndexPattern:
+      an index, or a list of ranges like "1-10:1,12".
+
+    The defaults are for SGE. For Slurm, use e.g. submitTemplate="sbatch --parsable -J %(jobName)s
+    -c %(nSlots)d %(script)s", arraySubmitTemplate="sbatch --parsable --array=1-%(nElements)d ...",
+    statusCmd="squeue -h -r -o %%i -u %(user)s", arrayIndexPattern=r"_(\\d+)" and
+    killTemplate="scancel %(jobIds)s".
+
+    >>> engine = PypeGridEngine(submitTemplate="echo 'Your job 42 (\\"%(jobName)s\\") has been submitted'",
+    ...                         arraySubmitTemplate="echo 'Your job-array 43.1-%(nElements)d:1 has been submitted'",
+    ...                         statusCmd="printf 'job-ID  prior\\n------\\n 41 0.5\\n 42 0.5\\n 43 0.5 r 2\\n 43 0.5 qw 4-5:1\\n'")
+    >>> engine.submit("/tmp/job.sh", jobName="job")
+    '42'
+    >>> engine.submitArray("/tmp/array.sh", 5, jobName="job")
+    '43'
+    >>> sorted(engine.activeJobIds())
+    ['41', '42', '43', '43.2', '43.4', '43.5']
+    """
+
+    def __init__(self, submitTemplate="qsub -S /bin/bash -N %(jobName)s %(script)s",
+                       statusCmd="qstat -u %(user)s",
+                       killTemplate="qdel %(jobIds)s",
+                       jobIdPattern=r"(\d+)",
+                       statusIdPattern=r"^\s*(\d+)",
+                       arraySubmitTemplate="qsub -t 1-%(nElements)d -S /bin/bash -N %(jobName)s %(script)s",
+                       arrayIndexPattern=r"(\d+(?:-\d+:\d+)?(?:,\d+(?:-\d+:\d+)?)*)\s*$"):
+        self.submitTemplate = submitTemplate
+        self.statusCmd = statusCmd
+        self.killTemplate = killTemplate
+        self.jobIdPattern = re.compile(jobIdPattern)
+        self.statusIdPattern = re.compile(statusIdPattern)
+        self.arraySubmitTemplate = arraySubmitTemplate
+        self.arrayIndexPattern = re.compile(arrayIndexPattern)
+        self._arrayJobIds = set()
+
+    @staticmethod
+    def _run(cmd):
+        p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            raise ClusterCommandError("%r exited with status %d: %s" % (cmd, p.returncode, err.strip()))
+        return out
+
+    def submit(self, script, jobName="pypeflow", nSlots=1):
+        """
+        Submit the script and return its job id.
+        """
+        return self._submit(self.submitTemplate, script, jobName=jobName, nSlots=nSlots)
+
+    def submitArray(self, script, nElements, jobName="pypeflow", nSlots=1):
+        """
+        Submit the script as an array job of nElements elements and return its job id;
+        its elements are listed by activeJobIds() as elementId(jobId, index), index from 1.
+        """
+        jobId = self._submit(self.arraySubmitTemplate, script, jobName=jobName, nSlots=nSlots, nElements=nElements)
+        self._arrayJobIds.add(jobId)
+        return jobId
+
+    def _submit(self, template, script, **values):
+        out = self._run(template % dict(script=script, **values))
+        m = self.jobIdPattern.search(out)
+        if m is None:
+            raise ClusterCommandError("No job id in the output of the submission of %s: %r" % (script, out))
+        return m.group(1)
+
+    def activeJobIds(self):
+        """
+        Return the set of the ids of the jobs (and elements of array jobs) queued or running,
+        with a single status query.
+        """
+        out = self._run(self.statusCmd % dict(user=getpass.getuser()))
+        jobIds = set()
+        for line in out.splitlines():
+            m = self.statusIdPattern.search(line)
+            if m is None:
+                continue
+            jobId = m.group(1)
+            jobIds.add(jobId)
+            if jobId in self._arrayJobIds:
+                m = self.arrayIndexPattern.search(line[m.end():])
+                if m is not None:
+                    jobIds.update(elementId(jobId, i) for i in _expandIndexSpec(m.group(1)))
+        self._arrayJobIds.intersection_update(jobIds)
+        return jobIds
+
+    def kill(self, jobIds):
+        jobIds = sorted(set(jobId.split(".")[0] for jobId in jobIds)) # the whole array jobs
+        if jobIds:
+            self._run(self.killTemplate % dict(jobIds=" ".join(jobIds)))
+
+class PypeFakeScheduler(object):
+
+    """
+    A stand-in for a grid engine with the interface of PypeGridEngine, which runs the job
+    scripts as local processes, at most maxRunning at a time. Like a real scheduler, it
+    only starts queued jobs and notices finished ones when it is asked for their state.
+    The jobs are started by a small launcher process, so that they do not have to be
+    forked from the (possibly large) workflow process.
+
+    >>> scheduler = PypeFakeScheduler(maxRunning=1)
+    >>> open("/tmp/pypetest_fake_job.sh", "w").write("sleep 0.2\\n")
+    >>> scheduler.submit("/tmp/pypetest_fake_job.sh"), scheduler.submit("/tmp/pypetest_fake_job.sh")
+    ('1', '2')
+    >>> sorted(scheduler.activeJobIds()), scheduler.nRunning
+    (['1', '2'], 1)
+    >>> import time
+    >>> while scheduler.activeJobIds(): time.sleep(0.05)
+    >>> scheduler.nSubmitted, scheduler.nStatusQueries > 2
+    (2, True)
+    >>> scheduler.submitArray("/tmp/pypetest_fake_job.sh", 2)
+    '3'
+    >>> sorted(scheduler.activeJobIds())
+    ['3.1', '3.2']
+    >>> scheduler.close()
+    """
+
+    def __init__(self, maxRunning=None, shell="/bin/bash"):
+        self.maxRunning = maxRunning
+        self.shell = shell
+        self._lock = threading.Lock()
+        self._lastId = 0
+        self._queued = deque() # (job id, script)
+        self._running = set()
+        self._launcher = None
+        self._buf = ""
+        self.nSubmitted = 0
+        self.nStatusQueries = 0
+
+    @property
+    def nRunning(self):
+        return len(self._running)
+
+    def _startLauncher(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "launcher.py")
+        self._launcher = subprocess.Popen([sys.executable, script, self.shell],
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        fd = self._launcher.stdout.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def submit(self, script, jobName="pypeflow", nSlots=1):
+        with self._lock:
+            self._lastId += 1
+            jobId = str(self._lastId)
+            self._queued.append((jobId, script))
+            self.nSubmitted += 1
+            self._schedule()
+        return jobId
+
+    def submitArray(self, script, nElements, jobName="pypeflow", nSlots=1):
+        with self._lock:
+            self._lastId += 1
+            jobId = str(self._lastId)
+            for i in range(1, nElements + 1):
+                self._queued.append((elementId(jobId, i), script))
+            self.nSubmitted += 1
+            self._schedule()
+        return jobId
+
+    def _schedule(self):
+        if self._launcher is None:
+            self._startLauncher()
+        while 1:
+            try:
+                data = os.read(self._launcher.stdout.fileno(), 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                raise PypeError("The launcher of the fake scheduler exited")
+            lines = (self._buf + data).split("\n")
+            self._buf = lines.pop()
+            self._running.difference_update(lines)
+        toStart = []
+        while self._queued and (self.maxRunning is None or len(self._running) < self.maxRunning):
+            jobId, script = self._queued.popleft()
+            self._running.add(jobId)
+            toStart.append("start %s %s\n" % (jobId, script))
+        if toStart:
+            self._launcher.stdin.write("".join(toStart))
+            self._launcher.stdin.flush()
+
+    def activeJobIds(self):
+        with self._lock:
+            self.nStatusQueries += 1
+            self._schedule()
+            return set(self._running) | set(jobId for jobId, script in self._queued)
+
+    def kill(self, jobIds):
+        with self._lock:
+            jobIds = set(jobIds)
+            jobIds.update(j for j, s in self._queued if j.split(".")[0] in jobIds)
+            jobIds.update(j for j in self._running if j.split(".")[0] in jobIds)
+            self._queued = deque((j, s) for j, s in self._queued if j not in jobIds)
+            if self._launcher is not None:
+                self._launcher.stdin.write("".join("kill %s\n" % j for j in jobIds if j in self._running))
+                self._launcher.stdin.flush()
+
+    def close(self):
+        """
+        Let the launcher exit once the running jobs are over.
+        """
+        if self._launcher is not None:
+            self._launcher.stdin.close()
+            self._launcher.wait()
+            self._launcher = None
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
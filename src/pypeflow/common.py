@@ -46,7 +46,8 @@ from rdflib import Literal
 from rdflib import URIRef
 
 from subprocess import Popen, PIPE
-import time
+import os
+import errno
 
 pypeNS = Namespace("pype://v0.1/")
 
@@ -114,6 +115,42 @@ class PypeObject(object):
 
         return self._RDFGraph.serialize() 
 
+def waitForChild(p, block=True):
+
+    """
+    Block until the child process of the Popen object p is finished, and return
+    its exit status (negative for a signal, like Popen.returncode) together with
+    its resource usage (the os.wait4() rusage, or None if it was reaped elsewhere).
+    With block=False, return None at once if the child is still running.
+
+    >>> status, rusage = waitForChild(Popen(["sh", "-c", "exit 3"]))
+    >>> status, rusage.ru_utime >= 0
+    (3, True)
+    >>> p = Popen(["sleep", "1"])
+    >>> waitForChild(p, block=False) is None
+    True
+    >>> waitForChild(p)[0]
+    0
+    """
+
+    while 1:
+        try:
+            pid, sts, rusage = os.wait4(p.pid, 0 if block else os.WNOHANG)
+            break
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                return p.wait(), None # reaped by someone else already
+            raise
+    if pid == 0:
+        return None
+    if os.WIFSIGNALED(sts):
+        p.returncode = -os.WTERMSIG(sts)
+    else:
+        p.returncode = os.WEXITSTATUS(sts)
+    return p.returncode, rusage
+
 def runShellCmd(args,**kwargs):
 
     """ 
@@ -123,12 +160,7 @@ def runShellCmd(args,**kwargs):
     """
 
     p = Popen(args,**kwargs)
-    pStatus = None
-    while 1:
-        time.sleep(0.2)
-        pStatus = p.poll()
-        if pStatus != None:
-            break
+    pStatus, rusage = waitForChild(p)
     return pStatus
 
 def runSgeSyncJob(args):
@@ -140,10 +172,5 @@ def runSgeSyncJob(args):
     """
 
     p = Popen(args)
-    pStatus = None
-    while 1:
-        time.sleep(0.1)
-        pStatus = p.poll()
-        if pStatus != None:
-            break
+    pStatus, rusage = waitForChild(p)
     return pStatus
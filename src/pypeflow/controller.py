@@ -26,6 +26,7 @@
 PypeController: This module provides the PypeWorkflow that controlls how a workflow is excuted.
 
 """
+import os
 import sys
 import datetime
 import multiprocessing
@@ -33,17 +34,34 @@ import threading
 import time 
 import logging
 import Queue
+import select
+import errno
+import fcntl
+import signal
+import subprocess
+import types
+import hashlib
+import json
 from cStringIO import StringIO 
 from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
 
 # TODO(CD): When we stop using Python 2.5, use relative-imports and remove this dir from PYTHONPATH.
-from common import PypeError, PypeObject, Graph, URIRef, pypeNS
-from data import PypeDataObjectBase, PypeSplittableLocalFile
-from task import PypeTaskBase, PypeTaskCollection, PypeThreadTaskBase, getFOFNMapTasks
+from common import PypeError, PypeObject, Graph, pypeNS, waitForChild
+from data import PypeDataObjectBase, PypeSplittableLocalFile, statCache
+from task import PypeTaskBase, PypeTaskCollection, PypeThreadTaskBase, getFOFNMapTasks, runTaskBatch
 from task import TaskInitialized, TaskDone, TaskFail
+from statusboard import PypeStatusBoard, PypeMessageQueue
+from taskdb import PypeTaskStateDB, PypeParamDigestDB
+from outputcache import PypeOutputCache
+from scheduler import PypeReadyQueue, PypeSubmitQueue, PypeResourcePool, PypeConcurrencyController
+from cluster import PypeGridEngine, elementId, writeChunkScript, writeArrayScript
 
 logger = logging.getLogger(__name__)
 
+OutputCacheHit = "cache hit" # sent by the output cache threads to the workflow, like a task status
+OutputCacheMiss = "cache miss"
+
 class TaskExecutionError(PypeError):
     pass
 class TaskTypeError(PypeError):
@@ -52,6 +70,8 @@ class TaskFailureError(PypeError):
     pass
 class LateTaskFailureError(PypeError):
     pass
+class TaskOutputCollisionError(PypeError):
+    pass
 
 class PypeNode(object):
     """ 
@@ -62,18 +82,30 @@ class PypeNode(object):
         self.obj = obj
         self._outNodes = set()
         self._inNodes = set()
+        self._depth = None # cached, see depth
 
     def addAnOutNode(self, obj):
         self._outNodes.add(obj)
         
     def addAnInNode(self, obj):
         self._inNodes.add(obj)
+        self._resetDepth()
 
     def removeAnOutNode(self, obj):
         self._outNodes.remove(obj)
 
     def removeAnInNode(self, obj):
         self._inNodes.remove(obj)
+        self._resetDepth()
+
+    def _resetDepth(self):
+        # the depths of everything downstream depend on this one
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._depth is not None or node is self:
+                node._depth = None
+                stack.extend(node._outNodes)
 
     @property
     def inDegree(self):
@@ -85,76 +117,362 @@ class PypeNode(object):
     
     @property
     def depth(self):
-        if self.inDegree == 0:
-            return 1
-        return 1 + max([ node.depth for node in self._inNodes ])
+        """
+        The number of nodes on the longest path from a source node to this node. It is
+        computed without recursion and cached on every node visited on the way.
+        """
+        if self._depth is not None:
+            return self._depth
+        stack = [ (self, iter(self._inNodes)) ]
+        onPath = set([self])
+        while stack:
+            node, inNodes = stack[-1]
+            for n in inNodes:
+                if n._depth is None:
+                    if n in onPath:
+                        raise TaskExecutionError("Circle detected in the dependency graph at %s" % n.obj)
+                    onPath.add(n)
+                    stack.append( (n, iter(n._inNodes)) )
+                    break
+            else:
+                node._depth = 1 + max([ n._depth for n in node._inNodes ]) if node._inNodes else 1
+                onPath.discard(node)
+                stack.pop()
+        return self._depth
+
+class PypeDependencyIndex(object):
+    """
+    An adjacency index of the "prereq" relation between the tasks and the data
+    objects of a workflow. It is built straight from the inputDataObjs,
+    outputDataObjs and mutableDataObjs of the tasks, so finding the
+    dependencies does not need an RDF graph.
+
+    >>> from pypeflow.data import makePypeLocalFile
+    >>> from pypeflow.task import PypeTask
+    >>> fin = makePypeLocalFile("/tmp/pypetest/index_in")
+    >>> fout = makePypeLocalFile("/tmp/pypetest/index_out")
+    >>> @PypeTask(inputs={"i":fin}, outputs={"o":fout}, URL="task://index/t")
+    ... def t(self):
+    ...     pass
+    >>> index = PypeDependencyIndex()
+    >>> index.addTask(t)
+    >>> sorted(index.transitivePrereqs(fout.URL))
+    ['file://localhost/tmp/pypetest/index_in', 'file://localhost/tmp/pypetest/index_out', 'task://index/t']
+    >>> sorted(index.dependents(fin.URL))
+    ['task://index/t']
+    """
+
+    def __init__(self):
+        self._prereqs = {} # URL -> URLs it directly depends on
+        self._dependents = {} # URL -> URLs directly depending on it
+        self._mutables = {} # task URL -> URLs of its mutable data objects
+        self._mutableOwners = {} # mutable data object URL -> task URLs
+
+    @classmethod
+    def fromRDFGraph(cls, rdfGraph):
+        """
+        Build an index from the "pype:prereq" and "pype:hasMutable" triples of an RDF
+        graph, e.g. the _RDFGraph of a workflow, which was used to find the dependencies
+        before this index.
+        """
+        index = cls()
+        for s, p, o in rdfGraph.triples((None, pypeNS["prereq"], None)):
+            index._addEdge(str(o), str(s))
+        for s, p, o in rdfGraph.triples((None, pypeNS["hasMutable"], None)):
+            index._mutables.setdefault(str(s), set()).add(str(o))
+            index._mutableOwners.setdefault(str(o), set()).add(str(s))
+        return index
+
+    @classmethod
+    def _asIndex(cls, graph):
+        """
+        Return graph if it is an index, else the index of graph, taken as an RDF graph.
+        """
+        if isinstance(graph, cls):
+            return graph
+        return cls.fromRDFGraph(graph)
+
+    def _addEdge(self, prereqURL, URL):
+        self._prereqs.setdefault(URL, set()).add(prereqURL)
+        self._dependents.setdefault(prereqURL, set()).add(URL)
+
+    @staticmethod
+    def _discard(adjacency, URL, otherURL):
+        URLs = adjacency[URL]
+        URLs.discard(otherURL)
+        if not URLs:
+            del adjacency[URL]
+
+    @staticmethod
+    def _replace(adjacency, URL, oldURL, newURL):
+        URLs = adjacency[URL]
+        URLs.discard(oldURL)
+        URLs.add(newURL)
+
+    def addTask(self, taskObj):
+        """
+        Index the edges between a task and its input, output and mutable data objects.
+        """
+        URL = taskObj.URL
+        for dObj in taskObj.inputDataObjs.values():
+            self._addEdge(dObj.URL, URL)
+        for dObj in taskObj.outputDataObjs.values():
+            self._addEdge(URL, dObj.URL)
+        for dObj in taskObj.mutableDataObjs.values():
+            self._mutables.setdefault(URL, set()).add(dObj.URL)
+            self._mutableOwners.setdefault(dObj.URL, set()).add(URL)
+
+    def removeTask(self, URL):
+        """
+        Drop a task and all of its edges. Every edge touching a task node belongs to
+        that task, so only the task's own neighbours are visited.
+        """
+        for prereqURL in self._prereqs.pop(URL, ()):
+            self._discard(self._dependents, prereqURL, URL)
+        for dependentURL in self._dependents.pop(URL, ()):
+            self._discard(self._prereqs, dependentURL, URL)
+        for mutableURL in self._mutables.pop(URL, ()):
+            self._discard(self._mutableOwners, mutableURL, URL)
+
+    def renameNode(self, oldURL, newURL):
+        """
+        Move the edges of a task or data object node from oldURL to newURL.
+        """
+        if oldURL in self._prereqs:
+            prereqURLs = self._prereqs[newURL] = self._prereqs.pop(oldURL)
+            for prereqURL in prereqURLs:
+                self._replace(self._dependents, prereqURL, oldURL, newURL)
+        if oldURL in self._dependents:
+            dependentURLs = self._dependents[newURL] = self._dependents.pop(oldURL)
+            for dependentURL in dependentURLs:
+                self._replace(self._prereqs, dependentURL, oldURL, newURL)
+        if oldURL in self._mutables:
+            mutableURLs = self._mutables[newURL] = self._mutables.pop(oldURL)
+            for mutableURL in mutableURLs:
+                self._replace(self._mutableOwners, mutableURL, oldURL, newURL)
+        if oldURL in self._mutableOwners:
+            ownerURLs = self._mutableOwners[newURL] = self._mutableOwners.pop(oldURL)
+            for ownerURL in ownerURLs:
+                self._replace(self._mutables, ownerURL, oldURL, newURL)
+
+    def prereqs(self, URL):
+        return self._prereqs.get(URL, frozenset())
+
+    def dependents(self, URL):
+        return self._dependents.get(URL, frozenset())
+
+    def edges(self):
+        """
+        Generate all (prereqURL, URL) pairs, i.e. the "URL pype:prereq prereqURL" triples.
+        """
+        for URL, prereqURLs in self._prereqs.iteritems():
+            for prereqURL in prereqURLs:
+                yield prereqURL, URL
+
+    def mutableEdges(self):
+        """
+        Generate all (taskURL, mutableDataObjURL) pairs.
+        """
+        for URL, mutableURLs in self._mutables.iteritems():
+            for mutableURL in mutableURLs:
+                yield URL, mutableURL
+
+    def prereqTaskURLs(self, taskURL):
+        """
+        Return the set of URLs of the tasks producing the inputs of a task, i.e. its
+        immediate predecessors once the data objects are left out of the DAG.
+        """
+        taskURLs = set()
+        for dataURL in self._prereqs.get(taskURL, ()):
+            taskURLs.update(self._prereqs.get(dataURL, ()))
+        taskURLs.discard(taskURL)
+        return taskURLs
+
+    def transitivePrereqs(self, URL):
+        """
+        Return the set of URLs that URL depends on directly or indirectly, URL included.
+        """
+        connected = set([URL])
+        stack = [URL]
+        while stack:
+            for prereqURL in self._prereqs.get(stack.pop(), ()):
+                if prereqURL not in connected:
+                    connected.add(prereqURL)
+                    stack.append(prereqURL)
+        return connected
 
 class PypeGraph(object):
     """ 
     Representing a dependence DAG with PypeObjects. 
     """
 
-    def __init__(self, RDFGraph, subGraphNodes=None):
+    def __init__(self, depIndex, subGraphNodes=None):
         """
-        Construct an internal DAG with PypeObject given an RDF graph.
+        Construct an internal DAG with PypeObject given a PypeDependencyIndex (or an RDF
+        graph, as it used to be, see PypeDependencyIndex.fromRDFGraph()).
         A sub-graph can be constructed if subGraphNodes is not "None"
+        The nodes are numbered and the edges are kept as lists of node ids, so the
+        graph is left untouched by sorting.
         """
+        depIndex = PypeDependencyIndex._asIndex(depIndex)
 
-        self._RDFGraph = RDFGraph
-        self._allEdges = set()
-        self._allNodes = set()
-        self.url2Node ={}
+        self._URLs = [] # node id -> URL
+        self._ids = {} # URL -> node id
+        self._inIds = [] # node id -> ids of the prereq nodes
+        self._outIds = [] # node id -> ids of the dependent nodes
+        self._url2Node = None
 
-        for row in self._RDFGraph.query('SELECT ?s ?o WHERE {?s pype:prereq ?o . }', initNs=dict(pype=pypeNS)):
-            if subGraphNodes != None:
-                if row[0] not in subGraphNodes: continue
-                if row[1] not in subGraphNodes: continue
-            
-            sURL, oURL = str(row[0]), str(row[1])
-            
-            self.url2Node[sURL] = self.url2Node.get( sURL, PypeNode(str(row[0])) )
-            self.url2Node[oURL] = self.url2Node.get( oURL, PypeNode(str(row[1])) )
+        if subGraphNodes != None:
+            edges = ( (oURL, sURL) for sURL in subGraphNodes
+                                   for oURL in depIndex.prereqs(sURL) if oURL in subGraphNodes )
+        else:
+            edges = depIndex.edges()
+
+        for oURL, sURL in edges:
+            n1 = self._nodeId(oURL)
+            n2 = self._nodeId(sURL)
+            self._outIds[n1].append(n2)
+            self._inIds[n2].append(n1)
+
+    def _nodeId(self, URL):
+        nodeId = self._ids.get(URL)
+        if nodeId is None:
+            nodeId = self._ids[URL] = len(self._URLs)
+            self._URLs.append(URL)
+            self._inIds.append([])
+            self._outIds.append([])
+        return nodeId
+
+    @property
+    def url2Node(self):
+        """
+        The PypeNode objects of the graph, keyed by URL. They are only built when asked for.
+        """
+        if self._url2Node is None:
+            nodes = [PypeNode(URL) for URL in self._URLs]
+            for n1, outIds in enumerate(self._outIds):
+                for n2 in outIds:
+                    nodes[n1].addAnOutNode(nodes[n2])
+                    nodes[n2].addAnInNode(nodes[n1])
+            self._url2Node = dict(zip(self._URLs, nodes))
+        return self._url2Node
 
-            n1 = self.url2Node[oURL]
-            n2 = self.url2Node[sURL]
-            
-            n1.addAnOutNode(n2)
-            n2.addAnInNode(n1)
-            
-            anEdge = (n1, n2)
-            self._allNodes.add( n1 )
-            self._allNodes.add( n2 )
-            self._allEdges.add( anEdge )
-            
     def __getitem__(self, url):
         """PypeGraph["URL"] ==> PypeNode"""
         return self.url2Node[url]
 
+    def __len__(self):
+        return len(self._URLs)
+
+    def _levelIds(self):
+        """
+        Kahn's algorithm on a copy of the in-degrees, one topological level at a time.
+        """
+        inDegree = [len(inIds) for inIds in self._inIds]
+        wave = [n for n, d in enumerate(inDegree) if d == 0]
+        levels = []
+        nSorted = 0
+        while wave:
+            levels.append(wave)
+            nSorted += len(wave)
+            nextWave = []
+            for n in wave:
+                for m in self._outIds[n]:
+                    inDegree[m] -= 1
+                    if inDegree[m] == 0:
+                        nextWave.append(m)
+            wave = nextWave
+
+        if nSorted != len(self._URLs):
+            raise TaskExecutionError("Circle detected in the dependency graph: %s" % " -> ".join(self._findCycle(inDegree)))
+        return levels
+
+    def _findCycle(self, inDegree):
+        """
+        Return the URLs along one cycle, given the in-degrees left over by an incomplete sort.
+        Every node left over has a prereq that is left over too, so walking the prereqs
+        backward has to come back to a node already seen.
+        """
+        n = [m for m, d in enumerate(inDegree) if d > 0][0]
+        position = {}
+        path = []
+        while n not in position:
+            position[n] = len(path)
+            path.append(n)
+            n = [m for m in self._inIds[n] if inDegree[m] > 0][0]
+        cycle = path[position[n]:]
+        cycle.reverse()
+        return [self._URLs[m] for m in cycle + cycle[:1]]
+
     def tSort(self): #return a topoloical sort node list
         """
         Output topological sorted list of the graph element. 
         It raises a TeskExecutionError if a circle is detected.
         """
-        edges = self._allEdges.copy()
-        
-        S = [x for x in self._allNodes if x.inDegree == 0]
-        L = []
-        while len(S) != 0:
-            n = S.pop()
-            L.append(n)
-            outNodes = n._outNodes.copy()
-            for m in outNodes:
-                edges.remove( (n, m) )
-                n.removeAnOutNode(m)
-                m.removeAnInNode(n)
-                if m.inDegree == 0:
-                    S.append(m)
-        
-        if len(edges) != 0:
-            raise TaskExecutionError(" Circle detectd in the dependency graph ")
-        else:
-            return [x.obj for x in L]
+        return [self._URLs[n] for wave in self._levelIds() for n in wave]
+
+    def tSortLevels(self):
+        """
+        Output the graph elements grouped by topological level. Everything in a level
+        only depends on the elements of the previous levels, so the elements within a
+        level can be processed concurrently. It raises a TeskExecutionError if a circle
+        is detected.
+        """
+        return [[self._URLs[n] for n in wave] for wave in self._levelIds()]
+
+    def _pathLengths(self, costs):
+        """
+        Return the node ids in topological order, and for every node the cost of the
+        longest path ending at it and of the longest path starting from it, both
+        including the node itself.
+        """
+        order = [n for wave in self._levelIds() for n in wave]
+        cost = [costs.get(URL, 0) for URL in self._URLs]
+        head = [0] * len(order)
+        tail = [0] * len(order)
+        for n in order:
+            head[n] = cost[n] + max([head[m] for m in self._inIds[n]] or [0])
+        for n in reversed(order):
+            tail[n] = cost[n] + max([tail[m] for m in self._outIds[n]] or [0])
+        return order, cost, head, tail
+
+    def remainingPathCosts(self, costs):
+        """
+        Given a dictionary of node URL to cost, return for every node the cost of the
+        most costly chain starting from it, the node included.
+        """
+        order, cost, head, tail = self._pathLengths(costs)
+        return dict( (self._URLs[n], tail[n]) for n in order )
+
+    def criticalPath(self, costs):
+        """
+        Given a dictionary of node URL to cost (missing nodes cost nothing), return
+        the URLs along the most costly chain of the graph and a dictionary giving the
+        slack of every node, i.e. by how much it could be delayed without making the
+        whole graph take longer.
+        """
+        order, cost, head, tail = self._pathLengths(costs)
+        if not order:
+            return [], {}
+        makespan = max(head)
+        slack = dict( (self._URLs[n], makespan - (head[n] + tail[n] - cost[n])) for n in order )
+
+        n = max(order, key = lambda m: tail[m])
+        path = [n]
+        while self._outIds[n]:
+            n = max(self._outIds[n], key = lambda m: tail[m])
+            path.append(n)
+        return [self._URLs[m] for m in path], slack
                     
+SNAPSHOT_VERSION = 3 # 1 had no stable parameter digests, 2 digested the scheduling hints too
+
+def isSnapshot(fn):
+    """
+    Return whether fn was written by PypeWorkflow.writeSnapshot(), rather than being an RDFXML file.
+    """
+    with open(fn) as f:
+        return f.read(1) == "{"
+
 class PypeWorkflow(PypeObject):
     """ 
     Representing a PypeWorkflow. PypeTask and PypeDataObjects can be added
@@ -204,10 +522,15 @@ class PypeWorkflow(PypeObject):
             URL = "workflow://" + __file__+"/%d" % id(self)
 
         self._pypeObjects = {}
+        self._depIndex = PypeDependencyIndex() # kept up to date as objects are added or removed
+        self.taskRuntimes = {} # task URL -> seconds it took the last time it was run
 
         PypeObject.__init__(self, URL, **attributes)
 
         self._referenceRDFGraph = None #place holder for a reference RDF
+        self._referenceSnapshot = None # task URL -> record of the reference snapshot
+        if "snapshotFileName" not in self.__dict__:
+            self.snapshotFileName = None # snapshot written after, and used as reference before, refreshTargets()
 
         
     def addObject(self, obj):
@@ -225,6 +548,8 @@ class PypeWorkflow(PypeObject):
                 else:
                     continue
             self._pypeObjects[obj.URL] = obj
+            if isinstance(obj, PypeTaskBase):
+                self._depIndex.addTask(obj)
 
     def addTask(self, taskObj):
         self.addTasks([taskObj])
@@ -235,6 +560,8 @@ class PypeWorkflow(PypeObject):
         Add tasks into the workflow. The dependent input and output data objects are added automatically too. 
         It sets the message queue used for communicating between the task thread and the main thread. One has
         to use addTasks() or addTask() to add task objects to a threaded workflow.
+        The dependencies are indexed when a task is added, so a task whose data objects are changed
+        afterwards has to be removed and added again.
         """
         for taskObj in taskObjs:
             if isinstance(taskObj, PypeTaskCollection):
@@ -271,6 +598,8 @@ class PypeWorkflow(PypeObject):
         for obj in objs:
             if obj.URL in self._pypeObjects:
                 del self._pypeObjects[obj.URL]
+                if isinstance(obj, PypeTaskBase):
+                    self._depIndex.removeTask(obj.URL)
             else:
                 raise PypeError, "Unable to remove %s from the graph. (Object not found)" % obj.URL
 
@@ -279,12 +608,18 @@ class PypeWorkflow(PypeObject):
         obj._updateURL(newURL)
         self._pypeObjects[newURL] = obj
         del self._pypeObjects[oldURL]
+        self._depIndex.renameNode(oldURL, newURL)
 
 
             
+    @property
+    def _dependencyIndex(self):
+        # maintained by addObjects(), removeObjects() and updateURL(), nothing to recompute
+        return self._depIndex
+
     @property
     def _RDFGraph(self):
-        # expensive to recompute
+        # expensive to recompute, only needed for RDFXML
         graph = Graph()
         for URL, obj in self._pypeObjects.iteritems():
             for s,p,o in obj._RDFGraph:
@@ -292,6 +627,13 @@ class PypeWorkflow(PypeObject):
         return graph
 
     def setReferenceRDFGraph(self, fn):
+        """
+        Use the code digests in fn, the RDFXML of an earlier workflow or a snapshot from
+        writeSnapshot(), to find the tasks whose code changed since then.
+        """
+        if isSnapshot(fn):
+            self.setReferenceSnapshot(fn)
+            return
         self._referenceRDFGraph = Graph()
         self._referenceRDFGraph.load(fn)
         refMD5s = self._referenceRDFGraph.subject_objects(pypeNS["codeMD5digest"])
@@ -299,8 +641,74 @@ class PypeWorkflow(PypeObject):
             obj = self._pypeObjects[str(URL)]
             obj.setReferenceMD5(md5digest)
 
+    def writeSnapshot(self, fn):
+        """
+        Write the code and parameter digests and the input, output and mutable data objects
+        of each task to fn, as a header line followed by one JSON object per task, for
+        setReferenceSnapshot(). The file is replaced at once, when it is complete. A task
+        that is not done keeps the digests of the reference snapshot, if there is one, so
+        a code change is still noticed after a failed run.
+        """
+        reference = self._referenceSnapshot or {}
+        tmpFn = "%s.%d.tmp" % (fn, os.getpid())
+        with open(tmpFn, "w") as f:
+            f.write(json.dumps({"pypeflowSnapshot": SNAPSHOT_VERSION}) + "\n")
+            for URL in sorted(self._pypeObjects):
+                obj = self._pypeObjects[URL]
+                if not isinstance(obj, PypeTaskBase):
+                    continue
+                if obj.getStatus() != TaskDone and URL in reference:
+                    codeDigest = reference[URL]["codeMD5digest"]
+                    paramDigest = reference[URL].get("parameterMD5digest", obj._paramMD5digest)
+                else:
+                    codeDigest, paramDigest = obj._codeMD5digest, obj._paramMD5digest
+                record = {"URL": URL,
+                          "codeMD5digest": codeDigest,
+                          "parameterMD5digest": paramDigest,
+                          "inputs": sorted(o.URL for o in obj.inputDataObjs.values()),
+                          "outputs": sorted(o.URL for o in obj.outputDataObjs.values()),
+                          "mutables": sorted(o.URL for o in obj.mutableDataObjs.values())}
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+        os.rename(tmpFn, fn)
+
+    def setReferenceSnapshot(self, fn):
+        """
+        Read a snapshot written by writeSnapshot(), in one pass, and use its code and
+        parameter digests as the reference of the tasks of this workflow: a task whose code
+        or parameters changed since the snapshot is not satisfied, and so, in turn, are the
+        tasks that depend on it. Tasks that are not in this workflow are ignored.
+        """
+        snapshot = {}
+        with open(fn) as f:
+            header = json.loads(f.readline() or "{}")
+            version = header.get("pypeflowSnapshot")
+            if version not in (1, 2, SNAPSHOT_VERSION):
+                raise PypeError("%s is not a pypeflow snapshot" % fn)
+            for line in f:
+                record = json.loads(line)
+                if version < SNAPSHOT_VERSION:
+                    record.pop("parameterMD5digest", None) # not computed the same way
+                URL = str(record["URL"])
+                snapshot[URL] = record
+                obj = self._pypeObjects.get(URL)
+                if isinstance(obj, PypeTaskBase):
+                    obj.setReferenceMD5(str(record["codeMD5digest"]))
+                    if "parameterMD5digest" in record:
+                        obj.setReferenceParamMD5(str(record["parameterMD5digest"]))
+        self._referenceSnapshot = snapshot
+
+    def _useSnapshot(self):
+        # The snapshot of the last run is the reference of the first refreshTargets().
+        if self.snapshotFileName is not None and self._referenceSnapshot is None and (
+                os.path.exists(self.snapshotFileName)):
+            self.setReferenceSnapshot(self.snapshotFileName)
+
+    def _writeSnapshot(self):
+        if self.snapshotFileName is not None:
+            self.writeSnapshot(self.snapshotFileName)
+
     def _graphvizDot(self, shortName=False):
-        graph = self._RDFGraph
+        depIndex = self._dependencyIndex
         dotStr = StringIO()
         shapeMap = {"file":"box", "state":"box", "task":"component"}
         colorMap = {"file":"yellow", "state":"cyan", "task":"green"}
@@ -318,14 +726,12 @@ class PypeWorkflow(PypeObject):
                     s = URLParseResult.scheme + "://..." + URLParseResult.path.split("/")[-1] 
                 dotStr.write( '"%s" [shape=%s, fillcolor=%s, style=filled];\n' % (s, shape, color))
 
-        for row in graph.query('SELECT ?s ?o WHERE {?s pype:prereq ?o . }', initNs=dict(pype=pypeNS)):
-            s, o = row
+        for o, s in depIndex.edges():
             if shortName == True:
                     s = urlparse(s).scheme + "://..." + urlparse(s).path.split("/")[-1] 
                     o = urlparse(o).scheme + "://..." + urlparse(o).path.split("/")[-1] 
             dotStr.write( '"%s" -> "%s";\n' % (o, s))
-        for row in graph.query('SELECT ?s ?o WHERE {?s pype:hasMutable ?o . }', initNs=dict(pype=pypeNS)):
-            s, o = row
+        for s, o in depIndex.mutableEdges():
             if shortName == True:
                     s = urlparse(s).scheme + "://..." + urlparse(s).path.split("/")[-1] 
                     o = urlparse(o).scheme + "://..." + urlparse(o).path.split("/")[-1] 
@@ -372,34 +778,92 @@ class PypeWorkflow(PypeObject):
         return makeStr.getvalue()
 
     @staticmethod
-    def getSortedURLs(rdfGraph, objs):
+    def getTargetGraph(depIndex, objs):
+        """
+        Return the PypeGraph of everything needed to reach the objects in "objs",
+        or of the whole workflow if "objs" is empty. depIndex is the _dependencyIndex
+        of the workflow; an RDF graph, e.g. its _RDFGraph as was passed before the index,
+        still works, but the index is built from it on each call.
+        """
+        depIndex = PypeDependencyIndex._asIndex(depIndex)
         if len(objs) != 0:
             connectedPypeNodes = set()
             for obj in objs:
                 if isinstance(obj, PypeSplittableLocalFile):
                     obj = obj._completeFile
-                for x in rdfGraph.transitive_objects(URIRef(obj.URL), pypeNS["prereq"]):
-                    connectedPypeNodes.add(x)
-            tSortedURLs = PypeGraph(rdfGraph, connectedPypeNodes).tSort( )
+                connectedPypeNodes.update(depIndex.transitivePrereqs(obj.URL))
+            return PypeGraph(depIndex, connectedPypeNodes)
         else:
-            tSortedURLs = PypeGraph(rdfGraph).tSort( )
-        return tSortedURLs
+            return PypeGraph(depIndex)
+
+    @staticmethod
+    def getSortedURLs(depIndex, objs):
+        """
+        The URLs needed to reach "objs" (all of them if empty) in topological order.
+        depIndex can be an RDF graph, as for getTargetGraph().
+        """
+        return PypeWorkflow.getTargetGraph(depIndex, objs).tSort( )
+
+    @staticmethod
+    def getSortedLevels(depIndex, objs):
+        """
+        The URLs needed to reach "objs" grouped by topological level. The number of
+        tasks in each level gives an idea of how many task slots a run can use.
+        """
+        return PypeWorkflow.getTargetGraph(depIndex, objs).tSortLevels( )
+
+    def getTaskCosts(self, runtimes = None):
+        """
+        Return the expected cost of every task: its recorded run time if there is one
+        (from "runtimes" or from a previous run of this workflow), else its costHint.
+        """
+        if runtimes is None:
+            runtimes = self.taskRuntimes
+        costs = {}
+        for URL, obj in self._pypeObjects.iteritems():
+            if isinstance(obj, PypeTaskBase):
+                costs[URL] = runtimes.get(URL, obj.costHint)
+        return costs
+
+    def criticalPath(self, objs = [], runtimes = None):
+        """
+        Find the chain of tasks bounding the time needed to reach "objs" (the whole
+        workflow if empty), weighted by getTaskCosts(runtimes). Return the task URLs
+        along that chain and a dictionary giving the slack of every task, i.e. how
+        much longer it could take without delaying the end of the run.
+        """
+        path, slack = self.getTargetGraph(self._dependencyIndex, objs).criticalPath(self.getTaskCosts(runtimes))
+        isTask = lambda URL: isinstance(self._pypeObjects.get(URL), PypeTaskBase)
+        return [URL for URL in path if isTask(URL)], dict( (URL, s) for URL, s in slack.iteritems() if isTask(URL) )
 
     def refreshTargets(self, objs = [], callback = (None, None, None) ):
         """
         Execute the DAG to reach all objects in the "objs" argument.
         """
-        tSortedURLs = self.getSortedURLs(self._RDFGraph, objs)
-        for URL in tSortedURLs:
-            obj = self._pypeObjects[URL]
-            if not isinstance(obj, PypeTaskBase):
-                continue
-            else:
-                obj()
-                obj.finalize()
+        tSortedURLs = self.getSortedURLs(self._dependencyIndex, objs)
+        self._useSnapshot()
+        statCache.activate()
+        try:
+            for URL in tSortedURLs:
+                obj = self._pypeObjects[URL]
+                if not isinstance(obj, PypeTaskBase):
+                    continue
+                else:
+                    startTime = time.time()
+                    obj()
+                    self.taskRuntimes[URL] = time.time() - startTime
+                    obj.finalize()
+        finally:
+            self._writeSnapshot()
+            self._logStatCache()
+            statCache.deactivate()
         self._runCallback(callback)
         return True
 
+    def _logStatCache(self):
+        logger.info("stat cache: %d hits, %d misses (hit rate %.1f%%)" % (
+            statCache.hits, statCache.misses, 100 * statCache.hitRate))
+
     def _runCallback(self, callback = (None, None, None ) ):
         if callback[0] != None and callable(callback[0]):
             argv = []
@@ -429,21 +893,19 @@ class PypeWorkflow(PypeObject):
 
     @property
     def inputDataObjects(self):
-        graph = self._RDFGraph
+        depIndex = self._dependencyIndex
         inputObjs = []
         for obj in self.dataObjects:
-            r = graph.query('SELECT ?o WHERE {<%s> pype:prereq ?o .  }' % obj.URL, initNs=dict(pype=pypeNS))
-            if len(r) == 0:
+            if len(depIndex.prereqs(obj.URL)) == 0:
                 inputObjs.append(obj)
         return inputObjs
      
     @property
     def outputDataObjects(self):
-        graph = self._RDFGraph
+        depIndex = self._dependencyIndex
         outputObjs = []
         for obj in self.dataObjects:
-            r = graph.query('SELECT ?s WHERE {?s pype:prereq <%s> .  }' % obj.URL, initNs=dict(pype=pypeNS))
-            if len(r) == 0:
+            if len(depIndex.dependents(obj.URL)) == 0:
                 outputObjs.append(obj)
         return outputObjs
 
@@ -451,16 +913,65 @@ def PypeMPWorkflow(URL = None, **attributes):
     """Factory for the workflow using multiprocessing.
     """
     th = _PypeProcsHandler()
-    mq = multiprocessing.Queue()
+    mq = PypeStatusBoard()
+    se = multiprocessing.Event()
+    return _PypeConcurrentWorkflow(URL=URL, thread_handler=th, messageQueue=mq, shutdown_event=se,
+            attributes=attributes)
+
+def PypeMPPoolWorkflow(URL = None, maxTasksPerChild = None, **attributes):
+    """Factory for the workflow using a pool of long-lived worker processes, at most
+    CONCURRENT_THREAD_ALLOWED of them, instead of a new process per task. A worker is
+    replaced after maxTasksPerChild tasks (never, if None). The workers are forked when
+    they are first needed during refreshTargets(), so they see the tasks as they were then.
+    """
+    th = _PypeProcPoolHandler(maxTasksPerChild)
+    mq = PypeStatusBoard()
     se = multiprocessing.Event()
     return _PypeConcurrentWorkflow(URL=URL, thread_handler=th, messageQueue=mq, shutdown_event=se,
             attributes=attributes)
 
+def PypeShellLoopWorkflow(URL = None, **attributes):
+    """Factory for the workflow that runs the commands of the shell script tasks (e.g. from
+    PypeShellTask or PypeDistributibleTask) from a single event loop thread instead of one
+    thread per task, so CONCURRENT_THREAD_ALLOWED can be set to thousands of jobs. The
+    other tasks run in threads as with PypeThreadWorkflow.
+    """
+    th = _PypeShellLoopHandler()
+    mq = PypeMessageQueue()
+    se = threading.Event()
+    return _PypeConcurrentWorkflow(URL=URL, thread_handler=th, messageQueue=mq, shutdown_event=se,
+            attributes=attributes)
+
+def PypeClusterWorkflow(URL = None, backend = None, minPollInterval = 1.0, maxPollInterval = 60.0, **attributes):
+    """Factory for the workflow that submits the distributed shell script tasks (from
+    PypeSGETask, or PypeDistributibleTask with distributed=True) to a cluster through
+    backend, a PypeGridEngine by default (or e.g. a cluster.PypeFakeScheduler for testing),
+    without keeping a thread or a process per job. The state of all the jobs is queried at
+    once, every minPollInterval seconds while jobs finish, backing off up to maxPollInterval
+    seconds while they do not. The other tasks run as with PypeShellLoopWorkflow.
+    """
+    if backend is None:
+        backend = PypeGridEngine()
+    th = _PypeClusterHandler(backend, minPollInterval, maxPollInterval)
+    mq = PypeMessageQueue()
+    se = threading.Event()
+    return _PypeConcurrentWorkflow(URL=URL, thread_handler=th, messageQueue=mq, shutdown_event=se,
+            attributes=attributes)
+
+class _classOrInstanceMethod(object):
+    """Like classmethod, but the method gets the instance when it is called on one.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+    def __get__(self, obj, cls):
+        return types.MethodType(self.func, cls if obj is None else obj)
+
 def PypeThreadWorkflow(URL = None, **attributes):
     """Factory for the workflow using threading.
     """
     th = _PypeThreadsHandler()
-    mq = Queue.Queue()
+    mq = PypeMessageQueue()
     se = threading.Event()
     return _PypeConcurrentWorkflow(URL=URL, thread_handler=th, messageQueue=mq, shutdown_event=se,
             attributes=attributes)
@@ -474,14 +985,37 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
 
     CONCURRENT_THREAD_ALLOWED = 16
     MAX_NUMBER_TASK_SLOT = CONCURRENT_THREAD_ALLOWED
+    STAT_SCAN_THREADS = 16 # for the freshness scan before the tasks are scheduled
+    OUTPUT_CACHE_THREADS = 4 # to hash the inputs and copy the outputs of the cached tasks
+    MAX_WAIT = 1.0 # seconds, the longest the scheduler waits for a message before it looks at the workers again
 
-    @classmethod
-    def setNumThreadAllowed(cls, nT, nS):
+    @_classOrInstanceMethod
+    def setNumThreadAllowed(self, nT, nS):
         """
-        Override the default number of threads used to run the tasks with this method.
+        Override the number of threads used to run the tasks and the number of task slots
+        with this method. Called on a workflow, it sets the limits of that workflow only;
+        called on a workflow factory (e.g. PypeThreadWorkflow.setNumThreadAllowed()), it
+        sets the defaults of the workflows that do not set their own.
         """
-        cls.CONCURRENT_THREAD_ALLOWED = nT
-        cls.MAX_NUMBER_TASK_SLOT = nS
+        self.CONCURRENT_THREAD_ALLOWED = nT
+        self.MAX_NUMBER_TASK_SLOT = nS
+
+    def setAdaptiveConcurrency(self, minTasks=1, maxTasks=None, **options):
+        """
+        Let a PypeConcurrencyController choose the number of tasks running at once, between
+        minTasks and maxTasks (CONCURRENT_THREAD_ALLOWED by default), from the load average,
+        the free memory and the task throughput observed while the workflow runs. The
+        options are passed to PypeConcurrencyController (e.g. interval, maxLoad,
+        minFreeMemory). Call it with minTasks=None to go back to CONCURRENT_THREAD_ALLOWED.
+        """
+        if minTasks is None:
+            self.concurrencyController = None
+            return
+        if maxTasks is None:
+            maxTasks = self.CONCURRENT_THREAD_ALLOWED
+        self.concurrencyController = PypeConcurrencyController(minTasks, maxTasks, **options)
+
+    readyTaskOrders = ("criticalPath", "fifo")
 
     def __init__(self, URL, thread_handler, messageQueue, shutdown_event, attributes):
         PypeWorkflow.__init__(self, URL, **attributes )
@@ -489,6 +1023,181 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
         self.messageQueue = messageQueue
         self.shutdown_event = shutdown_event
         self.jobStatusMap = dict()
+        self.resourceCapacities = dict(attributes.get("resourceCapacities", {}))
+        self.resourceUtilisation = {}
+        self._resourcePool = None
+        self.concurrencyController = None
+        self.stateDB = None
+        self.paramDB = None
+        self.outputCache = None
+        self._outputCachePool = None
+        self.dispatchStats = {"tasks": 0, "workers": 0, "batches": 0, "batchedTasks": 0,
+                              "timedTasks": 0, "overheadSeconds": 0.0}
+        self.setReadyTaskOrder(attributes.get("readyTaskOrder", "criticalPath"))
+        self.setBatchSize(attributes.get("batchSize", 16))
+        self.setParamDigestDB(attributes.get("paramDigestDB", ".pypeflow/params.sqlite"))
+
+    def setStateDB(self, dbFileName=".pypeflow/taskstate.sqlite"):
+        """
+        Record the tasks this workflow completes in a PypeTaskStateDB kept in dbFileName, or
+        stop recording them with None. On a restart, the recorded tasks whose code and
+        parameters did not change, and whose prereqs are recorded too, are not checked with
+        isSatisfied() nor finalized again. Only the files of the ones at the edge of that
+        part of the graph, i.e. with a successor that is not recorded, no successor, or an
+        input no task makes, are compared with the record; a file changed deeper inside it
+        is not noticed. A recorded task whose parameters changed is run again, and so are
+        the tasks that depend on it.
+        """
+        self.stateDB = PypeTaskStateDB(dbFileName) if dbFileName is not None else None
+
+    def setParamDigestDB(self, dbFileName=".pypeflow/params.sqlite"):
+        """
+        Record the parameter digest of each task this workflow completes or finds up to date
+        in a PypeParamDigestDB kept in dbFileName, or stop recording them with None. A task
+        whose parameters changed since is not satisfied, unless a snapshot says otherwise,
+        and so, in turn, are the tasks that depend on it. This is the default, with the
+        database in .pypeflow/ of the directory the workflow was made in; the attribute
+        paramDigestDB sets dbFileName.
+        """
+        self.paramDB = PypeParamDigestDB(dbFileName) if dbFileName is not None else None
+
+    def _useParamDigests(self, sortedTaskList):
+        """
+        Use the parameter digests recorded by the earlier runs as the reference of the tasks
+        that have none from a snapshot.
+        """
+        records = self.paramDB.load()
+        for URL, taskObj, tStatus in sortedTaskList:
+            if tStatus == TaskInitialized and taskObj._referenceParamMD5 is None:
+                taskObj.setReferenceParamMD5(self.paramDB.recorded(records, taskObj))
+
+    def _recordDone(self, taskObj):
+        """
+        Record a task that completed, or was found up to date, in the databases in use.
+        """
+        if self.stateDB is not None:
+            self.stateDB.recordDone(taskObj)
+        if self.paramDB is not None:
+            self.paramDB.record(taskObj)
+
+    def setOutputCache(self, cacheDir=".pypeflow/outputcache", maxBytes=None):
+        """
+        Keep the outputs of the tasks this workflow runs in a PypeOutputCache in cacheDir,
+        shared by any number of workflows, or stop using it with None. A task about to run
+        whose code, parameters and input contents match an entry gets its outputs restored
+        from it instead, and is finalized as if it had run. The least recently used entries
+        are evicted when the cache holds more than maxBytes. The inputs are hashed and the
+        files copied by OUTPUT_CACHE_THREADS threads, not by the scheduling loop.
+        """
+        self.outputCache = PypeOutputCache(cacheDir, maxBytes) if cacheDir is not None else None
+
+    def _lookupOutputCache(self, taskObj, cacheKeys):
+        """
+        Run by the output cache threads: restore the outputs of a ready task from the cache,
+        or keep its key in cacheKeys to store its outputs once it ran, and tell the workflow.
+        """
+        try:
+            key = self.outputCache.key(taskObj)
+            hit = self.outputCache.restore(key, taskObj)
+        except Exception:
+            logger.exception("Failed to look up the outputs of %s in the cache" % taskObj.URL)
+            key, hit = None, False
+        cacheKeys[taskObj.URL] = key
+        self.messageQueue.put( (taskObj.URL, OutputCacheHit if hit else OutputCacheMiss) )
+
+    def _storeOutputCache(self, key, taskObj):
+        """
+        Run by the output cache threads: keep the outputs of a task that completed.
+        """
+        try:
+            self.outputCache.store(key, taskObj)
+        except Exception:
+            logger.exception("Failed to store the outputs of %s in the cache" % taskObj.URL)
+
+    def _closeOutputCachePool(self):
+        """
+        Wait for the output cache threads to finish what they were given.
+        """
+        if self._outputCachePool is None:
+            return
+        self._outputCachePool.close()
+        self._outputCachePool.join()
+        self._outputCachePool = None
+
+    def _trustedTasks(self, sortedTaskList, prereqJobURLMap):
+        """
+        Return the URLs of the tasks that do not need to be checked, see setStateDB().
+        """
+        records = self.stateDB.load()
+        depIndex = self._dependencyIndex
+        trustedURLs = set()
+        for URL, taskObj, tStatus in sortedTaskList: # prereqs first
+            record = records.get(URL)
+            if record is not None and tStatus == TaskInitialized:
+                taskObj.setReferenceParamMD5(record[1]) # a parameter change makes isSatisfied() fail
+            if tStatus != TaskInitialized or record is None or not self.stateDB.matches(record, taskObj):
+                continue
+            if all(p in trustedURLs or self.jobStatusMap[p] == TaskDone for p in prereqJobURLMap[URL]):
+                trustedURLs.add(URL)
+
+        successors = {}
+        for URL, taskObj, tStatus in sortedTaskList:
+            for p in prereqJobURLMap[URL]:
+                successors.setdefault(p, []).append(URL)
+        toVerify = []
+        for URL in trustedURLs:
+            taskObj = self._pypeObjects[URL]
+            if (not successors.get(URL) or not trustedURLs.issuperset(successors[URL]) or
+                    any(not depIndex.prereqs(o.URL) for o in taskObj.inputDataObjs.values())):
+                toVerify.append(URL)
+        statCache.prefetch([path for URL in toVerify for path in records[URL][2]], self.STAT_SCAN_THREADS)
+
+        verifiedURLs = set()
+        while toVerify:
+            URL = toVerify.pop()
+            if URL in verifiedURLs or URL not in trustedURLs:
+                continue
+            verifiedURLs.add(URL)
+            if not self.stateDB.verify(records[URL]):
+                logger.debug("The files of %s changed since it was recorded" % URL)
+                trustedURLs.discard(URL)
+                toVerify.extend(p for p in prereqJobURLMap[URL] if p in trustedURLs)
+        logger.info("state DB: %d tasks recorded as done, %d of them checked" % (len(trustedURLs), len(verifiedURLs)))
+        return trustedURLs
+
+    def setBatchSize(self, batchSize):
+        """
+        Set the largest number of ready lightweight tasks (see PypeThreadTaskBase.lightweight)
+        run back to back by one thread or process; 1 runs each task on its own. The ready
+        lightweight tasks are shared among the free workers, so a batch is smaller than
+        this when there are few of them. Batches are not used with the worker pool.
+        """
+        if batchSize < 1:
+            raise PypeError("The batch size must be at least 1, not %r" % batchSize)
+        self.batchSize = batchSize
+
+    def setResourceCapacity(self, name, capacity):
+        """
+        Limit the total amount of a resource (e.g. "mem_gb", "cores" or a user defined "io"
+        token pool) held by the running tasks of this workflow, see PypeThreadTaskBase.resources.
+        A capacity of None removes the limit. The "slots" resource is limited by
+        MAX_NUMBER_TASK_SLOT.
+        """
+        if capacity is None:
+            self.resourceCapacities.pop(name, None)
+        else:
+            self.resourceCapacities[name] = capacity
+
+    def setReadyTaskOrder(self, order):
+        """
+        Choose the order in which the ready tasks get the free task slots of this workflow.
+        With "criticalPath" (the default), the tasks with the most costly chain of tasks
+        left behind them go first, weighted as in getTaskCosts(); with "fifo", tasks go in
+        the order they became ready.
+        """
+        if order not in self.readyTaskOrders:
+            raise PypeError("Unknown ready task order %r, use one of %r" % (order, self.readyTaskOrders))
+        self.readyTaskOrder = order
 
     def addTasks(self, taskObjs):
         """
@@ -496,6 +1205,7 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
         It sets the message queue used for communicating between the task thread and the main thread. One has
         to use addTasks() or addTask() to add task objects to a threaded workflow.
         """
+        self._checkOutputCollisions(taskObjs)
         for taskObj in taskObjs:
             if isinstance(taskObj, PypeTaskCollection):
                 for subTaskObj in taskObj.getTasks() + taskObj.getScatterGatherTasks():
@@ -511,6 +1221,48 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
 
         PypeWorkflow.addTasks(self, taskObjs)
 
+    def _checkOutputCollisions(self, taskObjs):
+        """
+        Raise a TaskOutputCollisionError if a data object would be written by two tasks,
+        as they could run at the same time. This is checked once, when the tasks are added.
+        """
+        depIndex = self._dependencyIndex
+        newWriterURLs = {} # output data object URL -> task URL, for the tasks being added
+        for taskObj in taskObjs:
+            if isinstance(taskObj, PypeTaskCollection):
+                subTaskObjs = taskObj.getTasks() + taskObj.getScatterGatherTasks()
+            else:
+                subTaskObjs = [taskObj]
+            for subTaskObj in subTaskObjs:
+                for dataObj in subTaskObj.outputDataObjs.values():
+                    writerURLs = set(depIndex.prereqs(dataObj.URL))
+                    writerURLs.add(newWriterURLs.setdefault(dataObj.URL, subTaskObj.URL))
+                    writerURLs.discard(subTaskObj.URL)
+                    if writerURLs:
+                        raise TaskOutputCollisionError("output collision detected for data object %r betw %r and %r" %(
+                            dataObj, subTaskObj.URL, writerURLs.pop()))
+
+    def _scanFreshness(self, taskObjs):
+        """
+        Stat all the files of the tasks up front, concurrently, and return a dict of
+        URL -> isSatisfied() for the tasks that can be decided now. Tasks whose
+        inputs do not exist yet are left out; they are checked after their prereqs ran.
+        """
+        paths = []
+        for taskObj in taskObjs:
+            for o in taskObj.inputDataObjs.values() + taskObj.outputDataObjs.values() + taskObj.mutableDataObjs.values():
+                path = getattr(o, "localFileName", None)
+                if path is not None:
+                    paths.append(path)
+        statCache.prefetch(paths, self.STAT_SCAN_THREADS)
+        satisfiedMap = {}
+        for taskObj in taskObjs:
+            try:
+                satisfiedMap[taskObj.URL] = taskObj.isSatisfied()
+            except Exception, e:
+                logger.debug("Cannot check %s before its prereqs ran: %r" % (taskObj.URL, e))
+        return satisfiedMap
+
     def refreshTargets(self, objs=None,
                        callback=(None, None, None),
                        updateFreq=None,
@@ -518,7 +1270,16 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
         if objs is None:
             objs = []
         task2thread = {}
+        self._useSnapshot()
         try:
+            statCache.activate()
+            prepareMessages = getattr(self.messageQueue, "prepare", None)
+            if prepareMessages is not None:
+                # Before any task process is forked.
+                prepareMessages([URL for URL, obj in self._pypeObjects.items() if isinstance(obj, PypeTaskBase)])
+            controller = self.concurrencyController
+            self.thread_handler.prepare(self._pypeObjects,
+                                        controller.maxTasks if controller is not None else self.CONCURRENT_THREAD_ALLOWED)
             rtn = self._refreshTargets(task2thread, objs = objs, callback = callback, updateFreq = updateFreq, exitOnFailure = exitOnFailure)
             return rtn
         except:
@@ -532,7 +1293,7 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
             print "!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!"
             sys.stdout.flush()
             th = self.thread_handler
-            threads = list(task2thread.values())
+            threads = list(set(task2thread.values()))
             logger.warning("#tasks=%d, #alive=%d" %(len(threads), th.alive(threads)))
             try:
                 while th.alive(threads):
@@ -543,7 +1304,81 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
                 th.notifyTerminate(threads)
                 raise
             raise
+        finally:
+            self.thread_handler.shutdown()
+            self._closeOutputCachePool()
+            closeMessages = getattr(self.messageQueue, "close", None)
+            if closeMessages is not None:
+                closeMessages() # its wakeup pipe; it is opened again by the next refreshTargets()
+            self._logResourceUtilisation()
+            self._logDispatchStats()
+            self._logOutputCache()
+            if self.stateDB is not None:
+                self.stateDB.flush()
+            if self.paramDB is not None:
+                self.paramDB.flush()
+            self._writeSnapshot()
+            self._logStatCache()
+            statCache.deactivate()
+
+
+    def _receiveMessages(self, timeout=0):
+        """
+        Return the messages sent by the tasks since the last call, waiting up to timeout
+        seconds for the first one. The message queues of the workflows (PypeMessageQueue
+        or PypeStatusBoard) wake the workflow up as soon as a message comes in; a plain
+        Queue is drained one message at a time.
+        """
+        wait = getattr(self.messageQueue, "wait", None)
+        if wait is not None:
+            wait(timeout)
+            return self.messageQueue.drain()
+        messages = []
+        try:
+            messages.append(self.messageQueue.get(timeout > 0, timeout))
+            while 1:
+                messages.append(self.messageQueue.get_nowait())
+        except Queue.Empty:
+            pass
+        return messages
+
+    def _logDispatchStats(self):
+        stats = self.dispatchStats
+        if not stats["workers"]:
+            return
+        logger.info("dispatch: %d tasks on %d workers, %d of them in %d batches; %.1f ms overhead per task" % (
+            stats["tasks"], stats["workers"], stats["batchedTasks"], stats["batches"], 1000 * self.overheadPerTask()))
+
+    def _logOutputCache(self):
+        cache = self.outputCache
+        if cache is None or not (cache.hits + cache.misses):
+            return
+        logger.info("output cache: %d hits, %d misses (%.0f%% hit rate), %d stored, %d evicted" % (
+            cache.hits, cache.misses, 100 * cache.hitRate, cache.stores, cache.evictions))
+
+    def overheadPerTask(self):
+        """
+        Return the mean time, in seconds, the tasks of the last refreshTargets() took to run
+        beyond the time spent in their own run(), i.e. in starting a thread or a process,
+        messaging and listing their output directories. Batching lightweight tasks lowers it.
+        """
+        stats = self.dispatchStats
+        return stats["overheadSeconds"] / stats["timedTasks"] if stats["timedTasks"] else 0.0
 
+    def _logResourceUtilisation(self):
+        """
+        Keep the use of each resource during the last refreshTargets() in resourceUtilisation.
+        """
+        if self._resourcePool is None:
+            return
+        self.resourceUtilisation = self._resourcePool.utilisation()
+        self._resourcePool = None
+        for name, use in sorted(self.resourceUtilisation.items()):
+            if use["capacity"] is None:
+                logger.info("resource %s: peak %s, mean %.2f (not limited)" % (name, use["peak"], use["mean"]))
+            else:
+                logger.info("resource %s: peak %s/%s, mean %.2f (%.0f%%)" % (name, use["peak"], use["capacity"],
+                    use["mean"], 100 * use["fraction"]))
 
     def _refreshTargets(self, task2thread, objs,
                         callback,
@@ -551,8 +1386,9 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
                         exitOnFailure):
         thread = self.thread_handler.create
 
-        rdfGraph = self._RDFGraph # expensive to recompute, should not change during execution
-        tSortedURLs = self.getSortedURLs(rdfGraph, objs)
+        depIndex = self._dependencyIndex
+        targetGraph = self.getTargetGraph(depIndex, objs)
+        tSortedURLs = targetGraph.tSort()
 
         sortedTaskList = [ (str(u), self._pypeObjects[u], self._pypeObjects[u].getStatus()) for u in tSortedURLs
                             if isinstance(self._pypeObjects[u], PypeTaskBase) ]
@@ -562,10 +1398,15 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
             ))
 
         prereqJobURLMap = {}
+        capacities = dict(self.resourceCapacities)
+        capacities["slots"] = self.MAX_NUMBER_TASK_SLOT
+        resourcePool = self._resourcePool = PypeResourcePool(capacities)
+        if self.concurrencyController is not None:
+            self.concurrencyController.reset()
 
         for URL, taskObj, tStatus in sortedTaskList:
-            prereqJobURLs = [str(u) for u in rdfGraph.transitive_objects(URIRef(URL), pypeNS["prereq"])
-                                    if isinstance(self._pypeObjects[str(u)], PypeTaskBase) and str(u) != URL ]
+            # Only the immediate predecessors are kept; they cannot be done before their own prereqs.
+            prereqJobURLs = depIndex.prereqTaskURLs(URL)
 
             prereqJobURLMap[URL] = prereqJobURLs
 
@@ -574,18 +1415,74 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
             if taskObj.nSlots > self.MAX_NUMBER_TASK_SLOT:
                 raise TaskExecutionError("%s requests more %s task slots which is more than %d task slots allowed" %
                                           (str(URL), taskObj.nSlots, self.MAX_NUMBER_TASK_SLOT) )
+            for name in resourcePool.exceeds(taskObj.resources):
+                raise TaskExecutionError("%s requests %r of resource %r which is more than the capacity of %r" %
+                                          (str(URL), taskObj.resources[name], name, resourcePool.capacity(name)) )
+
+        readyQueue = PypeReadyQueue([t[0] for t in sortedTaskList], prereqJobURLMap, self.jobStatusMap)
+        if self.paramDB is not None:
+            self._useParamDigests(sortedTaskList)
+        trustedURLs = self._trustedTasks(sortedTaskList, prereqJobURLMap) if self.stateDB is not None else set()
+        satisfiedMap = self._scanFreshness([t[1] for t in sortedTaskList
+                                            if t[2] == TaskInitialized and t[0] not in trustedURLs])
 
-        sleep_time = 0
         nSubmittedJob = 0
-        usedTaskSlots = 0
         loopN = 0
         lastUpdate = None
-        activeDataObjs = set() #keep a set of output data object. repeats are illegal.
-        mutableDataObjs = set() #keep a set of mutable data object. a task will be delayed if a running task has the same output.
+        activeDataObjs = {} #output data object URL -> URL of the task writing it. repeats are illegal.
+        mutableDataObjs = {} #mutable data object URL -> URL of the task holding it. a task will be delayed if a running task has the same output.
+        mutableDelayedTaskURLs = {} #mutable data object URL -> tasks delayed by it, re-queued when it is released
         updatedTaskURLs = set() #to avoid extra stat-calls
+        runningTaskURLs = set() #submitted tasks that have not reported "done" or "fail" yet
+        submitTimes = {} #to record the task run times
+        cacheKeys = {} #URL of a running task -> its output cache key, taken before it ran
+        cacheLookups = set() #URLs of the ready tasks being looked up in the output cache
+        if self.outputCache is not None:
+            cachePool = self._outputCachePool = ThreadPool(self.OUTPUT_CACHE_THREADS)
+        workers = {} #URL of a running task -> the thread, process or batch running it, with the resources it holds
+        createBatch = getattr(self.thread_handler, "createBatch", None)
+        self.dispatchStats = {"tasks": 0, "workers": 0, "batches": 0, "batchedTasks": 0,
+                              "timedTasks": 0, "overheadSeconds": 0.0}
         failedJobCount = 0
         succeededJobCount = 0
-        jobsReadyToBeSubmitted = []
+        if self.readyTaskOrder == "criticalPath":
+            jobsReadyToBeSubmitted = PypeSubmitQueue(targetGraph.remainingPathCosts(self.getTaskCosts()))
+        else:
+            jobsReadyToBeSubmitted = PypeSubmitQueue()
+
+        def releaseWorker(URL, runSeconds):
+            # The resources of a batch are held until its last task is over.
+            worker = workers.pop(URL)
+            worker["remaining"] -= 1
+            if runSeconds is None:
+                worker["timed"] = False
+            else:
+                worker["runSeconds"] += runSeconds
+            if worker["remaining"]:
+                return
+            resourcePool.release(worker["resources"])
+            worker["thread"].join(timeout=10)
+            if worker["timed"]:
+                self.dispatchStats["timedTasks"] += worker["nTasks"]
+                self.dispatchStats["overheadSeconds"] += time.time() - worker["submitTime"] - worker["runSeconds"]
+
+        def holdDataObjs(URL, taskObj):
+            for dataObj in taskObj.outputDataObjs.values():
+                logger.debug( "add active data obj: %s" %(dataObj,))
+                activeDataObjs[dataObj.URL] = URL
+            for dataObj in taskObj.mutableDataObjs.values():
+                logger.debug( "add mutable data obj: %s" %(dataObj,))
+                mutableDataObjs[dataObj.URL] = URL
+
+        def releaseDataObjs(taskObj):
+            # The task may have written them, possibly in another process.
+            statCache.invalidateDataObjs(taskObj.outputDataObjs.values() + taskObj.mutableDataObjs.values())
+            for o in taskObj.outputDataObjs.values():
+                activeDataObjs.pop(o.URL, None)
+            for o in taskObj.mutableDataObjs.values():
+                mutableDataObjs.pop(o.URL, None)
+                for delayedURL in mutableDelayedTaskURLs.pop(o.URL, ()):
+                    readyQueue.push(delayedURL)
 
         while 1:
 
@@ -594,44 +1491,55 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
                 # exponential back-off for logging
                 logger.info("tick: %d, #updatedTasks: %d" %(loopN, len(updatedTaskURLs)))
 
-            for URL, taskObj, tStatus in sortedTaskList:
+            # Only the tasks whose prereqs just became done are looked at.
+            while readyQueue:
+                URL = readyQueue.pop()
+                taskObj = self._pypeObjects[URL]
                 if self.jobStatusMap[URL] != TaskInitialized:
                     continue
+                if URL in trustedURLs and updatedTaskURLs.isdisjoint(prereqJobURLMap[URL]):
+                    # Completed in an earlier run; it was finalized then.
+                    logger.debug(' Skipping task recorded as done: %s' %(URL,))
+                    taskObj.setStatus(TaskDone)
+                    if self.paramDB is not None:
+                        self.paramDB.record(taskObj)
+                    self.jobStatusMap[URL] = TaskDone
+                    readyQueue.taskDone(URL)
+                    continue
                 logger.debug(" #outputDataObjs: %d; #mutableDataObjs: %d" %(
                     len(taskObj.outputDataObjs.values()),
                     len(taskObj.mutableDataObjs.values()),
                     ))
                 prereqJobURLs = prereqJobURLMap[URL]
 
-                logger.debug(' preqs of %s:' %URL)
-                for u in prereqJobURLs:
-                    logger.debug('  %s: %s' %(self.jobStatusMap[u], u))
-                if any(self.jobStatusMap[u] != "done" for u in prereqJobURLs):
-                    # Note: If self.jobStatusMap[u] raises, then the sorting was wrong.
-                    #logger.debug('Prereqs not done! %s' %URL)
-                    continue
                 # Check for mutable collisions; delay task if any.
                 outputCollision = False
                 for dataObj in taskObj.mutableDataObjs.values():
-                    for fromTaskObjURL, mutableDataObjURL in mutableDataObjs:
-                        if dataObj.URL == mutableDataObjURL and taskObj.URL != fromTaskObjURL:
-                            logger.debug("mutable output collision detected for data object %r betw %r and %r" %(
-                                dataObj, dataObj.URL, mutableDataObjURL))
-                            outputCollision = True
-                            break
+                    fromTaskObjURL = mutableDataObjs.get(dataObj.URL, URL)
+                    if fromTaskObjURL != URL:
+                        logger.debug("mutable output collision detected for data object %r betw %r and %r" %(
+                            dataObj, URL, fromTaskObjURL))
+                        mutableDelayedTaskURLs.setdefault(dataObj.URL, []).append(URL)
+                        if satisfiedMap.get(URL):
+                            del satisfiedMap[URL] # the holder may change it before this one gets to run
+                        outputCollision = True
+                        break
                 if outputCollision:
                     continue
                 # Check for illegal collisions.
-                if len(activeDataObjs) < 100:
-                    # O(n^2) on active tasks, but pretty fast.
-                    for dataObj in taskObj.outputDataObjs.values():
-                        for fromTaskObjURL, activeDataObjURL in activeDataObjs:
-                            if dataObj.URL == activeDataObjURL and taskObj.URL != fromTaskObjURL:
-                                raise Exception("output collision detected for data object %r betw %r and %r" %(
-                                    dataObj, dataObj.URL, activeDataObjURL))
+                for dataObj in taskObj.outputDataObjs.values():
+                    fromTaskObjURL = activeDataObjs.get(dataObj.URL, URL)
+                    if fromTaskObjURL != URL:
+                        raise TaskOutputCollisionError("output collision detected for data object %r betw %r and %r" %(
+                            dataObj, URL, fromTaskObjURL))
                 # We use 'updatedTaskURLs' to short-circuit 'isSatisfied()', to avoid many stat-calls.
+                # A task re-run in this call forces its successors to re-run too, so looking at
+                # the immediate prereqs is enough to cover all of the ancestors.
                 # Note: Sorting should prevent FileNotExistError in isSatisfied().
-                if not (set(prereqJobURLs) & updatedTaskURLs) and taskObj.isSatisfied():
+                # The flags from the freshness scan are used only once, isSatisfied() is not idempotent.
+                satisfied = satisfiedMap.pop(URL, None)
+                if updatedTaskURLs.isdisjoint(prereqJobURLs) and (
+                        taskObj.isSatisfied() if satisfied is None else satisfied):
                     #taskObj.setStatus(pypeflow.task.TaskDone) # Safe b/c thread is not running yet, and all prereqs are done.
                     logger.info(' Skipping already done task: %s' %(URL,))
                     logger.debug(' (Status was %s)' %(self.jobStatusMap[URL],))
@@ -639,59 +1547,122 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
                     self.jobStatusMap[str(URL)] = TaskDone # to avoid re-stat on *this* call
                     successfullTask = self._pypeObjects[URL]
                     successfullTask.finalize()
+                    self._recordDone(successfullTask)
+                    readyQueue.taskDone(URL) # successors are handled in this same pass
                     continue
                 self.jobStatusMap[str(URL)] = "ready" # in case not all ready jobs are given threads immediately, to avoid re-stat
+                holdDataObjs(URL, taskObj)
+                if self.outputCache is not None and self.outputCache.cacheable(taskObj):
+                    # Queued for submission when the cache thread reports a miss.
+                    cacheLookups.add(URL)
+                    cachePool.apply_async(self._lookupOutputCache, (taskObj, cacheKeys))
+                    continue
                 jobsReadyToBeSubmitted.append( (URL, taskObj) )
-                for dataObj in taskObj.outputDataObjs.values():
-                    logger.debug( "add active data obj: %s" %(dataObj,))
-                    activeDataObjs.add( (taskObj.URL, dataObj.URL) )
-                for dataObj in taskObj.mutableDataObjs.values():
-                    logger.debug( "add mutable data obj: %s" %(dataObj,))
-                    mutableDataObjs.add( (taskObj.URL, dataObj.URL) )
 
             logger.debug( "#jobsReadyToBeSubmitted: %d" % len(jobsReadyToBeSubmitted) )
 
-            numAliveThreads = self.thread_handler.alive(task2thread.values())
+            numAliveThreads = self.thread_handler.alive(set(task2thread[u] for u in runningTaskURLs))
             #better job status detection, messageQueue should be empty and all return condition should be "done", or "fail"
-            if numAliveThreads == 0 and len(jobsReadyToBeSubmitted) == 0 and self.messageQueue.empty(): 
+            if (numAliveThreads == 0 and len(jobsReadyToBeSubmitted) == 0 and self.messageQueue.empty() and
+                    not cacheLookups):
                 logger.info( "_refreshTargets() finished with no thread running and no new job to submit" )
                 for URL in task2thread:
                     assert self.jobStatusMap[str(URL)] in ("done", "fail"), "status(%s)==%r" %(
                             URL, self.jobStatusMap[str(URL)])
                 break # End of loop!
 
-            while jobsReadyToBeSubmitted:
-                URL, taskObj  = jobsReadyToBeSubmitted[0]
-                numberOfEmptySlot = self.MAX_NUMBER_TASK_SLOT - usedTaskSlots 
-                logger.debug( "#empty_slots = %d/%d; #jobs_ready=%d" % (numberOfEmptySlot, self.MAX_NUMBER_TASK_SLOT, len(jobsReadyToBeSubmitted)))
-                if numberOfEmptySlot >= taskObj.nSlots and numAliveThreads < self.CONCURRENT_THREAD_ALLOWED:
+            if self.concurrencyController is not None:
+                concurrencyLimit = self.concurrencyController.update(numAliveThreads, succeededJobCount + failedJobCount,
+                                                                     len(jobsReadyToBeSubmitted))
+            else:
+                concurrencyLimit = self.CONCURRENT_THREAD_ALLOWED
+            # A task that does not fit holds back the lower priority tasks that need any of the
+            # resources it is short of, but not the ones that can use the other idle resources.
+            blockedResources = set()
+            heldBack = []
+            while jobsReadyToBeSubmitted and numAliveThreads < concurrencyLimit and (
+                    "slots" not in blockedResources):
+                entry = jobsReadyToBeSubmitted.popEntry()
+                URL, taskObj = entry[2]
+                resources = taskObj.resources
+                logger.debug( "#empty_slots = %d/%d; #jobs_ready=%d" % (self.MAX_NUMBER_TASK_SLOT - resourcePool.used("slots"),
+                    self.MAX_NUMBER_TASK_SLOT, len(jobsReadyToBeSubmitted) + 1))
+                shortOf = resourcePool.shortOf(resources)
+                if shortOf or blockedResources.intersection(name for name, amount in resources.items() if amount):
+                    blockedResources.update(shortOf)
+                    heldBack.append(entry)
+                    continue
+                members = [(URL, taskObj)]
+                if createBatch is not None and self.batchSize > 1 and taskObj.lightweight:
+                    # Share the ready lightweight tasks among the free workers, at most batchSize per worker.
+                    nFree = concurrencyLimit - numAliveThreads
+                    batchSize = min(self.batchSize, (len(jobsReadyToBeSubmitted) + nFree) // nFree)
+                    while len(members) < batchSize and jobsReadyToBeSubmitted:
+                        nextURL, nextTaskObj = jobsReadyToBeSubmitted.peek()
+                        if not nextTaskObj.lightweight or nextTaskObj.resources != resources:
+                            break
+                        members.append(jobsReadyToBeSubmitted.pop())
+                if len(members) == 1:
                     t = thread(target = taskObj)
-                    t.start()
+                else:
+                    t = createBatch([m[1] for m in members])
+                    logger.debug("Batched %d lightweight tasks" % len(members))
+                t.start()
+                resourcePool.acquire(resources)
+                numAliveThreads += 1
+                worker = {"thread": t, "resources": resources, "nTasks": len(members), "remaining": len(members),
+                          "submitTime": time.time(), "runSeconds": 0.0, "timed": True}
+                self.dispatchStats["workers"] += 1
+                self.dispatchStats["tasks"] += len(members)
+                if len(members) > 1:
+                    self.dispatchStats["batches"] += 1
+                    self.dispatchStats["batchedTasks"] += len(members)
+                for URL, taskObj in members:
                     task2thread[URL] = t
+                    workers[URL] = worker
+                    runningTaskURLs.add(URL)
+                    submitTimes[URL] = worker["submitTime"]
                     nSubmittedJob += 1
-                    usedTaskSlots += taskObj.nSlots
-                    numAliveThreads += 1
                     self.jobStatusMap[URL] = "submitted"
                     # Note that we re-submit completed tasks whenever refreshTargets() is called.
                     logger.debug("Submitted %r" %URL)
-                    logger.debug(" Details: %r" %taskObj)
-                    jobsReadyToBeSubmitted.pop(0)
-                else:
-                    break
-
-            logger.debug( "Total # of running threads: %d; alive tasks: %d; sleep=%f" % (
-                threading.activeCount(), self.thread_handler.alive(task2thread.values()), sleep_time) )
-            time.sleep(sleep_time)
+                    logger.debug(" Details: %r", taskObj) # pformat only if needed
+            for entry in heldBack:
+                jobsReadyToBeSubmitted.pushBack(entry) # in its place, ahead of the tasks queued after it
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug( "Total # of running threads: %d; alive tasks: %d" % (
+                    threading.activeCount(), numAliveThreads) )
+            # Block until a task sends a message; look at the workers at least every MAX_WAIT seconds.
+            messages = self._receiveMessages(self.MAX_WAIT)
             if updateFreq != None:
                 elapsedSeconds = updateFreq if lastUpdate==None else (datetime.datetime.now()-lastUpdate).seconds
                 if elapsedSeconds >= updateFreq:
                     self._update( elapsedSeconds )
                     lastUpdate = datetime.datetime.now( )
 
-            sleep_time = sleep_time + 0.1 if (sleep_time < 1) else 1
-            while not self.messageQueue.empty():
-                sleep_time = 0 # Wait very briefly while messages are coming in.
-                URL, message = self.messageQueue.get()
+            for item in messages:
+                URL, message = item[:2]
+                if message in (TaskDone, TaskFail) and URL not in runningTaskURLs:
+                    # e.g. the failure of a pool worker that died after its task reported.
+                    logger.warning("Ignored %r from %r, which is not running" % (message, URL))
+                    continue
+                if message in (OutputCacheHit, OutputCacheMiss):
+                    cacheLookups.discard(URL)
+                    taskObj = self._pypeObjects[URL]
+                    if message == OutputCacheMiss:
+                        jobsReadyToBeSubmitted.append( (URL, taskObj) )
+                        continue
+                    logger.info(' Restored the outputs of task from the cache: %s' %(URL,))
+                    taskObj.setStatus(TaskDone)
+                    self.jobStatusMap[URL] = TaskDone
+                    updatedTaskURLs.add(URL) # the outputs are new, the successors have to run
+                    releaseDataObjs(taskObj)
+                    taskObj.finalize()
+                    self._recordDone(taskObj)
+                    readyQueue.taskDone(URL)
+                    continue
+                runSeconds = item[2] if len(item) > 2 else None # sent with the final status by some workers
                 updatedTaskURLs.add(URL)
                 self.jobStatusMap[str(URL)] = message
                 logger.debug("message for %s: %r" %(URL, message))
@@ -699,29 +1670,36 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
                 if message in ["done"]:
                     successfullTask = self._pypeObjects[str(URL)]
                     nSubmittedJob -= 1
-                    usedTaskSlots -= successfullTask.nSlots
                     logger.debug("Success (%r). Joining %r..." %(message, URL))
-                    task2thread[URL].join(timeout=10)
+                    batched = workers[URL]["nTasks"] > 1
+                    releaseWorker(URL, runSeconds)
                     #del task2thread[URL]
+                    runningTaskURLs.discard(URL)
+                    if batched and runSeconds is not None:
+                        self.taskRuntimes[str(URL)] = runSeconds # not the time it waited for the rest of its batch
+                    else:
+                        self.taskRuntimes[str(URL)] = time.time() - submitTimes[URL]
                     succeededJobCount += 1
                     successfullTask.finalize()
-                    for o in successfullTask.outputDataObjs.values():
-                        activeDataObjs.remove( (successfullTask.URL, o.URL) )
-                    for o in successfullTask.mutableDataObjs.values():
-                        mutableDataObjs.remove( (successfullTask.URL, o.URL) )
+                    releaseDataObjs(successfullTask)
+                    key = cacheKeys.pop(URL, None)
+                    if key is not None:
+                        cachePool.apply_async(self._storeOutputCache, (key, successfullTask))
+                    self._recordDone(successfullTask)
+                    readyQueue.taskDone(str(URL))
                 elif message in ["fail"]:
                     failedTask = self._pypeObjects[str(URL)]
                     nSubmittedJob -= 1
-                    usedTaskSlots -= failedTask.nSlots
                     logger.info("Failure (%r). Joining %r..." %(message, URL))
-                    task2thread[URL].join(timeout=10)
+                    releaseWorker(URL, runSeconds)
                     #del task2thread[URL]
+                    runningTaskURLs.discard(URL)
                     failedJobCount += 1
                     failedTask.finalize()
-                    for o in failedTask.outputDataObjs.values():
-                        activeDataObjs.remove( (failedTask.URL, o.URL) )
-                    for o in failedTask.mutableDataObjs.values():
-                        mutableDataObjs.remove( (failedTask.URL, o.URL) )
+                    releaseDataObjs(failedTask)
+                    cacheKeys.pop(URL, None)
+                    if self.stateDB is not None:
+                        self.stateDB.forget(URL)
                 elif message in ["started, runflag: 1"]:
                     logger.info("Queued %s ..." %repr(URL))
                 elif message in ["started, runflag: 0"]:
@@ -730,8 +1708,9 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
                 else:
                     logger.warning("Got unexpected message %r from URL %r." %(message, URL))
 
-            for u,s in sorted(self.jobStatusMap.items()):
-                logger.debug("task status: %r, %r, used slots: %d" % (str(u),str(s), self._pypeObjects[str(u)].nSlots))
+            if logger.isEnabledFor(logging.DEBUG):
+                for u,s in sorted(self.jobStatusMap.items()):
+                    logger.debug("task status: %r, %r, used slots: %d" % (str(u),str(s), self._pypeObjects[str(u)].nSlots))
 
             if failedJobCount != 0 and (exitOnFailure or succeededJobCount == 0):
                 raise TaskFailureError("Counted %d failure(s) with 0 successes so far." %failedJobCount)
@@ -753,7 +1732,7 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
 
     def _graphvizDot(self, shortName=False):
 
-        graph = self._RDFGraph
+        depIndex = self._dependencyIndex
         dotStr = StringIO()
         shapeMap = {"file":"box", "state":"box", "task":"component"}
         colorMap = {"file":"yellow", "state":"cyan", "task":"green"}
@@ -784,14 +1763,12 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
                     
                 dotStr.write( '"%s" [shape=%s, fillcolor=%s, style=filled];\n' % (s, shape, color))
 
-        for row in graph.query('SELECT ?s ?o WHERE {?s pype:prereq ?o . }', initNs=dict(pype=pypeNS)):
-            s, o = row
+        for o, s in depIndex.edges():
             if shortName == True:
                 s = urlparse(s).scheme + "://..." + urlparse(s).path.split("/")[-1] 
                 o = urlparse(o).scheme + "://..." + urlparse(o).path.split("/")[-1] 
             dotStr.write( '"%s" -> "%s";\n' % (o, s))
-        for row in graph.query('SELECT ?s ?o WHERE {?s pype:hasMutable ?o . }', initNs=dict(pype=pypeNS)):
-            s, o = row
+        for s, o in depIndex.mutableEdges():
             if shortName == True:
                     s = urlparse(s).scheme + "://..." + urlparse(s).path.split("/")[-1] 
                     o = urlparse(o).scheme + "://..." + urlparse(o).path.split("/")[-1] 
@@ -802,6 +1779,9 @@ class _PypeConcurrentWorkflow(PypeWorkflow):
 # For a class-method:
 PypeThreadWorkflow.setNumThreadAllowed = _PypeConcurrentWorkflow.setNumThreadAllowed
 PypeMPWorkflow.setNumThreadAllowed = _PypeConcurrentWorkflow.setNumThreadAllowed
+PypeMPPoolWorkflow.setNumThreadAllowed = _PypeConcurrentWorkflow.setNumThreadAllowed
+PypeShellLoopWorkflow.setNumThreadAllowed = _PypeConcurrentWorkflow.setNumThreadAllowed
+PypeClusterWorkflow.setNumThreadAllowed = _PypeConcurrentWorkflow.setNumThreadAllowed
 
 class _PypeThreadsHandler(object):
     """Stateless method delegator, for injection.
@@ -810,6 +1790,12 @@ class _PypeThreadsHandler(object):
         thread = threading.Thread(target=target)
         thread.daemon = True  # so it will terminate on exit
         return thread
+    def createBatch(self, targets):
+        return self.create(lambda: runTaskBatch(targets))
+    def prepare(self, targets, nWorkers):
+        pass
+    def shutdown(self):
+        pass
     def alive(self, threads):
         return sum(thread.is_alive() for thread in threads)
     def join(self, threads, timeout):
@@ -826,12 +1812,409 @@ class _PypeThreadsHandler(object):
         """
         self.join(threads, 1)
 
+def _setCloseOnExec(fd, closeOnExec=True):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if closeOnExec:
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    else:
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+class _PypeShellJob(object):
+    """The handle of a shell script task run by a _PypeShellLoopHandler, used like a Thread.
+    """
+    def __init__(self, loop, taskObj):
+        self._loop = loop
+        self.taskObj = taskObj
+        self.proc = None
+        self.exitFd = None
+        self.started = False
+        self._finished = threading.Event()
+    def start(self):
+        self.started = True
+        self._loop._start(self)
+    def is_alive(self):
+        return self.started and not self._finished.is_set()
+    def join(self, timeout=None):
+        if self.started:
+            self._finished.wait(timeout)
+    def _finish(self, exitStatus, outputsSynced=False):
+        try:
+            self.taskObj.afterShellCmd(exitStatus, outputsSynced)
+        except Exception:
+            logger.exception("Failed to finish %s" % self.taskObj.URL)
+            self.taskObj._queue.put( (self.taskObj.URL, "fail") )
+        self._finished.set()
+    def _abort(self):
+        logger.exception("Failed to start %s" % self.taskObj.URL)
+        self.taskObj._queue.put( (self.taskObj.URL, "fail") )
+        self._finished.set()
+
+class _PypeShellLoopHandler(_PypeThreadsHandler):
+    """Run the commands of shell script tasks as child processes watched by one event
+    loop thread, and the other tasks in threads. The loop wakes up when a child may be
+    over, and reaps the children that are without waiting for the others: on SIGCHLD
+    (through the signal wakeup fd, when prepare() runs in the main thread), on the end
+    of a pipe each child inherits (closed when it exits, unless it passed it on to a
+    background process or closed it itself), and every reapInterval seconds without
+    SIGCHLD. Their tasks are finished (their outputs looked at, and reported to the
+    workflow) by a pool of finishThreads threads, so a slow one does not hold up the
+    others. The children still running at shutdown() are terminated.
+    """
+    finishThreads = 4
+    reapInterval = 0.1
+
+    def __init__(self):
+        self._jobs = {} # pid -> _PypeShellJob
+        self._pipes = {} # read end of the exit pipe -> pid
+        self._lock = threading.Lock()
+        self._poller = None
+        self._wakeFds = None
+        self._oldSigchld = None
+        self._thread = None
+        self._finishPool = None
+
+    def create(self, target):
+        if getattr(target, "shellCmd", None) is None:
+            return _PypeThreadsHandler.create(self, target)
+        return _PypeShellJob(self, target)
+
+    def prepare(self, targets, nWorkers):
+        if self._thread is not None:
+            return
+        self._poller = select.poll()
+        self._wakeFds = os.pipe()
+        for fd in self._wakeFds:
+            _setCloseOnExec(fd)
+        fcntl.fcntl(self._wakeFds[1], fcntl.F_SETFL, fcntl.fcntl(self._wakeFds[1], fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poller.register(self._wakeFds[0], select.POLLIN)
+        self._watchSigchld()
+        self._finishPool = ThreadPool(self.finishThreads)
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watchSigchld(self):
+        try:
+            oldSigchld = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        except ValueError:
+            return # not the main thread, reap every reapInterval instead
+        oldWakeupFd = signal.set_wakeup_fd(self._wakeFds[1])
+        if oldWakeupFd != -1:
+            # Somebody else's, leave it alone.
+            signal.set_wakeup_fd(oldWakeupFd)
+            signal.signal(signal.SIGCHLD, oldSigchld)
+            return
+        signal.siginterrupt(signal.SIGCHLD, False)
+        self._oldSigchld = oldSigchld
+
+    def _unwatchSigchld(self):
+        if self._oldSigchld is None:
+            return
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, self._oldSigchld)
+        self._oldSigchld = None
+
+    def _wakeUp(self, c):
+        try:
+            os.write(self._wakeFds[1], c)
+        except OSError, e:
+            if e.errno != errno.EAGAIN: # the pipe is full of wakeups already
+                raise
+
+    def shutdown(self):
+        if self._thread is None:
+            return
+        self._wakeUp("q")
+        self._thread.join()
+        self._thread = None
+        self._unwatchSigchld()
+        with self._lock:
+            jobs = self._jobs.values()
+            self._jobs.clear()
+            for fd in self._pipes:
+                os.close(fd)
+            self._pipes.clear()
+        for job in jobs:
+            logger.warning("Terminating %s, still running at shutdown" % job.taskObj.URL)
+            try:
+                os.kill(job.proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for job in jobs:
+            waitForChild(job.proc)
+            job._finished.set()
+        self._finishPool.close()
+        self._finishPool.join()
+        self._finishPool = None
+        for fd in self._wakeFds:
+            os.close(fd)
+        self._wakeFds = None
+
+    def _start(self, job):
+        taskObj = job.taskObj
+        rfd, wfd = os.pipe()
+        _setCloseOnExec(rfd)
+        _setCloseOnExec(wfd) # other children must not hold it, only this one
+        try:
+            taskObj.beforeShellCmd()
+            logger.debug("Running %s" % " ".join(taskObj.shellCmd))
+            job.proc = subprocess.Popen(taskObj.shellCmd, preexec_fn=lambda: _setCloseOnExec(wfd, False))
+        except Exception:
+            os.close(rfd)
+            os.close(wfd)
+            job._abort()
+            return
+        os.close(wfd)
+        job.exitFd = rfd
+        with self._lock:
+            self._jobs[job.proc.pid] = job
+            self._pipes[rfd] = job.proc.pid
+            self._poller.register(rfd, select.POLLIN)
+        self._wakeUp("w") # to poll the new pipe too, and reap the child if it is over already
+
+    def _loop(self):
+        while 1:
+            with self._lock:
+                timeout = None if self._oldSigchld is not None or not self._jobs else 1000 * self.reapInterval
+            try:
+                events = self._poller.poll(timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wakeFds[0]:
+                    if "q" in os.read(fd, 4096):
+                        return
+                    continue
+                # The child is over, or does not hold the pipe any more.
+                with self._lock:
+                    self._pipes.pop(fd)
+                    self._poller.unregister(fd)
+                os.close(fd)
+            self._reap()
+
+    def _reap(self):
+        with self._lock:
+            jobs = self._jobs.values()
+        for job in jobs:
+            result = waitForChild(job.proc, block=False)
+            if result is None:
+                continue
+            with self._lock:
+                del self._jobs[job.proc.pid]
+                if self._pipes.pop(job.exitFd, None) is not None:
+                    # Still held by a background process of the child.
+                    self._poller.unregister(job.exitFd)
+                    os.close(job.exitFd)
+            exitStatus, rusage = result
+            self._finishPool.apply_async(job._finish, (exitStatus,))
+
+    def alive(self, jobs):
+        return sum(job.is_alive() for job in jobs)
+
+    def notifyTerminate(self, jobs):
+        for job in jobs:
+            if isinstance(job, _PypeShellJob) and job.is_alive():
+                try:
+                    os.kill(job.proc.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        _PypeThreadsHandler.notifyTerminate(self, jobs)
+
+class _PypeClusterJob(_PypeShellJob):
+    """The handle of a distributed shell script task run by a _PypeClusterHandler.
+    """
+    jobId = None
+    seen = False # listed by a status query yet
+    missing = 0 # number of status queries in a row that did not list it
+    def start(self):
+        self.started = True
+        self._loop._submit(self)
+
+class _PypeClusterHandler(_PypeShellLoopHandler):
+    """Submit the distributed shell script tasks to a cluster through a backend (see the
+    cluster module) from one thread, which also finds out which jobs are over with one
+    status query for all of them at a time. A job that was listed by a status query and
+    is not any more is over; so is one that was never listed by missingPolls queries in a
+    row. The task status comes from its outputs, as the exit status is not known.
+
+    The tasks of a PypeTaskCollection (e.g. from PypeScatteredTasks or PypeFOFNMapTasks)
+    submitted together go as array jobs of up to maxArraySize elements. Each element runs
+    the script of its task with the chunk_id of the task in the PYPEFLOW_CHUNK_ID variable
+    (so the tasks can share one script), and is reported as soon as it is over.
+    """
+    missingPolls = 2
+    backoff = 1.5
+    maxArraySize = 1000
+    submitDelay = 0.1 # wait for more jobs of the same scheduling round before submitting
+
+    def __init__(self, backend, minPollInterval=1.0, maxPollInterval=60.0):
+        _PypeShellLoopHandler.__init__(self)
+        self.backend = backend
+        self.minPollInterval = minPollInterval
+        self.maxPollInterval = maxPollInterval
+        self._cond = threading.Condition()
+        self._toSubmit = []
+        self._lastQueued = 0
+        self._clusterJobs = {} # job id -> _PypeClusterJob, only used by the polling thread
+        self._stopping = False
+        self._pollThread = None
+        self.nPolls = 0
+
+    def create(self, target):
+        if getattr(target, "distributed", False) and getattr(target, "script", None) is not None:
+            return _PypeClusterJob(self, target)
+        return _PypeShellLoopHandler.create(self, target)
+
+    def prepare(self, targets, nWorkers):
+        _PypeShellLoopHandler.prepare(self, targets, nWorkers)
+        if self._pollThread is not None:
+            return
+        self._stopping = False
+        self._pollThread = threading.Thread(target=self._pollLoop)
+        self._pollThread.daemon = True
+        self._pollThread.start()
+
+    def shutdown(self):
+        if self._pollThread is not None:
+            with self._cond:
+                self._stopping = True
+                self._cond.notify()
+            self._pollThread.join()
+            self._pollThread = None
+        _PypeShellLoopHandler.shutdown(self)
+
+    def _submit(self, job):
+        with self._cond:
+            self._toSubmit.append(job)
+            self._lastQueued = time.time()
+            self._cond.notify()
+
+    @staticmethod
+    def _jobName(URL):
+        path = urlparse(URL).path.rstrip("/").split("/")
+        return "pf_" + "".join(c if c.isalnum() else "_" for c in path[-1])
+
+    def _submitJobs(self, jobs):
+        collections = {} # collection URL -> jobs
+        for job in jobs:
+            collectionURL = getattr(job.taskObj, "_collectionURL", None)
+            collections.setdefault(collectionURL, []).append(job)
+        for collectionURL, members in collections.items():
+            if collectionURL is None or len(members) == 1:
+                for job in members:
+                    self._submitNow(job)
+                continue
+            members.sort(key=lambda job: getattr(job.taskObj, "chunk_id", None))
+            for i in range(0, len(members), self.maxArraySize):
+                self._submitArray(collectionURL, members[i:i+self.maxArraySize])
+
+    def _submitNow(self, job):
+        taskObj = job.taskObj
+        try:
+            taskObj.beforeShellCmd()
+            script = taskObj.script
+            chunkId = getattr(taskObj, "chunk_id", None)
+            if chunkId is not None:
+                script = "%s.chunk%d.sh" % (taskObj.script, chunkId)
+                writeChunkScript(script, taskObj.script, chunkId)
+            job.jobId = self.backend.submit(script, jobName=self._jobName(taskObj.URL), nSlots=taskObj.nSlots)
+        except Exception:
+            job._abort()
+            return
+        logger.debug("Submitted %s as job %s" % (taskObj.URL, job.jobId))
+        self._clusterJobs[job.jobId] = job
+
+    def _submitArray(self, collectionURL, jobs):
+        try:
+            for job in jobs:
+                job.taskObj.beforeShellCmd()
+            taskObjs = [job.taskObj for job in jobs]
+            digest = hashlib.md5(" ".join(t.URL for t in taskObjs)).hexdigest()[:8]
+            script = "%s.array_%s.sh" % (taskObjs[0].script, digest)
+            writeArrayScript(script, [(t.script, getattr(t, "chunk_id", i)) for i, t in enumerate(taskObjs)])
+            jobId = self.backend.submitArray(script, len(jobs), jobName=self._jobName(collectionURL),
+                                             nSlots=taskObjs[0].nSlots)
+        except Exception:
+            for job in jobs:
+                job._abort()
+            return
+        logger.debug("Submitted %d tasks of %s as array job %s" % (len(jobs), collectionURL, jobId))
+        for i, job in enumerate(jobs):
+            job.jobId = elementId(jobId, i + 1)
+            self._clusterJobs[job.jobId] = job
+
+    def _pollLoop(self):
+        interval = self.minPollInterval
+        nextPoll = 0
+        while 1:
+            with self._cond:
+                while not self._stopping and not self._toSubmit and (
+                        not self._clusterJobs or time.time() < nextPoll):
+                    self._cond.wait(max(0, nextPoll - time.time()) if self._clusterJobs else None)
+                while not self._stopping and time.time() < self._lastQueued + self.submitDelay:
+                    self._cond.wait(self._lastQueued + self.submitDelay - time.time())
+                if self._stopping:
+                    return
+                toSubmit, self._toSubmit = self._toSubmit, []
+            hadJobs = bool(self._clusterJobs)
+            self._submitJobs(toSubmit)
+            if toSubmit:
+                # New jobs may be short, look at them soon.
+                interval = self.minPollInterval
+                nextPoll = min(nextPoll, time.time() + interval) if hadJobs else time.time() + interval
+            if not self._clusterJobs or time.time() < nextPoll:
+                continue
+
+            self.nPolls += 1
+            try:
+                activeJobIds = self.backend.activeJobIds()
+            except Exception:
+                logger.exception("Failed to query the state of the cluster jobs")
+                activeJobIds = None
+            finished = []
+            if activeJobIds is not None:
+                for jobId, job in self._clusterJobs.items():
+                    if jobId in activeJobIds:
+                        job.seen = True
+                        job.missing = 0
+                    else:
+                        job.missing += 1
+                        if job.seen or job.missing >= self.missingPolls:
+                            finished.append(job)
+            # One listing of each output directory for all the jobs that are over.
+            PypeTaskBase.syncDirectories([o.localFileName for job in finished
+                                          for o in job.taskObj.outputDataObjs.values()])
+            for job in finished:
+                del self._clusterJobs[job.jobId]
+                self._finishPool.apply_async(job._finish, (None, True))
+            if finished:
+                interval = self.minPollInterval
+            else:
+                interval = min(interval * self.backoff, self.maxPollInterval)
+            nextPoll = time.time() + interval
+
+    def notifyTerminate(self, jobs):
+        jobIds = [job.jobId for job in jobs if isinstance(job, _PypeClusterJob) and job.jobId is not None and job.is_alive()]
+        try:
+            self.backend.kill(jobIds)
+        except Exception:
+            logger.exception("Failed to kill the cluster jobs %s" % " ".join(jobIds))
+        _PypeShellLoopHandler.notifyTerminate(self, jobs)
+
 class _PypeProcsHandler(object):
     """Stateless method delegator, for injection.
     """
     def create(self, target):
         proc = multiprocessing.Process(target=target)
         return proc
+    def createBatch(self, targets):
+        return multiprocessing.Process(target=runTaskBatch, args=(targets,))
+    def prepare(self, targets, nWorkers):
+        pass
+    def shutdown(self):
+        pass
     def alive(self, procs):
         return sum(proc.is_alive() for proc in procs)
     def join(self, procs, timeout):
@@ -846,6 +2229,209 @@ class _PypeProcsHandler(object):
             if proc.is_alive():
                 proc.terminate()
 
+def _poolWorker(targets, jobQueue, eventQueue, maxTasksPerChild):
+    """Run the tasks whose URLs the controller hands to this worker through its own
+    jobQueue, until None comes or maxTasksPerChild tasks are done.
+    """
+    pid = os.getpid()
+    eventQueue.put(("ready", pid, None, time.time()))
+    nDone = 0
+    while maxTasksPerChild is None or nDone < maxTasksPerChild:
+        URL = jobQueue.get()
+        if URL is None:
+            break
+        eventQueue.put(("started", pid, URL, time.time()))
+        try:
+            targets[URL]()
+        except Exception:
+            pass # the task has reported its failure through the message queue already
+        nDone += 1
+        sys.stdout.flush()
+        eventQueue.put(("done", pid, URL, time.time()))
+    eventQueue.put(("exit", pid, None, time.time()))
+
+class _PypePoolJob(object):
+    """The handle of a task run by a _PypeProcPoolHandler, used like a Process.
+    """
+    def __init__(self, pool, URL):
+        self._pool = pool
+        self.URL = URL
+        self.submitted = None
+        self.finished = False
+    def start(self):
+        self._pool._submit(self)
+    def is_alive(self):
+        # As of the last poll of the pool, done once per scheduling tick by alive().
+        return self.submitted is not None and not self.finished
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while self.is_alive() and (deadline is None or time.time() < deadline):
+            self._pool._poll(0.05)
+
+class _PypeProcPoolHandler(object):
+    """Run the tasks in long-lived worker processes instead of forking one per task.
+    The workers are forked from the controller, so they find the task to run by its URL
+    in their copy of the workflow; each task still reports through the message queue.
+    Each worker has a job queue of its own, so the controller knows which task a worker
+    holds before the worker says anything, and fails that task if the worker dies.
+    """
+    def __init__(self, maxTasksPerChild=None):
+        self.maxTasksPerChild = maxTasksPerChild
+        self._targets = None
+        self._nWorkers = 0
+        self._workers = {} # pid -> Process
+        self._jobs = {} # URL -> the running _PypePoolJob
+        self._workerJobs = {} # pid -> URL of the job handed to it
+        self._workerQueues = {} # pid -> its job queue
+        self._workerTasks = {} # pid -> number of jobs handed to it
+        self._pending = [] # URLs waiting for an idle worker, oldest first
+        self._eventQueue = None
+        self._resetStats()
+
+    def _resetStats(self):
+        self.nTasks = 0
+        self.nForks = 0
+        self.forkSeconds = 0.0 # from Process.start() to the worker being ready
+        self.dispatchSeconds = 0.0 # from a job being submitted to a worker starting it
+
+    def prepare(self, targets, nWorkers):
+        self._targets = targets
+        self._nWorkers = max(1, nWorkers)
+        self._pending = []
+        self._eventQueue = multiprocessing.Queue()
+        self._forkTimes = {}
+        self._resetStats()
+
+    def create(self, target):
+        return _PypePoolJob(self, target.URL)
+
+    def _submit(self, job):
+        job.submitted = time.time()
+        self._jobs[job.URL] = job
+        self._pending.append(job.URL)
+        self._spawnWorkers()
+        self._dispatch()
+
+    def _spawnWorkers(self):
+        nBusy = len(self._jobs)
+        while len(self._workers) < min(self._nWorkers, nBusy):
+            jobQueue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=_poolWorker,
+                    args=(self._targets, jobQueue, self._eventQueue, self.maxTasksPerChild))
+            proc.daemon = True
+            startTime = time.time()
+            proc.start()
+            self._forkTimes[proc.pid] = startTime
+            self._workers[proc.pid] = proc
+            self._workerQueues[proc.pid] = jobQueue
+            self._workerTasks[proc.pid] = 0
+            self.nForks += 1
+
+    def _dispatch(self):
+        """Hand the pending jobs to the idle workers, recording who got which.
+        """
+        for pid in self._workers:
+            if not self._pending:
+                break
+            if pid in self._workerJobs:
+                continue
+            if self.maxTasksPerChild is not None and self._workerTasks[pid] >= self.maxTasksPerChild:
+                continue # retiring, its "exit" is on the way
+            URL = self._pending.pop(0)
+            self._workerJobs[pid] = URL
+            self._workerTasks[pid] += 1
+            self._workerQueues[pid].put(URL)
+
+    def _removeWorker(self, pid):
+        proc = self._workers.pop(pid)
+        jobQueue = self._workerQueues.pop(pid)
+        jobQueue.cancel_join_thread() # a dead worker never reads what is left in it
+        jobQueue.close()
+        self._workerTasks.pop(pid, None)
+        return proc
+
+    def _poll(self, timeout=None):
+        """Handle the events from the workers; wait up to timeout seconds for the first one.
+        """
+        while 1:
+            try:
+                if timeout:
+                    event, pid, URL, eventTime = self._eventQueue.get(True, timeout)
+                    timeout = None
+                else:
+                    event, pid, URL, eventTime = self._eventQueue.get_nowait()
+            except Queue.Empty:
+                break
+            if event == "ready":
+                self.forkSeconds += eventTime - self._forkTimes.pop(pid, eventTime)
+            elif event == "started":
+                job = self._jobs.get(URL)
+                if job is not None:
+                    self.dispatchSeconds += eventTime - job.submitted
+            elif event == "done":
+                self._workerJobs.pop(pid, None)
+                job = self._jobs.pop(URL, None)
+                if job is not None:
+                    job.finished = True
+                self.nTasks += 1
+            elif event == "exit":
+                if pid in self._workers:
+                    self._removeWorker(pid).join()
+                self._spawnWorkers() # replace the recycled worker if there is work left
+        for pid, proc in self._workers.items():
+            if not proc.is_alive() and self._eventQueue.empty():
+                # Killed without a word, e.g. by the OOM killer, maybe before it could
+                # even say it started the job it was handed.
+                self._removeWorker(pid)
+                URL = self._workerJobs.pop(pid, None)
+                job = self._jobs.pop(URL, None)
+                if job is not None:
+                    logger.error("Worker %d died while running %s (exitcode=%r)" % (pid, URL, proc.exitcode))
+                    job.finished = True
+                    # The task could not report its failure itself.
+                    self._targets[URL]._queue.put( (URL, TaskFail) )
+                self._spawnWorkers()
+        self._dispatch()
+
+    def alive(self, jobs):
+        self._poll() # once for all the jobs
+        return sum(job.is_alive() for job in jobs)
+
+    def join(self, jobs, timeout):
+        then = time.time()
+        for job in jobs:
+            job.join(max(0, timeout - (time.time() - then)))
+
+    def notifyTerminate(self, jobs):
+        """This can orphan sub-processes.
+        """
+        for proc in self._workers.values():
+            if proc.is_alive():
+                proc.terminate()
+
+    def shutdown(self):
+        for jobQueue in self._workerQueues.values():
+            jobQueue.put(None)
+        for pid, proc in self._workers.items():
+            proc.join(10)
+            if proc.is_alive():
+                proc.terminate()
+            self._removeWorker(pid)
+        self._jobs.clear()
+        self._workerJobs.clear()
+        self._pending = []
+        if self.nTasks:
+            logger.info(self.overheadReport())
+
+    def overheadReport(self):
+        """Compare the cost of handing a task to a pooled worker with the cost of forking a process for it.
+        """
+        forkCost = self.forkSeconds / self.nForks if self.nForks else 0.0
+        dispatchCost = self.dispatchSeconds / self.nTasks if self.nTasks else 0.0
+        return ("worker pool: %d tasks on %d forked workers; %.1f ms to fork a worker, %.1f ms to dispatch a task, "
+                "%.1f ms saved per task" % (self.nTasks, self.nForks, 1000 * forkCost, 1000 * dispatchCost,
+                1000 * (forkCost - dispatchCost)))
+
 
 def defaultOutputTemplate(fn):
     return fn + ".out"
@@ -861,8 +2447,7 @@ def applyFOFN( task_fun = None,
                              parameters = dict(nSlots = 1))( task_fun )
 
     wf = PypeThreadWorkflow()
-    wf.CONCURRENT_THREAD_ALLOWED = nproc 
-    wf.MAX_NUMBER_TASK_SLOT = nproc
+    wf.setNumThreadAllowed(nproc, nproc)
     wf.addTasks(tasks)
     wf.refreshTargets(exitOnFailure=False)
 
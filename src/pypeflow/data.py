@@ -32,6 +32,8 @@ PypeData: This module defines the general interface and class for PypeData Objec
 from urlparse import urlparse, urljoin
 import platform
 import os, shutil
+import thread
+from multiprocessing.pool import ThreadPool
 from common import pypeNS, PypeObject, PypeError, NotImplementedError
 import logging
     
@@ -46,6 +48,135 @@ class TypeMismatchError(PypeError):
 def fn(obj):
     return obj.localFileName
 
+class PypeStatCache(object):
+
+    """
+    Remember the os.stat() result of the paths looked at while a workflow is refreshed,
+    so that timeStamp, exists and the compare functions cost at most one os.stat() per
+    path per refresh pass. The cache is only used by the thread (and process) that
+    activated it; everywhere else, and when it is not active, every call is a fresh
+    os.stat(). The paths written by a task have to be invalidated when it completes.
+
+    >>> os.system("mkdir -p /tmp/pypetest; touch /tmp/pypetest/stat_cache")
+    0
+    >>> cache = PypeStatCache()
+    >>> cache.activate()
+    >>> cache.stat("/tmp/pypetest/stat_cache") is not None
+    True
+    >>> os.remove("/tmp/pypetest/stat_cache")
+    >>> cache.stat("/tmp/pypetest/stat_cache") is not None
+    True
+    >>> cache.invalidate(["/tmp/pypetest/stat_cache"])
+    >>> cache.stat("/tmp/pypetest/stat_cache") is None
+    True
+    >>> cache.hits, cache.misses
+    (1, 2)
+    >>> cache.deactivate()
+    """
+
+    def __init__(self):
+        self._stats = {} # path -> os.stat() result, or None if there is no such file
+        self._owner = None
+        self._depth = 0
+        self.hits = 0
+        self.misses = 0
+
+    def activate(self):
+        """
+        Start caching for the calling thread. Nested calls are counted, only the outermost
+        one clears the cache and the counters.
+        """
+        if self._depth == 0:
+            self._stats.clear()
+            self._owner = (os.getpid(), thread.get_ident())
+            self.hits = 0
+            self.misses = 0
+        self._depth += 1
+
+    def deactivate(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._stats.clear()
+
+    @property
+    def hitRate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stat(self, path):
+        """
+        Return os.stat(path), or None if path does not exist.
+        """
+        if self._owner is None or self._owner != (os.getpid(), thread.get_ident()):
+            try:
+                return os.stat(path)
+            except OSError:
+                return None
+        try:
+            st = self._stats[path]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            self._stats[path] = st
+        return st
+
+    def prefetch(self, paths, nThreads=16, chunkSize=256):
+        """
+        Stat the paths that are not cached yet with a pool of up to nThreads threads and
+        cache the results, so that the stat round-trips to a shared filesystem overlap.
+        The paths are handed out by directory, in chunks of at most chunkSize paths.
+        Only the thread that activated the cache can prefetch into it.
+        """
+        if self._owner is None or self._owner != (os.getpid(), thread.get_ident()):
+            return
+        pathsByDir = {}
+        for path in set(paths):
+            if path not in self._stats:
+                pathsByDir.setdefault(os.path.dirname(path), []).append(path)
+        chunks = []
+        for dirPaths in pathsByDir.values():
+            for i in xrange(0, len(dirPaths), chunkSize):
+                chunks.append(dirPaths[i:i+chunkSize])
+        if not chunks:
+            return
+        if nThreads > 1 and len(chunks) > 1:
+            pool = ThreadPool(min(nThreads, len(chunks)))
+            try:
+                results = pool.map(_statPaths, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_statPaths, chunks)
+        for result in results:
+            self._stats.update(result)
+            self.misses += len(result)
+        logger.debug("prefetched %d stats from %d directories" % (
+            sum(len(c) for c in chunks), len(pathsByDir)))
+
+    def invalidate(self, paths):
+        for path in paths:
+            self._stats.pop(path, None)
+
+    def invalidateDataObjs(self, dataObjs):
+        self.invalidate([o.localFileName for o in dataObjs if getattr(o, "localFileName", None) is not None])
+
+def _statPaths(paths):
+    rtn = []
+    for path in paths:
+        try:
+            rtn.append((path, os.stat(path)))
+        except OSError:
+            rtn.append((path, None))
+    return rtn
+
+statCache = PypeStatCache()
+
 class PypeDataObjectBase(PypeObject):
     
     """ 
@@ -109,13 +240,14 @@ class PypeLocalFile(PypeDataObjectBase):
 
     @property
     def timeStamp(self):
-        if not os.path.exists(self.localFileName):
+        st = statCache.stat(self.localFileName)
+        if st is None:
             raise FileNotExistError("No such file:%s on %s" % (self.localFileName, platform.node()) )
-        return os.stat(self.localFileName).st_mtime 
+        return st.st_mtime 
 
     @property
     def exists(self):
-        return os.path.exists(self.localFileName)
+        return statCache.stat(self.localFileName) is not None
     
     def verify(self):
         logger.debug("Verifying contents of %s" % self.URL)
@@ -199,15 +331,16 @@ class PypeLocalFileCollection(PypeDataObjectBase):  #stub for now Mar 17, 2010
     def timeStamp(self):
         if self.localFileName == None:
             raise PypeError, "No PypeLocalFile is added into the PypeLocalFileColletion yet"
-        if not os.path.exists(self.localFileName):
+        st = statCache.stat(self.localFileName)
+        if st is None:
             raise FileNotExistError("No such file:%s on %s" % (self.localFileName, platform.node()) )
-        return os.stat(self.localFileName).st_mtime 
+        return st.st_mtime 
 
     @property
     def exists(self):
         if self.localFileName == None:
             raise PypeError, "No PypeLocalFile is added into the PypeLocalFileColletion yet"
-        return os.path.exists(self.localFileName)
+        return statCache.stat(self.localFileName) is not None
         
 
 class PypeSplittableLocalFile(PypeDataObjectBase):
@@ -0,0 +1,208 @@
+# @author Jason Chin
+#
+# Copyright (C) 2010 by Jason Chin 
+# Copyright (C) 2011 by Jason Chin, Pacific Biosciences
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+
+"""
+
+PypeFingerprint: This module provides the content digests of the files used by the
+content based comparison of the tasks, and a persistent record of the digests of the
+inputs each output was produced from.
+
+"""
+
+import os
+import stat
+import hashlib
+import sqlite3
+import logging
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1 << 20
+
+def fileDigest(path, blockSize=BLOCK_SIZE):
+    """
+    Return the md5 hex digest of the content of a file, read block by block.
+    """
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        while 1:
+            block = f.read(blockSize)
+            if not block:
+                break
+            h.update(block) # releases the GIL, so several files can be hashed at once
+    return h.hexdigest()
+
+def statKey(st):
+    """
+    Return the (device, inode, size, mtime in ns) key of a stat result. A file whose key
+    has not changed is assumed to have the same content.
+    """
+    return (st.st_dev, st.st_ino, st.st_size, int(round(st.st_mtime * 1e9)))
+
+class PypeDigestCache(object):
+
+    """
+    Keep the content digests of files in a SQLite database, keyed by statKey(), so that
+    an unchanged file is only hashed once, and the digests of the inputs each output
+    was produced from. The database can be shared by threads and processes.
+
+    >>> import os
+    >>> os.system("mkdir -p /tmp/pypetest; rm -f /tmp/pypetest/digests.sqlite")
+    0
+    >>> open("/tmp/pypetest/digest_in", "w").write("hello\\n")
+    >>> cache = PypeDigestCache("/tmp/pypetest/digests.sqlite")
+    >>> cache.digests(["/tmp/pypetest/digest_in", "/tmp/pypetest"])
+    {'/tmp/pypetest/digest_in': 'b1946ac92492d2347c6235b4d2611184', '/tmp/pypetest': None}
+    >>> cache.digests(["/tmp/pypetest/digest_in"]).values()
+    ['b1946ac92492d2347c6235b4d2611184']
+    >>> cache.hits, cache.misses
+    (1, 1)
+    >>> cache.record(["/tmp/pypetest/digest_out"], {"/tmp/pypetest/digest_in": "b1946ac92492d2347c6235b4d2611184"})
+    >>> cache.recorded("/tmp/pypetest/digest_out")
+    {'/tmp/pypetest/digest_in': 'b1946ac92492d2347c6235b4d2611184'}
+    >>> cache.recorded("/tmp/pypetest/digest_in") is None
+    True
+    """
+
+    def __init__(self, dbFileName, nThreads=4):
+        self.dbFileName = os.path.abspath(dbFileName)
+        self.nThreads = nThreads
+        self.hits = 0 # files whose digest was found in the database
+        self.misses = 0 # files that had to be hashed
+        dirName = os.path.dirname(self.dbFileName)
+        if not os.path.isdir(dirName):
+            os.makedirs(dirName)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS digests ("
+                             "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT, "
+                             "PRIMARY KEY (dev, ino, size, mtime_ns))")
+                conn.execute("CREATE TABLE IF NOT EXISTS provenance ("
+                             "output TEXT, input TEXT, digest TEXT, PRIMARY KEY (output, input))")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # One connection per call, connections cannot be shared between threads or processes.
+        conn = sqlite3.connect(self.dbFileName, timeout=60)
+        conn.text_factory = str
+        return conn
+
+    def digests(self, paths):
+        """
+        Return a dict of path -> content digest. Paths that are not regular files get None.
+        The files not in the database are hashed with up to nThreads threads.
+        """
+        rtn = {}
+        keys = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode):
+                rtn[path] = None
+            else:
+                keys[path] = statKey(st)
+        if not keys:
+            return rtn
+
+        toHash = []
+        conn = self._connect()
+        try:
+            for path, key in keys.iteritems():
+                row = conn.execute("SELECT digest FROM digests WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+                                   key).fetchone()
+                if row is None:
+                    toHash.append(path)
+                else:
+                    rtn[path] = row[0]
+        finally:
+            conn.close()
+        self.hits += len(keys) - len(toHash)
+        self.misses += len(toHash)
+        if not toHash:
+            return rtn
+
+        if self.nThreads > 1 and len(toHash) > 1:
+            pool = ThreadPool(min(self.nThreads, len(toHash)))
+            try:
+                hashed = pool.map(fileDigest, toHash)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            hashed = map(fileDigest, toHash)
+
+        conn = self._connect()
+        try:
+            with conn:
+                for path, digest in zip(toHash, hashed):
+                    rtn[path] = digest
+                    key = keys[path]
+                    if statKey(os.stat(path)) != key:
+                        logger.debug("%s changed while being hashed, its digest is not kept" % path)
+                        continue
+                    # Only the latest version of a file is worth keeping.
+                    conn.execute("DELETE FROM digests WHERE dev=? AND ino=?", key[:2])
+                    conn.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)", key + (digest,))
+        finally:
+            conn.close()
+        return rtn
+
+    def record(self, outputPaths, inputDigests):
+        """
+        Record that the outputs were produced from the inputs with the given digests.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                for output in outputPaths:
+                    conn.execute("DELETE FROM provenance WHERE output=?", (output,))
+                    conn.executemany("INSERT INTO provenance VALUES (?, ?, ?)",
+                                     [(output, i, d) for i, d in inputDigests.iteritems()])
+                    if not inputDigests:
+                        conn.execute("INSERT INTO provenance VALUES (?, NULL, NULL)", (output,))
+        finally:
+            conn.close()
+
+    def recorded(self, outputPath):
+        """
+        Return the dict of input path -> digest recorded for an output, or None if there is no record.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT input, digest FROM provenance WHERE output=?", (outputPath,)).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return None
+        return dict( (i, d) for i, d in rows if i is not None )
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
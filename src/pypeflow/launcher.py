@@ -0,0 +1,112 @@
+# @author Jason Chin
+#
+# Copyright (C) 2010 by Jason Chin 
+# Copyright (C) 2011 by Jason Chin, Pacific Biosciences
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+
+"""
+
+PypeLauncher: This module is the launcher process of the cluster.PypeFakeScheduler, which
+starts the job scripts and reports the ones that are over. It is run as a script and only
+imports the standard library, to start quickly and small.
+
+"""
+
+import os
+import sys
+import errno
+import fcntl
+import select
+import signal
+
+def _setNonBlockingCloseOnExec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+def launcherMain(shell):
+    """
+    Read "start <job id> <script>" and "kill <job id>" lines from stdin, and write the ids
+    of the jobs that are over to stdout. The elements of array jobs get their index in
+    PYPEFLOW_ARRAY_INDEX. It sleeps in select() until a line comes in or a job exits, which
+    writes to a pipe through signal.set_wakeup_fd().
+    """
+    running = {} # pid -> job id
+    pids = {} # job id -> pid
+    stdin, stdout = sys.stdin.fileno(), sys.stdout.fileno()
+    wakeRead, wakeWrite = os.pipe()
+    for fd in (wakeRead, wakeWrite):
+        _setNonBlockingCloseOnExec(fd)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wakeWrite)
+    buf = ""
+    eof = False
+    while not eof or running:
+        try:
+            readable, w, x = select.select([wakeRead] if eof else [stdin, wakeRead], [], [])
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = [wakeRead]
+        if wakeRead in readable:
+            try:
+                os.read(wakeRead, 4096)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        if stdin in readable:
+            data = os.read(stdin, 65536)
+            eof = not data
+            lines = (buf + data).split("\n")
+            buf = lines.pop()
+            for line in lines:
+                cmd, arg = line.split(" ", 1)
+                if cmd == "start":
+                    jobId, script = arg.split(" ", 1)
+                    env = os.environ.copy()
+                    if "." in jobId:
+                        env["PYPEFLOW_ARRAY_INDEX"] = jobId.split(".")[1]
+                    pid = os.spawnve(os.P_NOWAIT, shell, [shell, script], env)
+                    running[pid] = jobId
+                    pids[jobId] = pid
+                elif cmd == "kill" and arg in pids:
+                    try:
+                        os.kill(pids[arg], signal.SIGTERM)
+                    except OSError:
+                        pass
+        over = []
+        while running:
+            try:
+                pid, sts = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                break
+            jobId = running.pop(pid)
+            del pids[jobId]
+            over.append(jobId + "\n")
+        if over:
+            os.write(stdout, "".join(over))
+
+if __name__ == "__main__":
+    launcherMain(sys.argv[1])
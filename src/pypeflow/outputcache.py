@@ -0,0 +1,310 @@
+# @author Jason Chin
+#
+# Copyright (C) 2010 by Jason Chin
+# Copyright (C) 2011 by Jason Chin, Pacific Biosciences
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+
+PypeOutputCache: This module provides a content addressed cache of the outputs of the
+tasks, to restore them instead of running a task again on the same inputs.
+
+"""
+
+import os
+import stat
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+
+from fingerprint import PypeDigestCache
+
+logger = logging.getLogger(__name__)
+
+def cloneFile(src, dst):
+    """
+    Copy src to dst, sharing their blocks (a reflink) where the file system can. Hard
+    links are not used, a task that runs again would write the cached file through them.
+    """
+    try:
+        if subprocess.call(["cp", "--reflink=auto", "--preserve=timestamps", src, dst]) == 0:
+            return
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+
+def cloneFiles(pairs):
+    """
+    Copy each (src, dst) pair like cloneFile(), with one cp for all the files that go to
+    the same directory. cp is given symbolic links named after the destinations.
+
+    >>> import os
+    >>> os.system("rm -rf /tmp/pypetest/clone; mkdir -p /tmp/pypetest/clone")
+    0
+    >>> open("/tmp/pypetest/clone/a", "w").write("a")
+    >>> open("/tmp/pypetest/clone/b", "w").write("b")
+    >>> cloneFiles([("/tmp/pypetest/clone/a", "/tmp/pypetest/clone/b.copy"),
+    ...             ("/tmp/pypetest/clone/b", "/tmp/pypetest/clone/a.copy")])
+    >>> open("/tmp/pypetest/clone/b.copy").read(), open("/tmp/pypetest/clone/a.copy").read()
+    ('a', 'b')
+    """
+    byDir = {}
+    for src, dst in pairs:
+        byDir.setdefault(os.path.dirname(dst) or ".", []).append( (src, os.path.basename(dst)) )
+    for dstDir, files in byDir.items():
+        if len(files) == 1:
+            cloneFile(files[0][0], os.path.join(dstDir, files[0][1]))
+            continue
+        linkDir = tempfile.mkdtemp(prefix="pypeflow-clone.")
+        try:
+            for src, name in files:
+                os.symlink(os.path.abspath(src), os.path.join(linkDir, name))
+            copied = subprocess.call(["cp", "-L", "--reflink=auto", "--preserve=timestamps"] +
+                                     [os.path.join(linkDir, name) for src, name in files] + [dstDir]) == 0
+        except OSError:
+            copied = False
+        finally:
+            shutil.rmtree(linkDir, ignore_errors=True)
+        if not copied:
+            for src, name in files:
+                shutil.copy2(src, os.path.join(dstDir, name))
+
+class PypeOutputCache(object):
+
+    """
+    Keep the output files of the tasks in cacheDir, under a key made of the code digest of
+    the task, its parameters, the names and content digests of its input files, the content
+    digest of its script for a shell script task, and the names of its outputs, so a task run again on the same inputs, even in another workflow with
+    other file names, can get its outputs back with restore(). The files are copied in and
+    out with cloneFiles(). Tasks with mutable data objects, or whose inputs or outputs are
+    not regular local files, are not cached. The methods can be called from several
+    threads at once.
+
+    When the cache holds more than maxBytes (no limit if None), the entries used the
+    longest time ago are evicted.
+
+    >>> import os
+    >>> from pypeflow.task import PypeTask, PypeTaskBase
+    >>> from pypeflow.data import makePypeLocalFile
+    >>> os.system("rm -rf /tmp/pypetest/outputcache; mkdir -p /tmp/pypetest")
+    0
+    >>> fin = makePypeLocalFile("/tmp/pypetest/outputcache_in")
+    >>> fout = makePypeLocalFile("/tmp/pypetest/outputcache_out")
+    >>> open(fin.localFileName, "w").write("in")
+    >>> @PypeTask(inputDataObjs={"i": fin}, outputDataObjs={"o": fout}, URL="task://localhost/cached", TaskType=PypeTaskBase)
+    ... def t(self):
+    ...     open(self.o.localFileName, "w").write("out")
+    >>> cache = PypeOutputCache("/tmp/pypetest/outputcache")
+    >>> key = cache.key(t)
+    >>> cache.restore(key, t)
+    False
+    >>> t()
+    True
+    >>> cache.store(key, t)
+    >>> os.remove(fout.localFileName)
+    >>> cache.restore(key, t), open(fout.localFileName).read()
+    (True, 'out')
+    >>> cache.hits, cache.misses
+    (1, 1)
+    """
+
+    def __init__(self, cacheDir, maxBytes=None):
+        self.cacheDir = os.path.abspath(cacheDir)
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock() # for the counters
+        self._objectsDir = os.path.join(self.cacheDir, "objects")
+        if not os.path.isdir(self._objectsDir):
+            os.makedirs(self._objectsDir)
+        self.digestCache = PypeDigestCache(os.path.join(self.cacheDir, "digests.sqlite"))
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                             "key TEXT PRIMARY KEY, size INTEGER, lastUsed REAL)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(os.path.join(self.cacheDir, "index.sqlite"), timeout=60)
+        conn.text_factory = str
+        return conn
+
+    @property
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    @staticmethod
+    def _localFiles(dataObjs):
+        paths = {}
+        for name, o in dataObjs.items():
+            path = getattr(o, "localFileName", None)
+            if path is None:
+                return None
+            paths[name] = path
+        return paths
+
+    def cacheable(self, taskObj):
+        """
+        Return whether the outputs of a task can be cached, without looking at its files.
+        """
+        return (not taskObj.mutableDataObjs and self._localFiles(taskObj.inputDataObjs) is not None and
+                bool(self._localFiles(taskObj.outputDataObjs)))
+
+    def key(self, taskObj):
+        """
+        Return the cache key of a task, from the current content of its inputs, or None if
+        the task cannot be cached.
+        """
+        if not self.cacheable(taskObj):
+            return None
+        inputs = self._localFiles(taskObj.inputDataObjs)
+        outputs = self._localFiles(taskObj.outputDataObjs)
+        # The code digest of a shell script task is the one of the wrapper running its script.
+        script = getattr(taskObj, "script", None)
+        digests = self.digestCache.digests(inputs.values() + ([script] if script is not None else []))
+        if None in digests.values():
+            return None
+        keyData = [taskObj._codeMD5digest,
+                   taskObj._paramMD5digest,
+                   sorted((name, digests[path]) for name, path in inputs.items()),
+                   sorted(outputs)]
+        if script is not None:
+            keyData.append(digests[script])
+        return hashlib.md5(json.dumps(keyData)).hexdigest()
+
+    def _entryDir(self, key):
+        return os.path.join(self._objectsDir, key[:2], key)
+
+    def restore(self, key, taskObj):
+        """
+        Put the cached outputs of the key in place of the outputs of the task, and return
+        True, or return False if the key is not in the cache.
+        """
+        if key is None:
+            return False
+        entryDir = self._entryDir(key)
+        outputs = self._localFiles(taskObj.outputDataObjs)
+        if not all(os.path.isfile(os.path.join(entryDir, name)) for name in outputs):
+            with self._lock:
+                self.misses += 1
+            return False
+        tmpPaths = {}
+        for name, path in outputs.items():
+            dirName = os.path.dirname(path)
+            if dirName and not os.path.isdir(dirName):
+                os.makedirs(dirName)
+            tmpPaths[name] = "%s.%s.cached" % (path, self._tmpSuffix())
+        cloneFiles([(os.path.join(entryDir, name), tmpPaths[name]) for name in outputs])
+        for name, path in outputs.items():
+            os.rename(tmpPaths[name], path)
+            os.utime(path, None) # newer than the inputs, like a file the task just wrote
+        self._touch(key)
+        with self._lock:
+            self.hits += 1
+        logger.debug("Restored the outputs of %s from %s" % (taskObj.URL, entryDir))
+        return True
+
+    @staticmethod
+    def _tmpSuffix():
+        return "%d.%d" % (os.getpid(), threading.current_thread().ident)
+
+    def _touch(self, key, size=None):
+        conn = self._connect()
+        try:
+            with conn:
+                if size is None:
+                    conn.execute("UPDATE entries SET lastUsed=? WHERE key=?", (time.time(), key))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, size, time.time()))
+        finally:
+            conn.close()
+
+    def store(self, key, taskObj):
+        """
+        Keep the outputs of a task that completed under the key it had when it started.
+        """
+        if key is None:
+            return
+        outputs = self._localFiles(taskObj.outputDataObjs)
+        entryDir = self._entryDir(key)
+        if os.path.isdir(entryDir):
+            self._touch(key)
+            return
+        for path in outputs.values():
+            try:
+                if not stat.S_ISREG(os.stat(path).st_mode):
+                    return
+            except OSError:
+                return
+        parentDir = os.path.dirname(entryDir)
+        if not os.path.isdir(parentDir):
+            os.makedirs(parentDir)
+        tmpDir = "%s.%s.tmp" % (entryDir, self._tmpSuffix())
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        os.mkdir(tmpDir)
+        cloneFiles([(path, os.path.join(tmpDir, name)) for name, path in outputs.items()])
+        size = sum(os.path.getsize(path) for path in outputs.values())
+        try:
+            os.rename(tmpDir, entryDir)
+        except OSError:
+            shutil.rmtree(tmpDir, ignore_errors=True) # stored by another process meanwhile
+        self._touch(key, size)
+        with self._lock:
+            self.stores += 1
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache holds at most maxBytes.
+        """
+        if self.maxBytes is None:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                if total <= self.maxBytes:
+                    return
+                for key, size in conn.execute("SELECT key, size FROM entries ORDER BY lastUsed").fetchall():
+                    if total <= self.maxBytes:
+                        break
+                    shutil.rmtree(self._entryDir(key), ignore_errors=True)
+                    conn.execute("DELETE FROM entries WHERE key=?", (key,))
+                    total -= size
+                    with self._lock:
+                        self.evictions += 1
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
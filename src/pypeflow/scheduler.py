@@ -0,0 +1,383 @@
+# @author Jason Chin
+#
+# Copyright (C) 2010 by Jason Chin 
+# Copyright (C) 2011 by Jason Chin, Pacific Biosciences
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+
+PypeScheduler: This module provides the bookkeeping used by the concurrent workflow to
+decide which tasks can be started.
+
+"""
+
+from collections import deque
+import heapq
+import logging
+import multiprocessing
+import os
+import time
+
+from task import TaskInitialized, TaskDone
+
+logger = logging.getLogger(__name__)
+
+class PypeReadyQueue(object):
+
+    """
+    Keep the number of unfinished prerequisite tasks of each task and a queue of
+    the tasks whose prerequisites are all done. Finishing a task only touches its
+    own successors, so the cost of a scheduling tick is proportional to the number
+    of tasks that changed state.
+
+    >>> prereqs = {"task://a": [], "task://b": ["task://a"], "task://c": ["task://a", "task://b"]}
+    >>> status = dict((URL, TaskInitialized) for URL in prereqs)
+    >>> q = PypeReadyQueue(["task://a", "task://b", "task://c"], prereqs, status)
+    >>> q.pop()
+    'task://a'
+    >>> len(q)
+    0
+    >>> q.taskDone("task://a")
+    ['task://b']
+    >>> q.remaining("task://c")
+    1
+    """
+
+    def __init__(self, sortedTaskURLs, prereqJobURLMap, jobStatusMap):
+        """
+        sortedTaskURLs gives the order in which initially ready tasks are queued,
+        prereqJobURLMap maps a task URL to the URLs of the tasks it depends on and
+        jobStatusMap gives the current status of every task.
+        """
+        self._jobStatusMap = jobStatusMap
+        self._successors = {}
+        self._remaining = {}
+        self._queue = deque()
+
+        for URL in sortedTaskURLs:
+            remaining = 0
+            for prereqURL in prereqJobURLMap[URL]:
+                self._successors.setdefault(prereqURL, []).append(URL)
+                if jobStatusMap[prereqURL] != TaskDone:
+                    remaining += 1
+            self._remaining[URL] = remaining
+            if remaining == 0 and jobStatusMap[URL] == TaskInitialized:
+                self._queue.append(URL)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def pop(self):
+        return self._queue.popleft()
+
+    def push(self, URL):
+        """
+        Queue a task again, e.g. one that was put aside because of a mutable data object collision.
+        """
+        self._queue.append(URL)
+
+    def remaining(self, URL):
+        return self._remaining[URL]
+
+    def taskDone(self, URL):
+        """
+        Account for a finished task and return the successors that became ready.
+        """
+        newlyReady = []
+        for successorURL in self._successors.get(URL, ()):
+            self._remaining[successorURL] -= 1
+            if self._remaining[successorURL] == 0 and self._jobStatusMap[successorURL] == TaskInitialized:
+                self._queue.append(successorURL)
+                newlyReady.append(successorURL)
+        return newlyReady
+
+class PypeSubmitQueue(object):
+
+    """
+    Hold the (URL, taskObj) pairs of the tasks that are ready and wait for free task
+    slots. The task with the highest priority comes first; tasks with the same
+    priority come in the order they were added, so without priorities this is a
+    plain FIFO.
+
+    >>> q = PypeSubmitQueue({"task://a": 1, "task://b": 5})
+    >>> q.append( ("task://a", None) )
+    >>> q.append( ("task://b", None) )
+    >>> q.append( ("task://c", None) )
+    >>> [q.pop()[0] for i in range(len(q))]
+    ['task://b', 'task://a', 'task://c']
+
+    A task taken out with popEntry() and not started keeps its place with pushBack():
+
+    >>> q.append( ("task://c", None) )
+    >>> q.append( ("task://d", None) )
+    >>> entry = q.popEntry()
+    >>> q.pushBack(entry)
+    >>> [q.pop()[0] for i in range(len(q))]
+    ['task://c', 'task://d']
+    """
+
+    def __init__(self, priorities = None):
+        self._priorities = priorities if priorities is not None else {}
+        self._heap = []
+        self._count = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def append(self, item):
+        URL = item[0]
+        heapq.heappush(self._heap, (-self._priorities.get(URL, 0), self._count, item))
+        self._count += 1
+
+    def peek(self):
+        return self._heap[0][2]
+
+    def pop(self):
+        return heapq.heappop(self._heap)[2]
+
+    def popEntry(self):
+        """
+        Remove the first task and return its (priority, sequence number, item) entry, which
+        pushBack() puts back in the same place, ahead of the tasks added after it.
+        """
+        return heapq.heappop(self._heap)
+
+    def pushBack(self, entry):
+        heapq.heappush(self._heap, entry)
+
+class PypeResourcePool(object):
+
+    """
+    Account the resources held by the running tasks (e.g. "slots", "mem_gb", "cores" or a
+    user defined "io" token pool), given as dicts of resource name -> amount, against the
+    capacity of each resource. A resource without a capacity is not limited, but its use
+    is still reported by utilisation().
+
+    >>> pool = PypeResourcePool({"slots": 4, "mem_gb": 64})
+    >>> pool.acquire({"slots": 1, "mem_gb": 48})
+    >>> pool.shortOf({"slots": 1, "mem_gb": 32})
+    ['mem_gb']
+    >>> pool.fits({"slots": 2, "io": 1})
+    True
+    >>> pool.exceeds({"slots": 8})
+    ['slots']
+    >>> pool.release({"slots": 1, "mem_gb": 48})
+    >>> pool.used("mem_gb")
+    0
+    """
+
+    def __init__(self, capacities=None, clock=time.time):
+        self._capacities = dict(capacities or {})
+        self._used = {}
+        self._peak = {}
+        self._usedTime = {} # resource name -> integral of the use over time
+        self._clock = clock
+        self._start = self._last = clock()
+
+    def capacity(self, name):
+        """
+        Return the capacity of a resource, None if it is not limited.
+        """
+        return self._capacities.get(name)
+
+    def used(self, name):
+        return self._used.get(name, 0)
+
+    def exceeds(self, request):
+        """
+        Return the names of the resources of which the request asks more than the capacity,
+        i.e. a task with this request can never run.
+        """
+        return sorted(name for name, amount in request.items()
+                      if name in self._capacities and amount > self._capacities[name])
+
+    def shortOf(self, request):
+        """
+        Return the names of the resources of which not enough is free now for the request.
+        """
+        return sorted(name for name, amount in request.items()
+                      if name in self._capacities and self.used(name) + amount > self._capacities[name])
+
+    def fits(self, request):
+        return not self.shortOf(request)
+
+    def _account(self):
+        now = self._clock()
+        for name, amount in self._used.items():
+            self._usedTime[name] = self._usedTime.get(name, 0) + amount * (now - self._last)
+        self._last = now
+
+    def acquire(self, request):
+        self._account()
+        for name, amount in request.items():
+            self._used[name] = self.used(name) + amount
+            self._peak[name] = max(self._peak.get(name, 0), self._used[name])
+
+    def release(self, request):
+        self._account()
+        for name, amount in request.items():
+            self._used[name] = self.used(name) - amount
+
+    def utilisation(self):
+        """
+        Return a dict of resource name -> dict with the "capacity" (None if not limited),
+        the "peak" use and the "mean" use since the pool was created. For a limited
+        resource, "fraction" is the mean use over the capacity.
+        """
+        self._account()
+        elapsed = max(self._last - self._start, 1e-9)
+        report = {}
+        for name in set(self._capacities) | set(self._peak):
+            capacity = self._capacities.get(name)
+            mean = self._usedTime.get(name, 0) / elapsed
+            report[name] = {"capacity": capacity, "peak": self._peak.get(name, 0), "mean": mean,
+                            "fraction": float(mean) / capacity if capacity else None}
+        return report
+
+def cpuCount():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def loadPerCpu():
+    """
+    Return the one minute load average divided by the number of CPUs, None where it is not available.
+    """
+    try:
+        return os.getloadavg()[0] / cpuCount()
+    except (AttributeError, OSError):
+        return None
+
+def freeMemoryFraction(meminfo="/proc/meminfo"):
+    """
+    Return the fraction of the memory available to new processes, None where it is not available.
+    """
+    try:
+        fields = {}
+        with open(meminfo) as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                fields[name] = int(value.split()[0])
+    except (IOError, ValueError):
+        return None
+    if "MemAvailable" in fields:
+        available = fields["MemAvailable"]
+    else:
+        available = fields.get("MemFree", 0) + fields.get("Buffers", 0) + fields.get("Cached", 0)
+    return float(available) / fields["MemTotal"] if fields.get("MemTotal") else None
+
+class PypeConcurrencyController(object):
+
+    """
+    Choose how many tasks a workflow runs at once, between minTasks and maxTasks. Every
+    interval seconds, update() looks at the host and at the tasks finished since the
+    last look:
+
+    - if the load per CPU is over maxLoad or less than minFreeMemory of the memory is
+      available, the limit goes down by a quarter;
+    - otherwise, if more tasks could run than the limit allows, the limit is moved by a step
+      (a quarter of it, at least 1) in the same direction as the last move, unless the
+      throughput dropped by more than tolerance since then, which turns the direction.
+
+    So the limit climbs while more tasks finish more work, and settles around the peak.
+    The probes are functions returning the load per CPU and the free memory fraction,
+    or None when they are not known.
+
+    >>> now = [0]
+    >>> c = PypeConcurrencyController(2, 8, initial=4, clock=lambda: now[0],
+    ...                               loadProbe=lambda: 0.5, memoryProbe=lambda: 0.5)
+    >>> now[0] = 10; c.update(4, 20, 3)
+    5
+    >>> now[0] = 20; c.update(2, 40) # no task waits for the limit
+    5
+    """
+
+    def __init__(self, minTasks=1, maxTasks=None, initial=None, interval=10.0,
+                 maxLoad=1.0, minFreeMemory=0.1, tolerance=0.1,
+                 clock=time.time, loadProbe=loadPerCpu, memoryProbe=freeMemoryFraction):
+        self.minTasks = max(1, minTasks)
+        self.maxTasks = max(self.minTasks, maxTasks if maxTasks is not None else 4 * cpuCount())
+        self.interval = interval
+        self.maxLoad = maxLoad
+        self.minFreeMemory = minFreeMemory
+        self.tolerance = tolerance
+        self._clock = clock
+        self._loadProbe = loadProbe
+        self._memoryProbe = memoryProbe
+        self.limit = self._clamp(initial if initial is not None else cpuCount())
+        self.history = [] # (time, limit, reason) of each change
+        self.reset()
+
+    def _clamp(self, limit):
+        return max(self.minTasks, min(self.maxTasks, int(limit)))
+
+    def reset(self):
+        """
+        Start measuring again, e.g. for a new refreshTargets(); the limit is kept.
+        """
+        self._lastTime = self._clock()
+        self._lastDone = 0
+        self._lastThroughput = None
+        self._direction = 1
+
+    def update(self, nRunning, nDone, nWaiting=0):
+        """
+        Take the number of running tasks, the number of tasks finished so far and the
+        number of ready tasks waiting to run, and return the number of tasks allowed to
+        run now.
+        """
+        now = self._clock()
+        elapsed = now - self._lastTime
+        if elapsed < self.interval or elapsed <= 0:
+            return self.limit
+        throughput = (nDone - self._lastDone) / float(elapsed)
+        self._lastTime, self._lastDone = now, nDone
+
+        load = self._loadProbe()
+        freeMemory = self._memoryProbe()
+        limit = self.limit
+        if load is not None and load > self.maxLoad:
+            limit, reason = limit * 3 / 4, "load %.2f per cpu" % load
+            self._direction = 1
+        elif freeMemory is not None and freeMemory < self.minFreeMemory:
+            limit, reason = limit * 3 / 4, "%.0f%% memory free" % (100 * freeMemory)
+            self._direction = 1
+        elif nRunning + nWaiting > self.limit:
+            if self._lastThroughput is not None and throughput < self._lastThroughput * (1 - self.tolerance):
+                self._direction = -self._direction
+            limit, reason = limit + self._direction * max(1, limit / 4), "%.2f tasks/s" % throughput
+        else:
+            reason = None
+        self._lastThroughput = throughput
+
+        limit = self._clamp(limit)
+        if limit != self.limit:
+            logger.info("concurrency limit %d -> %d (%s)" % (self.limit, limit, reason))
+            self.history.append((now, limit, reason))
+            self.limit = limit
+        elif limit == self.minTasks:
+            self._direction = 1
+        return self.limit
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
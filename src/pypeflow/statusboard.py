@@ -0,0 +1,288 @@
+# @author Jason Chin
+#
+# Copyright (C) 2010 by Jason Chin
+# Copyright (C) 2011 by Jason Chin, Pacific Biosciences
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+
+PypeStatusBoard: This module provides the channels through which the tasks report their
+status to the workflow: in shared memory for the task processes of the multiprocessing
+workflows, and in a queue for the task threads. Both wake up a workflow waiting on them.
+
+"""
+
+import ctypes
+import errno
+import fcntl
+import multiprocessing
+import os
+import Queue
+import select
+
+from task import TaskDone, TaskFail
+
+TaskStarted = "started, runflag: 1"
+
+def _wakeupPipe():
+    fds = os.pipe()
+    for fd in fds:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fds
+
+def _closePipe(fds):
+    if fds is not None:
+        for fd in fds:
+            os.close(fd)
+
+def _wakeUp(fd):
+    try:
+        os.write(fd, "x")
+    except OSError, e:
+        # EAGAIN: the pipe is full, the reader will wake up anyway. EPIPE: the reader closed it.
+        if e.errno not in (errno.EAGAIN, errno.EPIPE):
+            raise
+
+def _clearWakeups(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError, e:
+        if e.errno != errno.EAGAIN:
+            raise
+
+def _waitReadable(fd, timeout):
+    try:
+        readable, writable, errors = select.select([fd], [], [], timeout)
+    except select.error, e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return False
+    return bool(readable)
+
+class PypeMessageQueue(Queue.Queue):
+
+    """
+    A Queue.Queue for the messages of the tasks running in threads, which also wakes up
+    wait(), so the workflow can block until a task is over without polling the queue.
+    The pipe used to wake it up is opened when it is first needed and closed by close().
+
+    >>> q = PypeMessageQueue()
+    >>> q.wait(0)
+    False
+    >>> q.put( ("task://a", TaskDone) )
+    >>> q.wait(1)
+    True
+    >>> q.drain()
+    [('task://a', 'done')]
+    >>> q.close()
+    """
+
+    def __init__(self):
+        Queue.Queue.__init__(self)
+        self._wakeup = None
+
+    def _wakeupFds(self):
+        if self._wakeup is None:
+            self._wakeup = _wakeupPipe()
+        return self._wakeup
+
+    def put(self, item, block=True, timeout=None):
+        Queue.Queue.put(self, item, block, timeout)
+        _wakeUp(self._wakeupFds()[1])
+
+    def drain(self):
+        """
+        Return the messages put since the last call, in the order they were put.
+        """
+        _clearWakeups(self._wakeupFds()[0])
+        items = []
+        while 1:
+            try:
+                items.append(self.get_nowait())
+            except Queue.Empty:
+                return items
+
+    def wait(self, timeout=None):
+        """
+        Block until a message is put, or for at most timeout seconds. Return whether there may be messages.
+        """
+        if not self.empty():
+            return True
+        return _waitReadable(self._wakeupFds()[0], timeout)
+
+    def close(self):
+        """
+        Close the pipe used to wake up wait(). The messages left are kept.
+        """
+        _closePipe(self._wakeup)
+        self._wakeup = None
+
+class PypeStatusBoard(object):
+
+    """
+    Take the (URL, message) or (URL, message, runSeconds) status messages of the tasks,
+    like the message queue of a workflow, but without pickling them. prepare() gives each
+    task an integer id; a task process then appends the id and a status code to a log
+    in shared memory and writes a byte to a pipe to wake up the workflow, which reads all
+    the new entries at once with drain(). Messages the board has no code for, or from
+    tasks not given to prepare(), or that do not fit in the log, go through a
+    multiprocessing.Queue instead. Every message takes a sequence number from a shared
+    counter, so drain() returns the messages of both channels in the order they were put.
+
+    The shared memory and the wakeup pipe are allocated by prepare(), so the processes
+    have to be forked after it is called. close() closes the pipe.
+
+    >>> board = PypeStatusBoard()
+    >>> board.prepare(["task://a", "task://b"])
+    >>> board.put( ("task://b", TaskStarted) )
+    >>> board.put( ("task://c", "queued") )
+    >>> board.put( ("task://b", TaskDone, 0.5) )
+    >>> board.drain()
+    [('task://b', 'started, runflag: 1'), ('task://c', 'queued'), ('task://b', 'done', 0.5)]
+    >>> board.empty()
+    True
+    >>> board.close()
+    """
+
+    codes = {TaskStarted: 1, TaskDone: 2, TaskFail: 3}
+    flushTimeout = 1.0 # seconds drain() waits for a message already put in the fallback queue
+
+    def __init__(self):
+        self._messages = dict((code, message) for message, code in self.codes.items())
+        self._fallback = multiprocessing.Queue()
+        self._URLs = []
+        self._ids = {}
+        self._runSeconds = None
+        self._log = None # entries of (task id << 2 | status code)
+        self._logSeqs = None # the sequence number of each entry of the log
+        self._nLogged = None
+        self._nRead = 0
+        self._nPut = multiprocessing.Value(ctypes.c_long, 0) # its lock guards the log too
+        self._nextSeq = 0 # the sequence number of the next message drain() returns
+        self._received = {} # sequence number -> message, taken from the fallback queue but not returned yet
+        self._wakeup = None
+
+    def _wakeupFds(self):
+        if self._wakeup is None:
+            self._wakeup = _wakeupPipe()
+        return self._wakeup
+
+    def prepare(self, URLs):
+        """
+        Give the ids to the tasks, and room for each of them to report its start and its end.
+        """
+        self._wakeupFds()
+        self._URLs = list(URLs)
+        self._ids = dict((URL, i) for i, URL in enumerate(self._URLs))
+        nTasks = len(self._URLs)
+        self._runSeconds = multiprocessing.Array(ctypes.c_double, max(1, nTasks), lock=False)
+        self._log = multiprocessing.Array(ctypes.c_long, 2 * nTasks + 16, lock=False)
+        self._logSeqs = multiprocessing.Array(ctypes.c_long, 2 * nTasks + 16, lock=False)
+        self._nLogged = multiprocessing.Value(ctypes.c_long, 0, lock=False)
+        self._nRead = 0
+        with self._nPut.get_lock():
+            self._nextSeq = self._nPut.value # the messages not drained before are dropped with the old log
+        self._received.clear()
+
+    def put(self, item):
+        URL, message = item[:2]
+        code = self.codes.get(message)
+        taskId = self._ids.get(URL)
+        logged = False
+        if code is not None and taskId is not None:
+            self._runSeconds[taskId] = item[2] if len(item) > 2 and item[2] is not None else -1
+        with self._nPut.get_lock():
+            seq = self._nPut.value
+            self._nPut.value = seq + 1
+            if code is not None and taskId is not None:
+                i = self._nLogged.value
+                if i < len(self._log):
+                    self._log[i] = taskId << 2 | code
+                    self._logSeqs[i] = seq
+                    self._nLogged.value = i + 1
+                    logged = True
+        if not logged:
+            self._fallback.put( (seq, item) )
+        _wakeUp(self._wakeupFds()[1])
+
+    def empty(self):
+        return self._nPut.value == self._nextSeq
+
+    def drain(self):
+        """
+        Return the messages put since the last call, in the order they were put.
+        """
+        _clearWakeups(self._wakeupFds()[0])
+        with self._nPut.get_lock():
+            nPut = self._nPut.value
+            nLogged = self._nLogged.value if self._nLogged is not None else 0
+        # The fallback messages are put after their sequence number is taken; the queue
+        # may not have them yet, so wait for them rather than for the next wakeup.
+        nMissing = (nPut - self._nextSeq) - (nLogged - self._nRead) - len(self._received)
+        while nMissing > 0:
+            try:
+                seq, item = self._fallback.get(True, self.flushTimeout)
+            except Queue.Empty:
+                break
+            if seq >= self._nextSeq:
+                self._received[seq] = item
+                nMissing -= 1
+        items = []
+        while self._nextSeq < nPut:
+            seq = self._nextSeq
+            if seq in self._received:
+                items.append(self._received.pop(seq))
+            elif self._nRead < nLogged and self._logSeqs[self._nRead] == seq:
+                entry = self._log[self._nRead]
+                URL = self._URLs[entry >> 2]
+                message = self._messages[entry & 3]
+                runSeconds = self._runSeconds[entry >> 2]
+                if message == TaskStarted or runSeconds < 0:
+                    items.append( (URL, message) )
+                else:
+                    items.append( (URL, message, runSeconds) )
+                self._nRead += 1
+            else:
+                break # not in the fallback queue yet, keep the order
+            self._nextSeq += 1
+        return items
+
+    def wait(self, timeout=None):
+        """
+        Block until a message is put, or for at most timeout seconds. Return whether there may be messages.
+        """
+        if not self.empty():
+            return True
+        return _waitReadable(self._wakeupFds()[0], timeout)
+
+    def close(self):
+        """
+        Close the pipe used to wake up wait(). The messages left are kept.
+        """
+        _closePipe(self._wakeup)
+        self._wakeup = None
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -35,6 +35,7 @@ import hashlib
 import logging
 import copy
 import sys
+import re
 
 PYTHONVERSION = sys.version_info[:2]
 if PYTHONVERSION == (2,5):
@@ -44,9 +45,11 @@ else:
 
 import os
 import shlex
+import time
 
 from common import PypeError, PypeObject, pypeNS, runShellCmd, Graph, URIRef, Literal
-from data import FileNotExistError, PypeSplittableLocalFile, makePypeLocalFile
+from data import FileNotExistError, PypeSplittableLocalFile, makePypeLocalFile, statCache
+from fingerprint import PypeDigestCache
 
 logger = logging.getLogger(__name__)
 
@@ -59,6 +62,41 @@ TaskDone = "done"
 TaskFail = "fail"
 # TODO(CD): Make user-code compare by variable name.
 
+# The task attributes that are not parameters.
+_nonParameters = set(["URL", "inputDataObjs", "outputDataObjs", "mutableDataObjs", "parameters",
+                      "inputs", "outputs", "mutables"])
+# The parameters that only tell the scheduler how to run a task, not what it makes.
+_schedulingHints = set(["nSlots", "cost", "resources", "lightweight"])
+_addressRE = re.compile(r" at 0x[0-9a-fA-F]+")
+
+def _canonicalValue(value):
+    if isinstance(value, dict):
+        return dict((str(k), _canonicalValue(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_canonicalValue(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(_canonicalValue(v) for v in value)
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, PypeObject):
+        return value.URL
+    if inspect.isroutine(value) or inspect.isclass(value):
+        return "%s.%s" % (getattr(value, "__module__", None), getattr(value, "__name__", None))
+    return _addressRE.sub("", repr(value))
+
+def parameterDigest(parameters):
+    """
+    Return the MD5 digest of a dict of task parameters, the same in every run: the order
+    of the dicts does not matter, data objects count by their URL and functions by their
+    name, not by their address.
+
+    >>> parameterDigest({"a": 1, "b": [1, 2]}) == parameterDigest({"b": (1, 2), "a": 1})
+    True
+    >>> parameterDigest({"a": 1}) == parameterDigest({"a": 2})
+    False
+    """
+    return hashlib.md5(json.dumps(_canonicalValue(parameters), sort_keys=True)).hexdigest()
+
 class PypeTaskBase(PypeObject):
     """
     Represent a PypeTask. Subclass it to for different kind of
@@ -79,6 +117,7 @@ class PypeTaskBase(PypeObject):
         self._kwargv = kwargv
         self._taskFun = kwargv['_taskFun']
         self._referenceMD5 = None
+        self._referenceParamMD5 = None
         self._status = TaskInitialized
         self._queue = None
         self.shutdown_event = None
@@ -109,7 +148,7 @@ class PypeTaskBase(PypeObject):
             self.chunk_id = kwargv["chunk_id"]
 
         self._codeMD5digest = kwargv.get("_codeMD5digest", "")
-        self._paramMD5digest = kwargv.get("_paramMD5digest", "")
+        self._paramMD5digest = kwargv.get("_paramMD5digest") or parameterDigest(self._digestedParameters(kwargv))
         self._compareFunctions = kwargv.get("_compareFunctions", [ timeStampCompare ])
 
         for o in self.outputDataObjs.values():
@@ -119,6 +158,18 @@ class PypeTaskBase(PypeObject):
     @property
     def status(self):
         return self._status
+
+    @property
+    def costHint(self):
+        """
+        Return the expected cost of the task (e.g. its run time in seconds) used to find
+        the critical path of a workflow when no run time has been recorded for it yet.
+        Set it through the "parameters" argument (e.g parameters={"cost":3600}), default is 1.
+        """
+        try:
+            return self.parameters["cost"]
+        except (AttributeError, KeyError):
+            return 1
         
     def setInputs( self, inputDataObjs ):
         self.inputDataObjs = inputDataObjs
@@ -128,9 +179,25 @@ class PypeTaskBase(PypeObject):
         self.outputDataObjs = outputDataObjs
         vars(self).update( outputDataObjs )
         
+    def _digestedParameters(self, kwargv):
+        """
+        Return what the parameter digest of the task is computed from: its "parameters"
+        and the other keyword arguments it was made with, but not its data objects nor
+        the scheduling hints (nSlots, cost, resources, lightweight) in its "parameters".
+        """
+        digested = dict((k, v) for k, v in kwargv.iteritems() if k not in _nonParameters and not k.startswith("_"))
+        digested["parameters"] = dict((k, v) for k, v in self.parameters.iteritems() if k not in _schedulingHints)
+        return digested
+
     def setReferenceMD5(self, md5Str):
         self._referenceMD5 = md5Str
 
+    def setReferenceParamMD5(self, md5Str):
+        """
+        Set the parameter digest the outputs were made with; the task is not satisfied if its own differs.
+        """
+        self._referenceParamMD5 = md5Str
+
     def _getRunFlag(self):
         """Determine whether the PypeTask should be run. It can be overridden in
         subclass to allow more flexible rules.
@@ -139,6 +206,12 @@ class PypeTaskBase(PypeObject):
         if self._referenceMD5 is not None and self._referenceMD5 != self._codeMD5digest:
             self._referenceMD5 = self._codeMD5digest
             # Code has changed.
+            runFlag = True
+        if self._referenceParamMD5 is not None and self._referenceParamMD5 != self._paramMD5digest:
+            self._referenceParamMD5 = self._paramMD5digest
+            logger.debug("The parameters of %s changed" % self.URL)
+            runFlag = True
+        if runFlag:
             return True
         return any( [ f(self.inputDataObjs, self.outputDataObjs, self.parameters) for f in self._compareFunctions] )
 
@@ -277,14 +350,26 @@ class PypeTaskBase(PypeObject):
 
         if self.inputDataObjs != inputDataObjs or self.parameters != parameters:
             raise TaskFunctionError("The 'inputDataObjs' and 'parameters' should not be modified in %s" % self.URL)
+        self._setStatusFromOutputs()
+
+        return True # to indicate that it run, since we no longer rely on runFlag
+
+    def _setStatusFromOutputs(self):
+        """
+        Set the status of the task once its function has run, from whether all its outputs exist.
+        """
+        statCache.invalidateDataObjs(self.outputDataObjs.values() + self.mutableDataObjs.values())
         missing = [(k,o) for (k,o) in self.outputDataObjs.iteritems() if not o.exists]
         if missing:
             logger.debug("%s fails to generate all outputs; missing:\n%s" %(self.URL, pprint.pformat(missing)))
             self._status = TaskFail
         else:
             self._status = TaskDone
-
-        return True # to indicate that it run, since we no longer rely on runFlag
+            for f in self._compareFunctions:
+                # Comparison functions that decide from what the outputs were made of keep a record of it.
+                record = getattr(f, "record", None)
+                if record is not None:
+                    record(self.inputDataObjs, self.outputDataObjs, self.parameters)
 
     def __repr__(self):
         r = dict()
@@ -328,6 +413,34 @@ class PypeThreadTaskBase(PypeTaskBase):
             nSlots = 1
         return nSlots
 
+    @property
+    def resources(self):
+        """
+        Return the resources the task holds while it runs, as a dict of resource name -> amount.
+        The "slots" resource is always nSlots; other resources, e.g. "mem_gb", "cores" or a
+        user defined label, are given through the "parameters" argument (e.g
+        parameters={"resources": {"mem_gb": 32, "io": 1}}), and are limited by the capacities
+        set with setResourceCapacity() of the workflow.
+        """
+        try:
+            resources = dict(self.parameters["resources"])
+        except (AttributeError, KeyError):
+            resources = {}
+        resources["slots"] = self.nSlots
+        return resources
+
+    @property
+    def lightweight(self):
+        """
+        Return True for a task so short (e.g. well under a second) that starting a thread or
+        a process for it costs more than its work. The concurrent workflows run the ready
+        lightweight tasks in batches, back to back in one worker (see runTaskBatch()).
+        Set it through the "parameters" argument (e.g parameters={"lightweight":True}).
+        """
+        try:
+            return bool(self.parameters["lightweight"])
+        except (AttributeError, KeyError):
+            return False
 
     def setMessageQueue(self, q):
         self._queue = q
@@ -360,12 +473,71 @@ class PypeThreadTaskBase(PypeTaskBase):
             raise Exception('There seems to be a case when self.queue==None, so we need to let this block simply return.')
 
         self._queue.put( (self.URL, "started, runflag: %d" % True) )
+        startTime = time.time()
         self.run(*argv, **kwargv)
+        runSeconds = time.time() - startTime
 
         self.syncDirectories([o.localFileName for o in self.outputDataObjs.values()])
 
+        self._queue.put( (self.URL, self._status, runSeconds) )
+
+    @property
+    def shellCmd(self):
+        """
+        The command line (a list) run by a shell script task, or None for a task that runs a python function.
+        """
+        return self.__dict__.get("_shellCmd")
+
+    def beforeShellCmd(self):
+        """
+        Do what runInThisThread() does before the task function runs, for the executors
+        that run the shellCmd of the task themselves instead of calling the task.
+        """
+        self._queue.put( (self.URL, "started, runflag: %d" % True) )
+        self.syncDirectories([o.localFileName for o in self.inputDataObjs.values()])
+        logger.info('Running task %s' % self.URL)
+
+    def afterShellCmd(self, exitStatus, outputsSynced=False):
+        """
+        Do what runInThisThread() does after the task function ran, given the exit status of the shellCmd.
+        An executor finishing many tasks at once can syncDirectories() all their outputs itself first.
+        """
+        if exitStatus: # None if it is not known, e.g. for a cluster job
+            logger.info('%s exited with status %r' % (self.URL, exitStatus))
+        self._setStatusFromOutputs()
+        if not outputsSynced:
+            self.syncDirectories([o.localFileName for o in self.outputDataObjs.values()])
         self._queue.put( (self.URL, self._status) )
 
+def runTaskBatch(taskObjs):
+    """
+    Run the tasks one after the other in this thread or process, as their own __call__()
+    would, but list the directories of all their outputs once, at the end. Each task
+    still sends its own messages; one that fails is reported as failed and the others
+    still run.
+    """
+    ran = []
+    for taskObj in taskObjs:
+        if taskObj.shutdown_event is not None and taskObj.shutdown_event.is_set():
+            taskObj._status = TaskFail
+            taskObj._queue.put( (taskObj.URL, TaskFail) )
+            continue
+        taskObj._queue.put( (taskObj.URL, "started, runflag: %d" % True) )
+        startTime = time.time()
+        try:
+            taskObj.run()
+        except Exception:
+            logger.exception('PypeTaskBase failed:\n%r' %taskObj)
+            taskObj._status = TaskFail
+            taskObj._queue.put( (taskObj.URL, TaskFail) )
+            continue
+        ran.append( (taskObj, time.time() - startTime) )
+
+    PypeTaskBase.syncDirectories([o.localFileName for taskObj, runSeconds in ran
+                                  for o in taskObj.outputDataObjs.values()])
+    for taskObj, runSeconds in ran:
+        taskObj._queue.put( (taskObj.URL, taskObj._status, runSeconds) )
+
 class PypeDistributiableTaskBase(PypeThreadTaskBase):
 
     """
@@ -382,16 +554,21 @@ class PypeDistributiableTaskBase(PypeThreadTaskBase):
 class PypeTaskCollection(PypeObject):
 
     """
-    Represent an object that encapsules a number of tasks
+    Represent an object that encapsules a number of tasks.
+    The tasks remember the URL of their collection (as _collectionURL), so that an
+    executor can submit the ones that are ready together as a single array job.
     """
 
     supportedURLScheme = ["tasks"]
     def __init__(self, URL, tasks = [], scatterGatherTasks = [], **kwargv):
         PypeObject.__init__(self, URL, **kwargv)
-        self._tasks = tasks[:]
+        self._tasks = []
+        for task in tasks:
+            self.addTask(task)
         self._scatterGatherTasks = scatterGatherTasks[:]
 
     def addTask(self, task):
+        task._collectionURL = self.URL
         self._tasks.append(task)
 
     def getTasks(self):
@@ -533,7 +710,6 @@ def PypeTask(*argv, **kwargv):
             kwargv["_codeMD5digest"] = hashlib.md5(inspect.getsource(taskFun)).hexdigest()
         except IOError: #python2.7 seems having problem to get source code from docstring, this is a work around to make docstring test working
             kwargv["_codeMD5digest"] = ""
-        kwargv["_paramMD5digest"] = hashlib.md5(repr(kwargv)).hexdigest()
 
         newKwargv = copy.copy(kwargv)
         inputDataObjs = kwargv.get("inputDataObjs",{}) 
@@ -613,6 +789,7 @@ def PypeShellTask(*argv, **kwargv):
             runShellCmd(shlex.split(shellCmd))
 
         kwargv["script"] = scriptToRun
+        kwargv["_shellCmd"] = shlex.split("/bin/bash %s" % scriptToRun)
         return PypeTask(*argv, **kwargv)(taskFun)
 
     return f
@@ -626,13 +803,15 @@ def PypeSGETask(*argv, **kwargv):
 
     def f(scriptToRun):
 
-        def taskFun():
+        def taskFun(self):
             """make shell script using the template"""
             """run shell command"""
             shellCmd = "qsub -sync y -S /bin/bash %s" % scriptToRun
             runShellCmd(shlex.split(shellCmd))
 
         kwargv["script"] = scriptToRun
+        kwargv["distributed"] = True
+        kwargv["_shellCmd"] = shlex.split("qsub -sync y -S /bin/bash %s" % scriptToRun)
 
         return PypeTask(*argv, **kwargv)(taskFun)
 
@@ -647,17 +826,18 @@ def PypeDistributibleTask(*argv, **kwargv):
 
     distributed = kwargv.get("distributed", False)
     def f(scriptToRun):
+        if distributed == True:
+            shellCmd = "qsub -sync y -S /bin/bash %s" % scriptToRun
+        else:
+            shellCmd = "/bin/bash %s" % scriptToRun
+
         def taskFun(self):
             """make shell script using the template"""
             """run shell command"""
-            if distributed == True:
-                shellCmd = "qsub -sync y -S /bin/bash %s" % scriptToRun
-            else:
-                shellCmd = "/bin/bash %s" % scriptToRun
-
             runShellCmd(shlex.split(shellCmd))
 
         kwargv["script"] = scriptToRun
+        kwargv["_shellCmd"] = shlex.split(shellCmd)
         return PypeTask(*argv, **kwargv)(taskFun) 
 
     return f
@@ -733,7 +913,6 @@ def PypeScatteredTasks(*argv, **kwargv):
                 # this is a work around to make docstring test working
                 newKwargv["_codeMD5digest"] = ""
 
-            newKwargv["_paramMD5digest"] = hashlib.md5(repr(kwargv)).hexdigest()
             newKwargv["chunk_id"] = i
 
             
@@ -785,6 +964,7 @@ def PypeFOFNMapTasks(*argv, **kwargv):
         with open(FOFNFileName,"r") as FOFN:
 
             newKwargv = copy.copy(kwargv)
+            chunkId = 0
             
             for fn in FOFN:
 
@@ -793,6 +973,9 @@ def PypeFOFNMapTasks(*argv, **kwargv):
                 if len(fn) == 0:
                     continue
 
+                newKwargv["chunk_id"] = chunkId
+                chunkId += 1
+
                 newKwargv["inputDataObjs"] = {"in_f": makePypeLocalFile(fn) } 
                 outfileName = outTemplateFunc(fn)
                 newKwargv["outputDataObjs"] = {"out_f": makePypeLocalFile(outfileName) } 
@@ -806,8 +989,6 @@ def PypeFOFNMapTasks(*argv, **kwargv):
                     newKwargv["_codeMD5digest"] = ""
 
 
-                newKwargv["_paramMD5digest"] = hashlib.md5(repr(kwargv)).hexdigest()
-
                 tasks.addTask( TaskType(*argv, **newKwargv) )
 
             allFOFNOutDataObjs = dict( [ ("FOFNout%03d" % t[0], t[1].in_f) for t in enumerate(tasks) ] )
@@ -866,6 +1047,102 @@ def timeStampCompare( inputDataObjs, outputDataObjs, parameters) :
 
     return runFlag
 
+
+class PypeContentCompare(object):
+
+    """
+    A comparison function, to be used in "_compareFunctions", which decides whether a task
+    has to run from the content of its input files rather than from their time stamps:
+    the outputs are stale if the digests of the inputs differ from the ones recorded when
+    the outputs were produced. The digests are kept in a PypeDigestCache, so the files are
+    only re-hashed when their (device, inode, size, mtime) change. Outputs without a record
+    yet, and tasks with inputs that are not regular files, fall back to timeStampCompare().
+
+    >>> import os
+    >>> from pypeflow.data import makePypeLocalFile
+    >>> os.system("mkdir -p /tmp/pypetest; rm -f /tmp/pypetest/content_compare.sqlite")
+    0
+    >>> compare = PypeContentCompare("/tmp/pypetest/content_compare.sqlite")
+    >>> fin = makePypeLocalFile("/tmp/pypetest/content_in")
+    >>> fout = makePypeLocalFile("/tmp/pypetest/content_out")
+    >>> open(fin.localFileName, "w").write("a")
+    >>> open(fout.localFileName, "w").write("b")
+    >>> compare.record({"in":fin}, {"out":fout}, {})
+    >>> compare({"in":fin}, {"out":fout}, {})
+    False
+    >>> os.utime(fin.localFileName, None) # touched, same content
+    >>> compare({"in":fin}, {"out":fout}, {})
+    False
+    >>> open(fin.localFileName, "w").write("c")
+    >>> compare({"in":fin}, {"out":fout}, {})
+    True
+    """
+
+    def __init__(self, dbFileName=None, nThreads=4):
+        """
+        The digests are kept in dbFileName, by default .pypeflow/digests.sqlite in the
+        working directory at the time of the first comparison.
+        """
+        self.dbFileName = dbFileName
+        self.nThreads = nThreads
+        self._digestCache = None
+
+    @property
+    def digestCache(self):
+        if self._digestCache is None:
+            dbFileName = self.dbFileName
+            if dbFileName is None:
+                dbFileName = os.path.join(os.getcwd(), ".pypeflow", "digests.sqlite")
+            self._digestCache = PypeDigestCache(dbFileName, self.nThreads)
+        return self._digestCache
+
+    @staticmethod
+    def _paths(dataObjs):
+        paths = [getattr(o, "localFileName", None) for o in dataObjs.values()]
+        if None in paths:
+            return None
+        return paths
+
+    def __call__(self, inputDataObjs, outputDataObjs, parameters):
+        if not outputDataObjs:
+            return True
+        for f in outputDataObjs.values():
+            if not f.exists:
+                logger.debug('output does not exist yet: %r'%f)
+                return True
+        inputPaths = self._paths(inputDataObjs)
+        outputPaths = self._paths(outputDataObjs)
+        if inputPaths is None or outputPaths is None:
+            return timeStampCompare(inputDataObjs, outputDataObjs, parameters)
+
+        digestCache = self.digestCache
+        inputDigests = None
+        for outputPath in outputPaths:
+            recorded = digestCache.recorded(outputPath)
+            if recorded is None:
+                return timeStampCompare(inputDataObjs, outputDataObjs, parameters)
+            if inputDigests is None:
+                inputDigests = digestCache.digests(inputPaths)
+                if None in inputDigests.values():
+                    return timeStampCompare(inputDataObjs, outputDataObjs, parameters)
+            if recorded != inputDigests:
+                logger.debug('inputs of %s changed since it was produced' % outputPath)
+                return True
+        return False
+
+    def record(self, inputDataObjs, outputDataObjs, parameters):
+        """
+        Record the digests of the inputs the outputs were just produced from.
+        """
+        inputPaths = self._paths(inputDataObjs)
+        outputPaths = self._paths(outputDataObjs)
+        if inputPaths is None or outputPaths is None:
+            return
+        digestCache = self.digestCache
+        digestCache.record(outputPaths, digestCache.digests(inputPaths))
+
+contentCompare = PypeContentCompare()
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,262 @@
+# @author Jason Chin
+#
+# Copyright (C) 2010 by Jason Chin
+# Copyright (C) 2011 by Jason Chin, Pacific Biosciences
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+
+PypeTaskDB: This module provides a persistent record of the tasks a workflow completed,
+so that a restarted workflow does not have to check every task again.
+
+"""
+
+import os
+import json
+import sqlite3
+import logging
+
+from data import statCache
+from fingerprint import statKey
+
+logger = logging.getLogger(__name__)
+
+class PypeTaskStateDB(object):
+
+    """
+    Keep in a SQLite database, for each task that completed, the code and parameter
+    digests it ran with and the statKey() of each of its input and output files when
+    it was over. The writes are buffered until flush().
+
+    >>> import os
+    >>> from pypeflow.task import PypeTask, PypeTaskBase
+    >>> from pypeflow.data import makePypeLocalFile
+    >>> os.system("mkdir -p /tmp/pypetest; rm -f /tmp/pypetest/taskstate.sqlite")
+    0
+    >>> fout = makePypeLocalFile("/tmp/pypetest/taskstate_out")
+    >>> open(fout.localFileName, "w").write("out")
+    >>> @PypeTask(outputDataObjs={"o": fout}, URL="task://localhost/taskstate", TaskType=PypeTaskBase)
+    ... def t(self):
+    ...     pass
+    >>> db = PypeTaskStateDB("/tmp/pypetest/taskstate.sqlite")
+    >>> db.recordDone(t)
+    >>> db.flush()
+    >>> record = PypeTaskStateDB("/tmp/pypetest/taskstate.sqlite").load()["task://localhost/taskstate"]
+    >>> db.matches(record, t), db.verify(record)
+    (True, True)
+    >>> os.remove(fout.localFileName)
+    >>> db.verify(record)
+    False
+    """
+
+    flushEvery = 1000 # tasks
+    schemaVersion = 2 # 0 had no stable parameter digests, 1 digested the scheduling hints too
+
+    def __init__(self, dbFileName):
+        self.dbFileName = os.path.abspath(dbFileName)
+        self._pending = {} # URL -> row to write, None to delete
+        dirName = os.path.dirname(self.dbFileName)
+        if not os.path.isdir(dirName):
+            os.makedirs(dirName)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                             "URL TEXT PRIMARY KEY, codeDigest TEXT, paramDigest TEXT, files TEXT)")
+                if conn.execute("PRAGMA user_version").fetchone()[0] < self.schemaVersion:
+                    conn.execute("DELETE FROM tasks") # the tasks are checked again, once
+                    conn.execute("PRAGMA user_version = %d" % self.schemaVersion)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.dbFileName, timeout=60)
+        conn.text_factory = str
+        return conn
+
+    def load(self):
+        """
+        Return a dict of task URL -> record, for the tasks recorded as completed.
+        """
+        self.flush()
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT URL, codeDigest, paramDigest, files FROM tasks").fetchall()
+        finally:
+            conn.close()
+        return dict((URL, (codeDigest, paramDigest, json.loads(files))) for URL, codeDigest, paramDigest, files in rows)
+
+    @staticmethod
+    def _fileKeys(paths):
+        keys = {}
+        for path in paths:
+            st = statCache.stat(path)
+            keys[path] = list(statKey(st)) if st is not None else None
+        return keys
+
+    @staticmethod
+    def filePaths(taskObj):
+        """
+        Return the paths of the local input and output files of a task; the mutable ones are left out.
+        """
+        return [o.localFileName for o in taskObj.inputDataObjs.values() + taskObj.outputDataObjs.values()
+                if getattr(o, "localFileName", None) is not None]
+
+    def recordDone(self, taskObj):
+        """
+        Record that the task completed, with its files as they are now.
+        """
+        files = self._fileKeys(self.filePaths(taskObj))
+        self._pending[taskObj.URL] = (taskObj.URL, taskObj._codeMD5digest, taskObj._paramMD5digest, json.dumps(files))
+        if len(self._pending) >= self.flushEvery:
+            self.flush()
+
+    def forget(self, URL):
+        self._pending[URL] = None
+        if len(self._pending) >= self.flushEvery:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("DELETE FROM tasks WHERE URL=?",
+                                 [(URL,) for URL, row in self._pending.iteritems() if row is None])
+                conn.executemany("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)",
+                                 [row for row in self._pending.itervalues() if row is not None])
+        finally:
+            conn.close()
+        self._pending = {}
+
+    @staticmethod
+    def matches(record, taskObj):
+        """
+        Return whether a record was made with the same code and parameters as the task has now.
+        """
+        codeDigest, paramDigest, files = record
+        return codeDigest == taskObj._codeMD5digest and paramDigest == taskObj._paramMD5digest
+
+    def verify(self, record):
+        """
+        Return whether the files of a record have not changed since it was made.
+        """
+        codeDigest, paramDigest, files = record
+        return self._fileKeys(files.keys()) == files
+
+class PypeParamDigestDB(object):
+
+    """
+    Keep in a SQLite database the parameter digest each task last completed with, and the
+    outputs it had then, so that a task whose parameters changed since is run again. The
+    database is made by the first flush() with something to write.
+
+    >>> import os
+    >>> from pypeflow.task import PypeTask, PypeTaskBase
+    >>> from pypeflow.data import makePypeLocalFile
+    >>> os.system("mkdir -p /tmp/pypetest; rm -f /tmp/pypetest/params.sqlite")
+    0
+    >>> def makeTask(outputName, parameters):
+    ...     @PypeTask(outputDataObjs={"o": makePypeLocalFile(outputName)}, parameters=parameters,
+    ...               URL="task://localhost/paramdigest", TaskType=PypeTaskBase)
+    ...     def t(self):
+    ...         pass
+    ...     return t
+    >>> db = PypeParamDigestDB("/tmp/pypetest/params.sqlite")
+    >>> db.load()
+    {}
+    >>> t = makeTask("/tmp/pypetest/paramdigest_out", {"x": 1})
+    >>> db.record(t)
+    >>> db.flush()
+    >>> records = PypeParamDigestDB("/tmp/pypetest/params.sqlite").load()
+    >>> db.recorded(records, makeTask("/tmp/pypetest/paramdigest_out", {"x": 2})) == t._paramMD5digest
+    True
+    >>> db.recorded(records, makeTask("/tmp/pypetest/paramdigest_other", {"x": 1})) is None # other outputs
+    True
+    """
+
+    flushEvery = 1000 # tasks
+
+    def __init__(self, dbFileName):
+        self.dbFileName = os.path.abspath(dbFileName)
+        self._pending = {} # URL -> row to write
+
+    def _connect(self):
+        conn = sqlite3.connect(self.dbFileName, timeout=60)
+        conn.text_factory = str
+        return conn
+
+    @staticmethod
+    def _outputs(taskObj):
+        return json.dumps(sorted(o.URL for o in taskObj.outputDataObjs.values()))
+
+    def load(self):
+        """
+        Return a dict of task URL -> record, for the tasks recorded as completed.
+        """
+        self.flush()
+        if not os.path.exists(self.dbFileName):
+            return {}
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT URL, outputs, paramDigest FROM params").fetchall()
+        finally:
+            conn.close()
+        return dict((URL, (outputs, paramDigest)) for URL, outputs, paramDigest in rows)
+
+    def record(self, taskObj):
+        """
+        Record that the task completed, or was found up to date, with its parameters as they are now.
+        """
+        self._pending[taskObj.URL] = (taskObj.URL, self._outputs(taskObj), taskObj._paramMD5digest)
+        if len(self._pending) >= self.flushEvery:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        dirName = os.path.dirname(self.dbFileName)
+        if not os.path.isdir(dirName):
+            os.makedirs(dirName)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS params (URL TEXT PRIMARY KEY, outputs TEXT, paramDigest TEXT)")
+                conn.executemany("INSERT OR REPLACE INTO params VALUES (?, ?, ?)", self._pending.values())
+        finally:
+            conn.close()
+        self._pending = {}
+
+    @classmethod
+    def recorded(cls, records, taskObj):
+        """
+        Return the parameter digest the task made its outputs with, from the records of
+        load(), or None if it is not known.
+        """
+        record = records.get(taskObj.URL)
+        if record is None or record[0] != cls._outputs(taskObj):
+            return None
+        return record[1]
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,5 +1,7 @@
 from nose.tools import assert_equal
 from nose import SkipTest
+import time
+import pypeflow.common
 
 class TestPypeObject:
     def TestRDFXML(self):
@@ -13,8 +15,17 @@ class TestPypeObject:
 
 class TestRunShellCmd:
     def test_run_shell_cmd(self):
-        # assert_equal(expected, runShellCmd(args, **kwargs))
-        raise SkipTest # TODO: implement your test here
+        assert_equal(0, pypeflow.common.runShellCmd(["true"]))
+        assert_equal(2, pypeflow.common.runShellCmd(["sh", "-c", "exit 2"]))
+        assert_equal(-9, pypeflow.common.runShellCmd(["sh", "-c", "kill -9 $$"]))
+        sleeps = []
+        sleep = time.sleep
+        time.sleep = sleeps.append
+        try:
+            assert_equal(0, pypeflow.common.runShellCmd(["sh", "-c", "exec sleep 0.2"]))
+        finally:
+            time.sleep = sleep
+        assert_equal([], sleeps) # waits for the child, does not poll it
 
 class TestRunSgeSyncJob:
     def test_run_sge_sync_job(self):
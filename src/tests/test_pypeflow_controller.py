@@ -1,5 +1,6 @@
 from nose import SkipTest
 from nose.tools import assert_equal
+import pypeflow.common
 import pypeflow.task
 import pypeflow.data
 import pypeflow.controller
@@ -20,9 +21,18 @@ class TestPypeNode:
         raise SkipTest # TODO: implement your test here
 
     def test_depth(self):
-        # pype_node = PypeNode(obj)
-        # assert_equal(expected, pype_node.depth())
-        raise SkipTest # TODO: implement your test here
+        PypeNode = pypeflow.controller.PypeNode
+        nodes = [PypeNode(i) for i in range(5000)]
+        for n1, n2 in zip(nodes[:-1], nodes[1:]):
+            n1.addAnOutNode(n2)
+            n2.addAnInNode(n1)
+        assert_equal(5000, nodes[-1].depth) # deeper than the recursion limit
+        shortcut = PypeNode("shortcut")
+        shortcut.addAnOutNode(nodes[-1])
+        nodes[-1].addAnInNode(shortcut)
+        assert_equal(5000, nodes[-1].depth)
+        nodes[2].removeAnInNode(nodes[1])
+        assert_equal(4998, nodes[-1].depth)
 
     def test_inDegree(self):
         # pype_node = PypeNode(obj)
@@ -44,20 +54,109 @@ class TestPypeNode:
         # assert_equal(expected, pype_node.removeAnOutNode(obj))
         raise SkipTest # TODO: implement your test here
 
+def _make_chain_workflow(nTasks):
+    """Build a linear chain f0 -> t0 -> f1 -> t1 -> ... -> f<nTasks>."""
+    PypeTask = pypeflow.task.PypeTask
+    files = [pypeflow.data.PypeLocalFile("file://localhost/tmp/pypetest/chain_%d" % i)
+             for i in range(nTasks + 1)]
+    tasks = []
+    for i in range(nTasks):
+        @PypeTask(inputDataObjs={"i": files[i]},
+                  outputDataObjs={"o": files[i+1]},
+                  URL="task://localhost/chain_%d" % i)
+        def t(self):
+            pass
+        tasks.append(t)
+    wf = pypeflow.controller.PypeWorkflow()
+    wf.addTasks(tasks)
+    return wf, files, tasks
+
+class TestPypeDependencyIndex:
+    def test_edges_match_rdf(self):
+        wf, files, tasks = _make_chain_workflow(3)
+        pypeNS = pypeflow.common.pypeNS
+        rdfEdges = set((str(o), str(s)) for s, o in
+                wf._RDFGraph.subject_objects(pypeNS["prereq"]))
+        assert_equal(rdfEdges, set(wf._dependencyIndex.edges()))
+
+    def test_transitivePrereqs(self):
+        wf, files, tasks = _make_chain_workflow(3)
+        depIndex = wf._dependencyIndex
+        assert_equal(set([files[1].URL, tasks[0].URL, files[0].URL]),
+                     depIndex.transitivePrereqs(files[1].URL))
+        assert_equal(set([files[0].URL]), depIndex.transitivePrereqs(files[0].URL))
+
+    def test_prereqTaskURLs(self):
+        wf, files, tasks = _make_chain_workflow(3)
+        depIndex = wf._dependencyIndex
+        assert_equal(set(), depIndex.prereqTaskURLs(tasks[0].URL))
+        assert_equal(set([tasks[1].URL]), depIndex.prereqTaskURLs(tasks[2].URL))
+
 class TestPypeGraph:
     def test___getitem__(self):
-        # pype_graph = PypeGraph(RDFGraph, subGraphNodes)
-        # assert_equal(expected, pype_graph.__getitem__(url))
-        raise SkipTest # TODO: implement your test here
+        wf, files, tasks = _make_chain_workflow(2)
+        pype_graph = pypeflow.controller.PypeGraph(wf._dependencyIndex)
+        node = pype_graph[tasks[0].URL]
+        assert_equal(tasks[0].URL, node.obj)
+        assert_equal(1, node.inDegree)
+        assert_equal(1, node.outDegree)
 
     def test___init__(self):
-        # pype_graph = PypeGraph(RDFGraph, subGraphNodes)
-        raise SkipTest # TODO: implement your test here
+        wf, files, tasks = _make_chain_workflow(2)
+        subGraphNodes = set([files[0].URL, tasks[0].URL, files[1].URL])
+        pype_graph = pypeflow.controller.PypeGraph(wf._dependencyIndex, subGraphNodes)
+        assert_equal(subGraphNodes, set(pype_graph.url2Node))
+        assert_equal(3, len(pype_graph))
 
     def test_tSort(self):
-        # pype_graph = PypeGraph(RDFGraph, subGraphNodes)
-        # assert_equal(expected, pype_graph.tSort())
-        raise SkipTest # TODO: implement your test here
+        wf, files, tasks = _make_chain_workflow(3)
+        pype_graph = pypeflow.controller.PypeGraph(wf._dependencyIndex)
+        expected = [files[0].URL, tasks[0].URL, files[1].URL, tasks[1].URL,
+                    files[2].URL, tasks[2].URL, files[3].URL]
+        assert_equal(expected, pype_graph.tSort())
+        # sorting leaves the graph untouched
+        assert_equal(expected, pype_graph.tSort())
+        assert_equal(1, pype_graph[tasks[1].URL].inDegree)
+
+    def test_tSortLevels(self):
+        PypeTask = pypeflow.task.PypeTask
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        a, b, c = [PypeLocalFile("file://localhost/tmp/pypetest/levels_%s" % x) for x in "abc"]
+        @PypeTask(inputDataObjs={"i": a}, outputDataObjs={"o": b}, URL="task://localhost/levels_1")
+        def t1(self):
+            pass
+        @PypeTask(inputDataObjs={"i": a, "j": b}, outputDataObjs={"o": c}, URL="task://localhost/levels_2")
+        def t2(self):
+            pass
+        wf = pypeflow.controller.PypeWorkflow()
+        wf.addTasks([t1, t2])
+        levels = wf.getSortedLevels(wf._dependencyIndex, [c])
+        assert_equal([[a.URL], [t1.URL], [b.URL], [t2.URL], [c.URL]], levels)
+
+    def test_tSort_cycle(self):
+        PypeTask = pypeflow.task.PypeTask
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        a, b, c = [PypeLocalFile("file://localhost/tmp/pypetest/cycle_%s" % x) for x in "abc"]
+        @PypeTask(inputDataObjs={"i": c}, outputDataObjs={"o": a}, URL="task://localhost/cycle_0")
+        def t0(self):
+            pass
+        @PypeTask(inputDataObjs={"i": a}, outputDataObjs={"o": b}, URL="task://localhost/cycle_1")
+        def t1(self):
+            pass
+        @PypeTask(inputDataObjs={"i": b}, outputDataObjs={"o": a}, URL="task://localhost/cycle_2")
+        def t2(self):
+            pass
+        wf = pypeflow.controller.PypeWorkflow()
+        wf.addTasks([t0, t1, t2])
+        pype_graph = pypeflow.controller.PypeGraph(wf._dependencyIndex)
+        try:
+            pype_graph.tSort()
+        except pypeflow.controller.TaskExecutionError, e:
+            cycle = e.msg.split(": ")[1].split(" -> ")
+            assert_equal(cycle[0], cycle[-1])
+            assert_equal(set([a.URL, t1.URL, b.URL, t2.URL]), set(cycle))
+        else:
+            assert False, "cycle not detected"
 
 class TestPypeWorkflow:
     def test___init__(self):
@@ -115,9 +214,33 @@ class TestPypeWorkflow:
         raise SkipTest # TODO: implement your test here
 
     def test_removeTask(self):
-        # pype_workflow = PypeWorkflow(URL, **attributes)
-        # assert_equal(expected, pype_workflow.removeTask(taskObj))
-        raise SkipTest # TODO: implement your test here
+        wf, files, tasks = _make_chain_workflow(3)
+        wf.removeTask(tasks[1])
+        depIndex = wf._dependencyIndex
+        assert_equal(set([(files[0].URL, tasks[0].URL), (tasks[0].URL, files[1].URL),
+                          (files[2].URL, tasks[2].URL), (tasks[2].URL, files[3].URL)]),
+                     set(depIndex.edges()))
+        wf.addTask(tasks[1])
+        assert_equal(6, len(list(depIndex.edges())))
+
+    def test_updateURL(self):
+        wf, files, tasks = _make_chain_workflow(2)
+        newURL = "file://localhost/tmp/pypetest/chain_renamed"
+        wf.updateURL(files[1].URL, newURL)
+        depIndex = wf._dependencyIndex
+        assert_equal(set([tasks[0].URL]), depIndex.prereqs(newURL))
+        assert_equal(set([tasks[1].URL]), depIndex.dependents(newURL))
+        assert_equal(set([newURL]), depIndex.prereqs(tasks[1].URL))
+        assert_equal([files[0].URL, tasks[0].URL, newURL, tasks[1].URL, files[2].URL],
+                     wf.getSortedURLs(depIndex, [files[2]]))
+
+    def test_getSortedURLsRDFGraph(self):
+        wf, files, tasks = _make_chain_workflow(3)
+        # The RDF graph of the workflow, as passed before the dependency index.
+        assert_equal(wf.getSortedURLs(wf._dependencyIndex, [files[2]]), wf.getSortedURLs(wf._RDFGraph, [files[2]]))
+        assert_equal(wf.getSortedURLs(wf._dependencyIndex, []), wf.getSortedURLs(wf._RDFGraph, []))
+        index = pypeflow.controller.PypeDependencyIndex.fromRDFGraph(wf._RDFGraph)
+        assert_equal(set(wf._dependencyIndex.edges()), set(index.edges()))
 
     def test_removeTasks(self):
         # pype_workflow = PypeWorkflow(URL, **attributes)
@@ -129,6 +252,97 @@ class TestPypeWorkflow:
         # assert_equal(expected, pype_workflow.setReferenceRDFGraph(fn))
         raise SkipTest # TODO: implement your test here
 
+    def test_snapshot(self):
+        import os, json
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        snapshot = "/tmp/pypetest/snapshot.json"
+        open("/tmp/pypetest/snapshot_in", "w").write("in")
+        ran = []
+
+        def v1(self):
+            ran.append("v1")
+            open(self.o.localFileName, "w").write("v1")
+        def v2(self):
+            ran.append("v2")
+            open(self.o.localFileName, "w").write("v2")
+
+        def run(taskFun):
+            t = PypeTask(inputDataObjs={"i": PypeLocalFile("file://localhost/tmp/pypetest/snapshot_in")},
+                         outputDataObjs={"o": PypeLocalFile("file://localhost/tmp/pypetest/snapshot_out")},
+                         URL="task://localhost/snapshot", TaskType=pypeflow.task.PypeThreadTaskBase)(taskFun)
+            wf = pypeflow.controller.PypeThreadWorkflow(snapshotFileName=snapshot)
+            wf.addTask(t)
+            wf.refreshTargets()
+
+        run(v1)
+        run(v1)
+        assert_equal(["v1"], ran)
+        run(v2) # the code changed since the snapshot
+        assert_equal(["v1", "v2"], ran)
+
+        lines = open(snapshot).read().splitlines()
+        assert_equal({"pypeflowSnapshot": pypeflow.controller.SNAPSHOT_VERSION}, json.loads(lines[0]))
+        record = json.loads(lines[1])
+        assert_equal("task://localhost/snapshot", record["URL"])
+        assert_equal(["file://localhost/tmp/pypetest/snapshot_out"], record["outputs"])
+        assert pypeflow.controller.isSnapshot(snapshot)
+
+    def test_snapshotParameters(self):
+        import os
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        ran = []
+
+        def run(suffix, snapshot, cost=1):
+            files = dict((x, PypeLocalFile("file://localhost/tmp/pypetest/params_%s" % x)) for x in ["in", "a", "b", "c"])
+            tasks = []
+            for name, i, parameters in [("a", "in", {"suffix": suffix, "f": os.path.join}),
+                                        ("b", "a", {}), ("c", "in", {"suffix": "+", "cost": cost, "nSlots": cost})]:
+                @PypeTask(inputDataObjs={"i": files[i]}, outputDataObjs={"o": files[name]}, parameters=parameters,
+                          URL="task://localhost/params_%s" % name, TaskType=pypeflow.task.PypeThreadTaskBase)
+                def t(self):
+                    ran.append(self.URL.rsplit("_", 1)[-1])
+                    open(self.o.localFileName, "w").write(open(self.i.localFileName).read() +
+                                                          self.parameters.get("suffix", ""))
+                tasks.append(t)
+            wf = pypeflow.controller.PypeThreadWorkflow(snapshotFileName=snapshot,
+                                                        paramDigestDB="/tmp/pypetest/db/params.sqlite")
+            wf.setNumThreadAllowed(4, 4)
+            wf.addTasks(tasks)
+            wf.refreshTargets()
+
+        # The digests are kept in the snapshot, or in the parameter digest DB without one.
+        for snapshot in ("/tmp/pypetest/snapshot.json", None):
+            os.system("rm -rf /tmp/pypetest; mkdir -p /tmp/pypetest")
+            open("/tmp/pypetest/params_in", "w").write("in")
+            del ran[:]
+            run("+", snapshot)
+            assert_equal(["a", "b", "c"], sorted(ran))
+            del ran[:]
+            run("+", snapshot)
+            assert_equal([], ran)
+            # The scheduling hints are not parameters.
+            run("+", snapshot, cost=3)
+            assert_equal([], ran)
+            # Only the task whose parameters changed and the tasks depending on it run again.
+            run("-", snapshot)
+            assert_equal(["a", "b"], sorted(ran))
+            assert_equal("in-", open("/tmp/pypetest/params_b").read())
+            # Nothing is kept next to the outputs.
+            assert_equal(["db", "params_a", "params_b", "params_c", "params_in"],
+                         sorted(fn for fn in os.listdir("/tmp/pypetest") if fn != "snapshot.json"))
+
+        # Outputs made before the digests were kept are taken as made with the current parameters.
+        os.system("rm -rf /tmp/pypetest/db")
+        del ran[:]
+        run("-", None)
+        assert_equal([], ran)
+        run("+", None)
+        assert_equal(["a", "b"], sorted(ran))
+
     def test_tasks(self):
         # pype_workflow = PypeWorkflow(URL, **attributes)
         # assert_equal(expected, pype_workflow.tasks())
@@ -236,25 +450,680 @@ class TestPypeWorkflow:
         print wf.graphvizDot
         wf.refreshTargets( [outfileObj4, outfileObj5] )
     
+    def test_criticalPath(self):
+        PypeTask = pypeflow.task.PypeTask
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        a, b, c, d = [PypeLocalFile("file://localhost/tmp/pypetest/cp_%s" % x) for x in "abcd"]
+        @PypeTask(inputDataObjs={"i": a}, outputDataObjs={"o": b},
+                  parameters={"cost": 10}, URL="task://localhost/cp_long")
+        def long(self):
+            pass
+        @PypeTask(inputDataObjs={"i": a}, outputDataObjs={"o": c},
+                  parameters={"cost": 2}, URL="task://localhost/cp_short")
+        def short(self):
+            pass
+        @PypeTask(inputDataObjs={"i": b, "j": c}, outputDataObjs={"o": d},
+                  URL="task://localhost/cp_merge")
+        def merge(self):
+            pass
+        wf = pypeflow.controller.PypeWorkflow()
+        wf.addTasks([long, short, merge])
+        path, slack = wf.criticalPath()
+        assert_equal([long.URL, merge.URL], path)
+        assert_equal({long.URL: 0, short.URL: 8, merge.URL: 0}, slack)
+        path, slack = wf.criticalPath(runtimes={long.URL: 1})
+        assert_equal([short.URL, merge.URL], path)
+        assert_equal(1, slack[long.URL])
+
 class TestPypeThreadWorkflow:
     def test___init__(self):
         # pype_thread_workflow = PypeThreadWorkflow(URL, **attributes)
         raise SkipTest # TODO: implement your test here
 
     def test_addTasks(self):
-        # pype_thread_workflow = PypeThreadWorkflow(URL, **attributes)
-        # assert_equal(expected, pype_thread_workflow.addTasks(taskObjs))
-        raise SkipTest # TODO: implement your test here
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        fin = PypeLocalFile("file://localhost/tmp/pypetest/collision_in")
+        fout = PypeLocalFile("file://localhost/tmp/pypetest/collision_out")
+        def makeTask(name):
+            @PypeTask(inputDataObjs={"i": fin}, outputDataObjs={"o": fout},
+                      URL="task://localhost/collision_%s" % name, TaskType=PypeThreadTaskBase)
+            def t(self):
+                pass
+            return t
+        t1, t2 = makeTask("1"), makeTask("2")
+        wf = pypeflow.controller.PypeThreadWorkflow()
+        wf.addTasks([t1])
+        wf.addTasks([t1]) # adding the same task again is fine
+        for wf, taskObjs in ((wf, [t2]), (pypeflow.controller.PypeThreadWorkflow(), [t1, t2])):
+            try:
+                wf.addTasks(taskObjs)
+            except pypeflow.controller.TaskOutputCollisionError:
+                pass
+            else:
+                assert False, "output collision not detected"
+        assert t2.URL not in wf._pypeObjects
 
     def test_refreshTargets(self):
         # pype_thread_workflow = PypeThreadWorkflow(URL, **attributes)
         # assert_equal(expected, pype_thread_workflow.refreshTargets(objs, callback, updateFreq, exitOnFailure))
         raise SkipTest # TODO: implement your test here
 
+    def test_refreshTargets_prepareFails(self):
+        wf = pypeflow.controller.PypeThreadWorkflow()
+        def prepare(targets, nWorkers):
+            raise OSError("cannot fork")
+        wf.thread_handler.prepare = prepare
+        try:
+            wf.refreshTargets()
+        except OSError:
+            pass
+        else:
+            assert False, "the failure to prepare was not raised"
+        assert_equal(None, pypeflow.data.statCache._owner) # not left active
+
     def test_setNumThreadAllowed(self):
-        # pype_thread_workflow = PypeThreadWorkflow(URL, **attributes)
-        # assert_equal(expected, pype_thread_workflow.setNumThreadAllowed(nT, nS))
-        raise SkipTest # TODO: implement your test here
+        wf = pypeflow.controller.PypeThreadWorkflow()
+        other = pypeflow.controller.PypeThreadWorkflow()
+        wf.setNumThreadAllowed(3, 5)
+        assert_equal((3, 5), (wf.CONCURRENT_THREAD_ALLOWED, wf.MAX_NUMBER_TASK_SLOT))
+        assert_equal(16, other.CONCURRENT_THREAD_ALLOWED) # not shared
+        pypeflow.controller.PypeThreadWorkflow.setNumThreadAllowed(4, 6) # the defaults
+        try:
+            assert_equal((4, 6), (other.CONCURRENT_THREAD_ALLOWED, other.MAX_NUMBER_TASK_SLOT))
+            assert_equal(4, pypeflow.controller.PypeMPWorkflow().CONCURRENT_THREAD_ALLOWED)
+            assert_equal((3, 5), (wf.CONCURRENT_THREAD_ALLOWED, wf.MAX_NUMBER_TASK_SLOT))
+        finally:
+            pypeflow.controller.PypeThreadWorkflow.setNumThreadAllowed(16, 16)
+
+    def test_adaptiveConcurrency(self):
+        import os, time, threading
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        lock = threading.Lock()
+        running = [0, 0] # now, peak
+
+        def makeTask(i):
+            @PypeTask(outputDataObjs={"o": PypeLocalFile("file://localhost/tmp/pypetest/adaptive_%d" % i)},
+                      URL="task://localhost/adaptive_%d" % i, TaskType=PypeThreadTaskBase)
+            def t(self):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(0.05)
+                with lock:
+                    running[0] -= 1
+                open(self.o.localFileName, "w").write("%d" % i)
+            return t
+
+        wf = pypeflow.controller.PypeThreadWorkflow()
+        wf.setAdaptiveConcurrency(minTasks=1, maxTasks=4, initial=1, interval=0.3,
+                                  loadProbe=lambda: 0.0, memoryProbe=lambda: 0.5)
+        wf.addTasks([makeTask(i) for i in range(40)])
+        wf.refreshTargets()
+        controller = wf.concurrencyController
+        assert controller.history, "the limit never changed"
+        assert 1 < running[1] <= 4, running
+        assert running[1] <= max(limit for t, limit, reason in controller.history)
+
+    def test_readyTaskOrder(self):
+        import os
+        os.system("rm -rf /tmp/pypetest/*")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        in0, outLeaf, h1, h2 = [PypeLocalFile("file://localhost/tmp/pypetest/order_%s" % x)
+                                for x in ("in", "leaf", "h1", "h2")]
+        with open(in0.localFileName, "w") as f:
+            f.write("in")
+        ran = []
+
+        def makeTask(name, inObj, outObj, cost):
+            @PypeTask(inputDataObjs={"i": inObj}, outputDataObjs={"o": outObj},
+                      parameters={"cost": cost}, URL="task://localhost/order_%s" % name,
+                      TaskType=PypeThreadTaskBase)
+            def t(self):
+                ran.append(name)
+                with open(self.o.localFileName, "w") as f:
+                    f.write(name)
+            return t
+
+        wf = pypeflow.controller.PypeThreadWorkflow()
+        wf.CONCURRENT_THREAD_ALLOWED = 1
+        wf.MAX_NUMBER_TASK_SLOT = 1
+        wf.addTasks([makeTask("leaf", in0, outLeaf, 1), makeTask("head", in0, h1, 1),
+                     makeTask("tail", h1, h2, 5)])
+        wf.refreshTargets()
+        assert_equal(["head", "tail", "leaf"], ran)
+
+        try:
+            wf.setReadyTaskOrder("random")
+        except pypeflow.common.PypeError:
+            pass
+        else:
+            assert False, "unknown order accepted"
+
+    def test_resources(self):
+        import os, time, threading
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        lock = threading.Lock()
+        running = set()
+        overlaps = []
+
+        def makeTask(name, resources, cost):
+            @PypeTask(outputDataObjs={"o": PypeLocalFile("file://localhost/tmp/pypetest/res_%s" % name)},
+                      parameters={"resources": resources, "cost": cost}, URL="task://localhost/res_%s" % name,
+                      TaskType=PypeThreadTaskBase)
+            def t(self):
+                with lock:
+                    overlaps.append((name, sorted(running)))
+                    running.add(name)
+                time.sleep(0.2)
+                with lock:
+                    running.discard(name)
+                open(self.o.localFileName, "w").write(name)
+            return t
+
+        wf = pypeflow.controller.PypeThreadWorkflow()
+        wf.CONCURRENT_THREAD_ALLOWED = 4
+        wf.MAX_NUMBER_TASK_SLOT = 4
+        wf.setResourceCapacity("mem_gb", 64)
+        wf.addTasks([makeTask("mem1", {"mem_gb": 40}, 10), makeTask("mem2", {"mem_gb": 40}, 10),
+                     makeTask("cpu1", {}, 1), makeTask("cpu2", {}, 1)])
+        wf.refreshTargets()
+        overlaps = dict(overlaps)
+        assert "mem2" not in overlaps["mem1"] and "mem1" not in overlaps["mem2"], overlaps
+        assert any(o for o in (overlaps["cpu1"], overlaps["cpu2"])), overlaps # not held back by mem2
+        assert_equal(40, wf.resourceUtilisation["mem_gb"]["peak"])
+        assert wf.resourceUtilisation["mem_gb"]["fraction"] < 40.0 / 64
+
+        wf = pypeflow.controller.PypeThreadWorkflow()
+        wf.setResourceCapacity("mem_gb", 64)
+        wf.addTasks([makeTask("huge", {"mem_gb": 100}, 1)])
+        try:
+            wf.refreshTargets()
+        except pypeflow.controller.TaskExecutionError:
+            pass
+        else:
+            assert False, "task larger than the capacity accepted"
+
+    def test_wideTaskKeepsItsPlace(self):
+        import os, time, threading
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        lock = threading.Lock()
+        running = set()
+        started = []
+
+        def makeTask(name, nSlots, seconds, inObj=None):
+            @PypeTask(inputDataObjs={"i": inObj} if inObj is not None else {},
+                      outputDataObjs={"o": PypeLocalFile("file://localhost/tmp/pypetest/wide_%s" % name)},
+                      parameters={"nSlots": nSlots}, URL="task://localhost/wide_%s" % name,
+                      TaskType=PypeThreadTaskBase)
+            def t(self):
+                with lock:
+                    started.append((name, sorted(running)))
+                    running.add(name)
+                time.sleep(seconds)
+                with lock:
+                    running.discard(name)
+                open(self.o.localFileName, "w").write(name)
+            return t
+
+        # The 4-slot task becomes ready while "first" runs, and the 1-slot tasks after it.
+        first, gate1, gate2 = makeTask("first", 1, 0.5), makeTask("gate1", 1, 0), makeTask("gate2", 1, 0.1)
+        wide = makeTask("wide", 4, 0.05, gate1.outputDataObjs["o"])
+        small = [makeTask("small%d" % i, 1, 0.05, gate2.outputDataObjs["o"]) for i in range(6)]
+        wf = pypeflow.controller.PypeThreadWorkflow(readyTaskOrder="fifo")
+        wf.setNumThreadAllowed(4, 4)
+        wf.addTasks([first, gate1, gate2, wide] + small)
+        wf.refreshTargets()
+        names = [name for name, others in started]
+        assert_equal([], dict(started)["wide"])
+        assert all(names.index("wide") < names.index(t) for t in ("small%d" % i for i in range(6))), names
+
+    def test_lightweightBatches(self):
+        import os, time
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        nTasks = 40
+
+        def makeTask(i):
+            @PypeTask(outputDataObjs={"o": PypeLocalFile("file://localhost/tmp/pypetest/light_%d" % i)},
+                      parameters={"lightweight": True}, URL="task://localhost/light_%d" % i,
+                      TaskType=PypeThreadTaskBase)
+            def t(self):
+                if i == 7:
+                    time.sleep(0.2) # after some successes, or the workflow stops at the first failure
+                    raise Exception("task 7 fails")
+                open(self.o.localFileName, "w").write("%d" % i)
+            return t
+
+        wf = pypeflow.controller.PypeThreadWorkflow(batchSize=8)
+        wf.setNumThreadAllowed(2, 2)
+        tasks = [makeTask(i) for i in range(nTasks)]
+        wf.addTasks(tasks)
+        try:
+            wf.refreshTargets(exitOnFailure=False)
+        except pypeflow.controller.LateTaskFailureError:
+            pass
+        else:
+            assert False, "the failure of task 7 was not reported"
+        assert_equal(["fail"], [t.status for t in tasks if t.status != "done"])
+        assert_equal("fail", wf.jobStatusMap["task://localhost/light_7"])
+        assert_equal(nTasks - 1, len([i for i in range(nTasks) if os.path.exists("/tmp/pypetest/light_%d" % i)]))
+        stats = wf.dispatchStats
+        assert_equal(nTasks, stats["tasks"])
+        assert stats["workers"] <= nTasks / 8 + 2, stats
+        assert wf.overheadPerTask() >= 0
+
+    def test_chainLatency(self):
+        import os, time, threading
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        nStages = 30
+        files = [PypeLocalFile("file://localhost/tmp/pypetest/chain_%d" % i) for i in range(nStages + 1)]
+        open(files[0].localFileName, "w").write("0")
+        tasks = []
+        for i in range(nStages):
+            @PypeTask(inputDataObjs={"i": files[i]}, outputDataObjs={"o": files[i + 1]},
+                      URL="task://localhost/chain_%d" % i, TaskType=PypeThreadTaskBase)
+            def t(self):
+                open(self.o.localFileName, "w").write("x")
+            tasks.append(t)
+        waits = [] # number of messages each wait returned
+        class Workflow(pypeflow.controller._PypeConcurrentWorkflow):
+            MAX_WAIT = 10.0
+            def _receiveMessages(self, timeout=0):
+                start = time.time()
+                messages = pypeflow.controller._PypeConcurrentWorkflow._receiveMessages(self, timeout)
+                # Only a task that never reports can make it wait that long.
+                assert messages or time.time() - start < timeout, "the scheduler slept through a message"
+                waits.append(len(messages))
+                return messages
+        wf = Workflow(URL=None, thread_handler=pypeflow.controller._PypeThreadsHandler(),
+                      messageQueue=pypeflow.controller.PypeMessageQueue(), shutdown_event=threading.Event(),
+                      attributes={})
+        wf.addTasks(tasks)
+        wf.refreshTargets()
+        assert len(waits) >= nStages
+        assert_equal("x", open(files[-1].localFileName).read())
+
+    def test_stateDB(self):
+        import os
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        dbFileName = "/tmp/pypetest/state/taskstate.sqlite"
+        names = ["a", "b", "c"]
+        ran = []
+
+        def makeWorkflow():
+            files = [PypeLocalFile("file://localhost/tmp/pypetest/state_%s" % x) for x in ["in"] + names]
+            tasks = []
+            for i, name in enumerate(names):
+                @PypeTask(inputDataObjs={"i": files[i]}, outputDataObjs={"o": files[i + 1]},
+                          URL="task://localhost/state_%s" % name, TaskType=PypeThreadTaskBase)
+                def t(self):
+                    ran.append(self.URL.rsplit("_", 1)[-1])
+                    open(self.o.localFileName, "w").write(open(self.i.localFileName).read() + "+")
+                def finalize():
+                    ran.append("finalize")
+                t.finalize = finalize
+                tasks.append(t)
+            wf = pypeflow.controller.PypeThreadWorkflow()
+            wf.setStateDB(dbFileName)
+            wf.addTasks(tasks)
+            return wf
+
+        open("/tmp/pypetest/state_in", "w").write("in")
+        makeWorkflow().refreshTargets()
+        assert_equal(["a", "finalize", "b", "finalize", "c", "finalize"], ran)
+
+        # A restart trusts the record, without finalizing the tasks again.
+        del ran[:]
+        makeWorkflow().refreshTargets()
+        assert_equal([], ran)
+
+        # The last output is checked.
+        os.remove("/tmp/pypetest/state_c")
+        makeWorkflow().refreshTargets()
+        assert_equal(["c", "finalize"], ran)
+
+        # So is the input no task makes.
+        del ran[:]
+        open("/tmp/pypetest/state_in", "w").write("changed")
+        os.utime("/tmp/pypetest/state_in", (2e9, 2e9))
+        makeWorkflow().refreshTargets()
+        assert_equal(["a", "finalize", "b", "finalize", "c", "finalize"], ran)
+        assert_equal("changed+++", open("/tmp/pypetest/state_c").read())
+
+    def test_outputCache(self):
+        import os
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        names = ["a", "b"]
+        ran = []
+
+        def makeWorkflow():
+            files = [PypeLocalFile("file://localhost/tmp/pypetest/cached_%s" % x) for x in ["in"] + names]
+            tasks = []
+            for i, name in enumerate(names):
+                @PypeTask(inputDataObjs={"i": files[i]}, outputDataObjs={"o": files[i + 1]},
+                          URL="task://localhost/cached_%s" % name, TaskType=PypeThreadTaskBase)
+                def t(self):
+                    ran.append(self.URL.rsplit("_", 1)[-1])
+                    open(self.o.localFileName, "w").write(open(self.i.localFileName).read() + "+")
+                tasks.append(t)
+            wf = pypeflow.controller.PypeThreadWorkflow()
+            wf.setOutputCache("/tmp/pypetest/cache")
+            wf.addTasks(tasks)
+            return wf
+
+        open("/tmp/pypetest/cached_in", "w").write("in")
+        wf = makeWorkflow()
+        wf.refreshTargets()
+        assert_equal(["a", "b"], ran)
+        assert_equal((0, 2, 2), (wf.outputCache.hits, wf.outputCache.misses, wf.outputCache.stores))
+
+        del ran[:]
+        open("/tmp/pypetest/cached_in", "w").write("other")
+        os.utime("/tmp/pypetest/cached_in", (2e9, 2e9))
+        makeWorkflow().refreshTargets()
+        assert_equal(["a", "b"], ran)
+
+        # Back to the first input: both outputs come from the cache.
+        del ran[:]
+        open("/tmp/pypetest/cached_in", "w").write("in")
+        os.utime("/tmp/pypetest/cached_in", (2.1e9, 2.1e9))
+        wf = makeWorkflow()
+        wf.refreshTargets()
+        assert_equal([], ran)
+        assert_equal((2, 0), (wf.outputCache.hits, wf.outputCache.misses))
+        assert_equal("in++", open("/tmp/pypetest/cached_b").read())
+        assert os.path.getmtime("/tmp/pypetest/cached_b") >= os.path.getmtime("/tmp/pypetest/cached_a")
+
+    def test_outputCacheScript(self):
+        import os
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeShellTask = pypeflow.task.PypeShellTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        open("/tmp/pypetest/script_in", "w").write("in")
+
+        def run(command):
+            with open("/tmp/pypetest/script.sh", "w") as f:
+                f.write("%s > /tmp/pypetest/script_out\n" % command)
+            taskObj = PypeShellTask(inputDataObjs={"i": PypeLocalFile("file://localhost/tmp/pypetest/script_in")},
+                                    outputDataObjs={"o": PypeLocalFile("file://localhost/tmp/pypetest/script_out")},
+                                    URL="task://localhost/script", TaskType=PypeThreadTaskBase)("/tmp/pypetest/script.sh")
+            wf = pypeflow.controller.PypeThreadWorkflow()
+            wf.setOutputCache("/tmp/pypetest/cache")
+            wf.addTasks([taskObj])
+            os.system("rm -f /tmp/pypetest/script_out") # to make it run again
+            wf.refreshTargets()
+            return wf.outputCache.hits, open("/tmp/pypetest/script_out").read()
+
+        assert_equal((0, "old\n"), run("echo old"))
+        assert_equal((1, "old\n"), run("echo old"))
+        # The script changed, the outputs of the old one are not used.
+        assert_equal((0, "new\n"), run("echo new"))
+
+    def test_workerPool(self):
+        import os
+        os.system("rm -rf /tmp/pypetest/*")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        fin = PypeLocalFile("file://localhost/tmp/pypetest/pool_in")
+        with open(fin.localFileName, "w") as f:
+            f.write("in")
+
+        def makeTask(i):
+            fout = PypeLocalFile("file://localhost/tmp/pypetest/pool_out%d" % i)
+            @PypeTask(inputDataObjs={"i": fin}, outputDataObjs={"o": fout},
+                      URL="task://localhost/pool_%d" % i, TaskType=PypeThreadTaskBase)
+            def t(self):
+                with open(self.o.localFileName, "w") as f:
+                    f.write(str(os.getpid()))
+            return t
+
+        wf = pypeflow.controller.PypeMPPoolWorkflow(maxTasksPerChild=2)
+        wf.CONCURRENT_THREAD_ALLOWED = 2
+        wf.MAX_NUMBER_TASK_SLOT = 2
+        wf.addTasks([makeTask(i) for i in range(7)])
+        wf.refreshTargets()
+        pids = set(open("/tmp/pypetest/pool_out%d" % i).read() for i in range(7))
+        assert str(os.getpid()) not in pids
+        assert 2 <= len(pids) <= 6, pids # workers are reused, and recycled
+        assert_equal(7, wf.thread_handler.nTasks)
+        assert len(pids) <= wf.thread_handler.nForks
+
+    def test_workerPoolDeadWorker(self):
+        import os, signal, time
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+
+        def makeTask(i):
+            fout = PypeLocalFile("file://localhost/tmp/pypetest/dead_out%d" % i)
+            @PypeTask(outputDataObjs={"o": fout}, URL="task://localhost/dead_%d" % i, TaskType=PypeThreadTaskBase)
+            def t(self):
+                if i == 1:
+                    time.sleep(0.2)
+                    os.kill(os.getpid(), signal.SIGKILL) # e.g. by the OOM killer
+                if i == 2:
+                    os.kill(os.getpid(), signal.SIGKILL) # before its "started" reaches the controller
+                with open(self.o.localFileName, "w") as f:
+                    f.write("%d" % i)
+            return t
+
+        wf = pypeflow.controller.PypeMPPoolWorkflow()
+        wf.setNumThreadAllowed(2, 2)
+        wf.addTasks([makeTask(i) for i in range(5)])
+        try:
+            wf.refreshTargets(exitOnFailure=False)
+        except pypeflow.controller.LateTaskFailureError:
+            pass
+        else:
+            assert False, "the task of the dead worker did not fail"
+        assert_equal(["fail"] * 2, [wf.jobStatusMap["task://localhost/dead_%d" % i] for i in (1, 2)])
+        assert_equal(["done"] * 3, [wf.jobStatusMap["task://localhost/dead_%d" % i] for i in (0, 3, 4)])
+
+    def test_shellLoop(self):
+        import os, threading
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeShellTask = pypeflow.task.PypeShellTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        nTasks = 50
+        taskObjs = []
+        for i in range(nTasks):
+            fout = PypeLocalFile("file://localhost/tmp/pypetest/loop_out%d" % i)
+            script = "/tmp/pypetest/loop%d.sh" % i
+            with open(script, "w") as f:
+                if i == 0:
+                    f.write("sleep 1; exit 1\n") # fails after the others, no output
+                else:
+                    f.write("sleep 0.2; touch %s\n" % fout.localFileName)
+            taskObjs.append(PypeShellTask(outputDataObjs={"o": fout}, URL="task://localhost/loop_%d" % i,
+                                          TaskType=PypeThreadTaskBase)(script))
+        threadCounts = []
+        class Workflow(pypeflow.controller._PypeConcurrentWorkflow):
+            def _update(self, elapsed):
+                threadCounts.append(threading.activeCount())
+        wf = Workflow(URL=None, thread_handler=pypeflow.controller._PypeShellLoopHandler(),
+                      messageQueue=pypeflow.controller.Queue.Queue(), shutdown_event=threading.Event(),
+                      attributes={})
+        wf.CONCURRENT_THREAD_ALLOWED = nTasks
+        wf.MAX_NUMBER_TASK_SLOT = nTasks
+        wf.addTasks(taskObjs)
+        try:
+            wf.refreshTargets(updateFreq=0, exitOnFailure=False)
+        except pypeflow.controller.LateTaskFailureError:
+            pass
+        else:
+            assert False, "failure not reported"
+        assert_equal("fail", wf.jobStatusMap["task://localhost/loop_0"])
+        assert all(wf.jobStatusMap["task://localhost/loop_%d" % i] == "done" for i in range(1, nTasks))
+        finishThreads = pypeflow.controller._PypeShellLoopHandler.finishThreads
+        # The loop, and the finishing pool with its 3 handler threads; not one thread per task.
+        assert max(threadCounts) <= threading.activeCount() + 1 + finishThreads + 3, threadCounts
+
+    def test_shellLoopShutdown(self):
+        import os, signal, time
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeShellTask = pypeflow.task.PypeShellTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        with open("/tmp/pypetest/forever.sh", "w") as f:
+            f.write("exec sleep 60\n") # no grandchild left behind holding our stdout
+        taskObj = PypeShellTask(outputDataObjs={"o": PypeLocalFile("file://localhost/tmp/pypetest/forever")},
+                                URL="task://localhost/forever", TaskType=PypeThreadTaskBase)("/tmp/pypetest/forever.sh")
+        taskObj.setMessageQueue(pypeflow.controller.Queue.Queue())
+        handler = pypeflow.controller._PypeShellLoopHandler()
+        handler.prepare({}, 1)
+        job = handler.create(taskObj)
+        job.start()
+        time.sleep(0.2)
+        then = time.time()
+        handler.shutdown()
+        assert time.time() - then < 10
+        assert_equal(-signal.SIGTERM, job.proc.returncode) # terminated and reaped
+        assert not job.is_alive()
+
+    def test_shellLoopBackgroundChild(self):
+        import os, sys, signal, threading
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeShellTask = pypeflow.task.PypeShellTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        with open("/tmp/pypetest/bg.sh", "w") as f:
+            # The background process holds the exit pipe of the script.
+            f.write("touch /tmp/pypetest/bg; sleep 60 >/dev/null 2>&1 & echo $! > /tmp/pypetest/bg.pid\n")
+        with open("/tmp/pypetest/closer.sh", "w") as f:
+            # Lets go of the exit pipe long before it is over.
+            f.write("exec %s -c 'import os, time; os.closerange(3, 1024); time.sleep(0.5); "
+                    "open(\"/tmp/pypetest/closer\", \"w\")'\n" % sys.executable)
+
+        def run(prepareHere):
+            handler = pypeflow.controller._PypeShellLoopHandler()
+            if prepareHere:
+                handler.prepare({}, 2) # SIGCHLD wakes the loop up
+            else:
+                t = threading.Thread(target=handler.prepare, args=({}, 2)) # no SIGCHLD, reap by polling
+                t.start()
+                t.join()
+            jobs = []
+            for name in ("bg", "closer"):
+                taskObj = PypeShellTask(outputDataObjs={"o": PypeLocalFile("file://localhost/tmp/pypetest/%s" % name)},
+                                        URL="task://localhost/%s" % name, TaskType=PypeThreadTaskBase)("/tmp/pypetest/%s.sh" % name)
+                taskObj.setMessageQueue(pypeflow.controller.Queue.Queue())
+                job = handler.create(taskObj)
+                job.start()
+                jobs.append(job)
+            try:
+                for job in jobs:
+                    job.join(20)
+                    assert not job.is_alive(), job.taskObj.URL
+                    assert_equal(0, job.proc.returncode)
+                bgPid = int(open("/tmp/pypetest/bg.pid").read())
+                os.kill(bgPid, 0) # the task is done without waiting for its background process
+                os.kill(bgPid, signal.SIGTERM)
+            finally:
+                handler.shutdown()
+            assert_equal(signal.SIG_DFL, signal.getsignal(signal.SIGCHLD))
+
+        run(True)
+        run(False)
+
+    def test_cluster(self):
+        import os, threading
+        import pypeflow.cluster
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeDistributibleTask = pypeflow.task.PypeDistributibleTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        nTasks = 40
+        taskObjs = []
+        for i in range(nTasks):
+            fout = PypeLocalFile("file://localhost/tmp/pypetest/cluster_out%d" % i)
+            script = "/tmp/pypetest/cluster%d.sh" % i
+            with open(script, "w") as f:
+                if i == 0:
+                    f.write("sleep 1\n") # no output
+                else:
+                    f.write("touch %s\n" % fout.localFileName)
+            taskObjs.append(PypeDistributibleTask(outputDataObjs={"o": fout}, URL="task://localhost/cluster_%d" % i,
+                                                  distributed=True, TaskType=PypeThreadTaskBase)(script))
+        scheduler = pypeflow.cluster.PypeFakeScheduler(maxRunning=8)
+        wf = pypeflow.controller.PypeClusterWorkflow(backend=scheduler, minPollInterval=0.05, maxPollInterval=0.2)
+        wf.CONCURRENT_THREAD_ALLOWED = nTasks
+        wf.MAX_NUMBER_TASK_SLOT = nTasks
+        wf.addTasks(taskObjs)
+        nThreads = threading.activeCount()
+        try:
+            wf.refreshTargets(exitOnFailure=False)
+        except pypeflow.controller.LateTaskFailureError:
+            pass
+        else:
+            assert False, "failure not reported"
+        assert_equal(nThreads, threading.activeCount())
+        assert_equal("fail", wf.jobStatusMap["task://localhost/cluster_0"])
+        assert all(wf.jobStatusMap["task://localhost/cluster_%d" % i] == "done" for i in range(1, nTasks))
+        assert_equal(nTasks, scheduler.nSubmitted)
+        assert scheduler.nStatusQueries < nTasks * 2, scheduler.nStatusQueries # batched
+        scheduler.close()
+
+    def test_clusterArrayJob(self):
+        import os, time
+        import pypeflow.cluster
+        os.system("rm -rf /tmp/pypetest/*; mkdir -p /tmp/pypetest")
+        PypeLocalFile = pypeflow.data.PypeLocalFile
+        PypeTask = pypeflow.task.PypeTask
+        PypeThreadTaskBase = pypeflow.task.PypeThreadTaskBase
+        nChunks = 4
+        script = "/tmp/pypetest/array.sh"
+        with open(script, "w") as f:
+            f.write("if [ $PYPEFLOW_CHUNK_ID = 0 ]; then sleep 1; fi\n")
+            f.write("date +%s.%N > /tmp/pypetest/array_out$PYPEFLOW_CHUNK_ID\n")
+        chunks = pypeflow.task.PypeTaskCollection("tasks://localhost/array")
+        after = []
+        for i in range(nChunks):
+            fout = PypeLocalFile("file://localhost/tmp/pypetest/array_out%d" % i)
+            chunks.addTask(PypeThreadTaskBase("task://localhost/array/%03d" % i, outputDataObjs={"o": fout},
+                                              script=script, distributed=True, chunk_id=i, _taskFun=None))
+            fdone = PypeLocalFile("file://localhost/tmp/pypetest/array_done%d" % i)
+            @PypeTask(inputDataObjs={"i": fout}, outputDataObjs={"o": fdone},
+                      URL="task://localhost/array_done_%d" % i, TaskType=PypeThreadTaskBase)
+            def done(self):
+                open(self.o.localFileName, "w").write("%f" % time.time())
+            after.append(done)
+        scheduler = pypeflow.cluster.PypeFakeScheduler()
+        wf = pypeflow.controller.PypeClusterWorkflow(backend=scheduler, minPollInterval=0.05, maxPollInterval=0.2)
+        wf.addTasks([chunks] + after)
+        wf.refreshTargets()
+        scheduler.close()
+        assert_equal(1, scheduler.nSubmitted)
+        slowEnd = float(open("/tmp/pypetest/array_out0").read())
+        for i in range(1, nChunks):
+            assert float(open("/tmp/pypetest/array_done%d" % i).read()) < slowEnd # not held back by chunk 0
 
     def test_mutableDataObjects(self):
 
@@ -20,6 +20,60 @@ class TestFn:
         file = PypeLocalFile("file://localhost"+ os.path.abspath("./test1"))
         assert fn(file) == os.path.abspath("./test1") 
 
+class TestPypeStatCache:
+    def test_stat(self):
+        obj = PypeLocalFile("file://localhost/tmp/pypetest/stat_cache_test")
+        os.system("mkdir -p /tmp/pypetest/; touch /tmp/pypetest/stat_cache_test")
+        cache = pypeflow.data.statCache
+        cache.activate()
+        try:
+            assert obj.exists == True
+            ts = obj.timeStamp
+            os.system("rm /tmp/pypetest/stat_cache_test")
+            assert obj.exists == True # cached for the whole pass
+            assert obj.timeStamp == ts
+            assert_equal((3, 1), (cache.hits, cache.misses))
+            cache.invalidateDataObjs([obj])
+            assert obj.exists == False
+        finally:
+            cache.deactivate()
+        os.system("touch /tmp/pypetest/stat_cache_test")
+        assert obj.exists == True # not cached when inactive
+        os.system("rm /tmp/pypetest/stat_cache_test")
+        assert obj.exists == False
+
+    def test_prefetch(self):
+        os.system("mkdir -p /tmp/pypetest/prefetch/a /tmp/pypetest/prefetch/b")
+        paths = ["/tmp/pypetest/prefetch/%s/%d" % (d, i) for d in "ab" for i in range(5)]
+        for path in paths[::2]:
+            open(path, "w").close()
+        cache = pypeflow.data.PypeStatCache()
+        cache.prefetch(paths) # inactive, nothing is kept
+        assert_equal(0, cache.misses)
+        cache.activate()
+        try:
+            cache.prefetch(paths + paths, nThreads=4, chunkSize=2)
+            assert_equal(10, cache.misses)
+            os.system("rm -rf /tmp/pypetest/prefetch")
+            assert_equal([True, False] * 5, [cache.stat(p) is not None for p in paths])
+            assert_equal((10, 10), (cache.hits, cache.misses))
+        finally:
+            cache.deactivate()
+
+    def test_other_thread(self):
+        import threading
+        os.system("mkdir -p /tmp/pypetest/; touch /tmp/pypetest/stat_cache_test")
+        cache = pypeflow.data.PypeStatCache()
+        cache.activate()
+        assert cache.stat("/tmp/pypetest/stat_cache_test") is not None
+        os.system("rm /tmp/pypetest/stat_cache_test")
+        result = []
+        t = threading.Thread(target=lambda: result.append(cache.stat("/tmp/pypetest/stat_cache_test")))
+        t.start()
+        t.join()
+        assert_equal([None], result)
+        cache.deactivate()
+
 class TestPypeDataObjectBase: #this class can not be tested directly
     pass
 
@@ -0,0 +1,109 @@
+from nose.tools import assert_equal
+import pypeflow.scheduler
+import pypeflow.task
+
+PypeReadyQueue = pypeflow.scheduler.PypeReadyQueue
+PypeResourcePool = pypeflow.scheduler.PypeResourcePool
+PypeConcurrencyController = pypeflow.scheduler.PypeConcurrencyController
+TaskInitialized = pypeflow.task.TaskInitialized
+TaskDone = pypeflow.task.TaskDone
+
+def _drain(q):
+    URLs = []
+    while q:
+        URLs.append(q.pop())
+    return URLs
+
+class TestPypeReadyQueue:
+    def test___init__(self):
+        prereqs = {"a": [], "b": ["a"], "c": [], "d": ["b", "c"]}
+        status = {"a": TaskDone, "b": TaskInitialized, "c": TaskInitialized, "d": TaskInitialized}
+        q = PypeReadyQueue(["a", "b", "c", "d"], prereqs, status)
+        assert_equal(["b", "c"], _drain(q))
+        assert_equal(2, q.remaining("d"))
+
+    def test_taskDone(self):
+        prereqs = {"a": [], "b": ["a"], "c": ["a"], "d": ["b", "c"]}
+        status = dict((URL, TaskInitialized) for URL in prereqs)
+        q = PypeReadyQueue(["a", "b", "c", "d"], prereqs, status)
+        assert_equal(["a"], _drain(q))
+        assert_equal(["b", "c"], q.taskDone("a"))
+        assert_equal([], q.taskDone("b"))
+        assert_equal(["d"], q.taskDone("c"))
+        assert_equal(["b", "c", "d"], _drain(q))
+
+    def test_taskDone_skips_finished_successor(self):
+        prereqs = {"a": [], "b": ["a"]}
+        status = {"a": TaskInitialized, "b": "fail"}
+        q = PypeReadyQueue(["a", "b"], prereqs, status)
+        _drain(q)
+        assert_equal([], q.taskDone("a"))
+        assert_equal(0, len(q))
+
+    def test_push(self):
+        q = PypeReadyQueue(["a"], {"a": []}, {"a": TaskInitialized})
+        q.pop()
+        q.push("a")
+        assert_equal(["a"], _drain(q))
+
+class TestPypeResourcePool:
+    def test_utilisation(self):
+        now = [0.0]
+        pool = PypeResourcePool({"slots": 4, "mem_gb": 64}, clock=lambda: now[0])
+        pool.acquire({"slots": 2, "mem_gb": 32, "io": 1})
+        now[0] = 10.0
+        pool.release({"slots": 2, "mem_gb": 32, "io": 1})
+        now[0] = 20.0
+        use = pool.utilisation()
+        assert_equal({"capacity": 64, "peak": 32, "mean": 16.0, "fraction": 0.25}, use["mem_gb"])
+        assert_equal(1, use["io"]["peak"])
+        assert_equal(None, use["io"]["capacity"])
+        assert_equal(0, pool.used("slots"))
+
+    def test_shortOf(self):
+        pool = PypeResourcePool({"slots": 4, "io": 2})
+        pool.acquire({"slots": 1, "io": 2})
+        assert_equal(["io"], pool.shortOf({"slots": 1, "io": 1}))
+        assert pool.fits({"slots": 3, "mem_gb": 1000})
+        assert_equal([], pool.exceeds({"slots": 4, "io": 2}))
+
+class TestPypeConcurrencyController:
+    def _controller(self, probes, **options):
+        now = [0]
+        def tick(nRunning, nDone, nWaiting=1):
+            now[0] += 10
+            return c.update(nRunning, nDone, nWaiting)
+        c = PypeConcurrencyController(clock=lambda: now[0], loadProbe=lambda: probes["load"],
+                                      memoryProbe=lambda: probes["memory"], **options)
+        return c, tick
+
+    def test_climb(self):
+        probes = {"load": 0.2, "memory": 0.8}
+        c, tick = self._controller(probes, minTasks=1, maxTasks=16, initial=4)
+        assert_equal(5, tick(4, 40))
+        assert_equal(6, tick(5, 90))
+        assert_equal(7, tick(6, 150))
+        # The throughput drops: back off.
+        assert_equal(6, tick(7, 160))
+        # No task waits for the limit: keep it.
+        assert_equal(6, tick(3, 200, 0))
+
+    def test_load(self):
+        probes = {"load": 2.0, "memory": 0.8}
+        c, tick = self._controller(probes, minTasks=2, maxTasks=16, initial=8)
+        assert_equal(6, tick(8, 10))
+        assert_equal(4, tick(6, 20))
+        assert_equal(3, tick(4, 30))
+        assert_equal(2, tick(3, 40))
+        assert_equal(2, tick(2, 50))
+        probes["load"], probes["memory"] = None, 0.05
+        assert_equal(2, tick(2, 60))
+        probes["memory"] = None
+        assert_equal(3, tick(2, 70))
+        assert_equal([6, 4, 3, 2, 3], [limit for t, limit, reason in c.history])
+
+    def test_bounds(self):
+        probes = {"load": 0.1, "memory": None}
+        c, tick = self._controller(probes, minTasks=1, maxTasks=3, initial=3)
+        assert_equal(3, tick(3, 10))
+        assert_equal(3, tick(3, 20))
@@ -0,0 +1,73 @@
+from nose.tools import assert_equal
+import multiprocessing
+import pypeflow.statusboard
+
+PypeStatusBoard = pypeflow.statusboard.PypeStatusBoard
+TaskStarted = pypeflow.statusboard.TaskStarted
+
+def _report(board, URLs):
+    for URL in URLs:
+        board.put( (URL, TaskStarted) )
+        board.put( (URL, "fail" if URL.endswith("3") else "done", 1.0) )
+
+class TestPypeStatusBoard:
+    def test_drain(self):
+        board = PypeStatusBoard()
+        URLs = ["task://localhost/t%d" % i for i in range(8)]
+        board.prepare(URLs)
+        procs = [multiprocessing.Process(target=_report, args=(board, URLs[i::2])) for i in range(2)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        assert board.wait(1)
+        messages = board.drain()
+        assert_equal(16, len(messages))
+        for URL in URLs:
+            mine = [m for m in messages if m[0] == URL]
+            assert_equal([(URL, TaskStarted), (URL, "fail" if URL.endswith("3") else "done", 1.0)], mine)
+        assert board.empty()
+        assert not board.wait(0)
+
+    def test_fallback(self):
+        board = PypeStatusBoard()
+        board.prepare(["task://localhost/a"])
+        board.put( ("task://localhost/a", "something else") )
+        board.put( ("task://localhost/b", "done") )
+        messages = []
+        while len(messages) < 2:
+            board.wait(1)
+            messages.extend(board.drain())
+        assert_equal([("task://localhost/a", "something else"), ("task://localhost/b", "done")], messages)
+
+    def test_order(self):
+        board = PypeStatusBoard()
+        board.prepare(["task://localhost/a"])
+        def report():
+            board.put( ("task://localhost/a", TaskStarted) )
+            board.put( ("task://localhost/a", "something else") )
+            board.put( ("task://localhost/a", "done") )
+            for i in range(40): # more than the log holds
+                board.put( ("task://localhost/a", "done") )
+        p = multiprocessing.Process(target=report)
+        p.start()
+        p.join()
+        assert board.wait(1)
+        messages = board.drain() # the fallback messages may still be on their way
+        assert_equal(43, len(messages))
+        assert_equal([("task://localhost/a", TaskStarted), ("task://localhost/a", "something else")], messages[:2])
+        assert board.empty()
+
+    def test_close(self):
+        import os
+        nFds = len(os.listdir("/proc/self/fd"))
+        for i in range(4):
+            board = PypeStatusBoard()
+            board.prepare(["task://localhost/a"])
+            board.put( ("task://localhost/a", "done") )
+            assert_equal([("task://localhost/a", "done")], board.drain())
+            board.close()
+            queue = pypeflow.statusboard.PypeMessageQueue()
+            queue.put( ("task://localhost/a", "done") )
+            queue.close()
+        assert len(os.listdir("/proc/self/fd")) <= nFds + 2, "wakeup pipes left open" # 2 for the fallback queue of the last board
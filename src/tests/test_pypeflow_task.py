@@ -86,6 +86,31 @@ class TestTimeStampCompare:
         # assert_equal(expected, timeStampCompare(inputDataObjs, outputDataObjs, parameters))
         raise SkipTest # TODO: implement your test here
 
+class TestPypeContentCompare:
+    def test_run(self):
+        import os
+        os.system("mkdir -p /tmp/pypetest/content; rm -f /tmp/pypetest/content/*")
+        compare = pypeflow.task.PypeContentCompare("/tmp/pypetest/content/digests.sqlite")
+        fin = pypeflow.data.makePypeLocalFile("/tmp/pypetest/content/in")
+        fout = pypeflow.data.makePypeLocalFile("/tmp/pypetest/content/out")
+        open(fin.localFileName, "w").write("a")
+        runs = []
+        @pypeflow.task.PypeTask(inputs={"fin":fin}, outputs={"fout":fout},
+                                _compareFunctions=[compare], URL="task://localhost/content_test")
+        def copy(self):
+            runs.append(1)
+            open(self.fout.localFileName, "w").write(open(self.fin.localFileName).read())
+        copy()
+        assert_equal(pypeflow.task.TaskDone, copy.status)
+        assert copy.isSatisfied()
+        os.utime(fin.localFileName, (0, 0)) # mtime lies, content is the same
+        os.utime(fout.localFileName, (0, 0))
+        os.utime(fin.localFileName, None)
+        assert copy.isSatisfied()
+        open(fin.localFileName, "w").write("b")
+        assert not copy.isSatisfied()
+        assert_equal([1], runs)
+
 class TestPypeTaskCollectionBase:
     def test___init__(self):
         # pype_task_collection_base = PypeTaskCollectionBase(URL, tasks)